@@ -11,6 +11,8 @@ Features :
 - Run Prepare training data
 - Run Training
 - Run Prediction
+- Queue jobs, run them in the background and follow their output
+- Preview orthoslices of the selected tomograms and of denoised outputs
 
 - Generate output folder
 - Output name
@@ -20,9 +22,158 @@ Features :
 import tkinter as tk
 from tkinter import messagebox, filedialog, Menu, Label, Button, ttk
 import subprocess
+import threading
+import queue
 import json
 import os
 import sys
+from collections import OrderedDict
+
+import mrcfile
+
+from cryocare.internals.CryoCAREBinning import bin_factor_for, orthoslices, overview, to_uint8, to_pgm
+
+
+class Job:
+    # A cryoCARE script run by the JobManager
+
+    def __init__(self, job_id, name, command):
+        self.id = job_id
+        self.name = name
+        self.command = command
+        self.status = "queued"
+        self.progress = ""
+        self.returncode = None
+        self.process = None
+        self.started = False
+        self.finished = False
+
+
+class JobManager:
+    """
+    Runs commands in background threads, at most max_running at a time.
+
+    The output of the jobs is passed to the Tk main thread through a queue, which the GUI empties with poll().
+    Tk widgets must only be used from the main thread, so the threads never touch them.
+    """
+
+    def __init__(self, max_running=1):
+        self.max_running = max_running
+        self.jobs = []
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+
+    def submit(self, name, command):
+        job = Job(len(self.jobs) + 1, name, command)
+        self.jobs.append(job)
+        self.start_queued()
+        return job
+
+    def running(self):
+        # Cancelled jobs count until their process has exited
+        return [job for job in self.jobs if job.started and not job.finished]
+
+    def start_queued(self):
+        for job in self.jobs:
+            if len(self.running()) >= self.max_running:
+                break
+            if job.status == "queued":
+                job.status = "running"
+                job.started = True
+                threading.Thread(target=self.run, args=(job,), daemon=True).start()
+
+    def run(self, job):
+        # Unbuffered, so that progress bars arrive while they are drawn
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        try:
+            with self.lock:
+                if job.status == "cancelled":
+                    self.events.put((job, "finished", None))
+                    return
+                job.process = subprocess.Popen(job.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                               text=True, bufsize=1, env=env)
+        except OSError as e:
+            self.events.put((job, "output", f"Failed to start {job.command[0]}: {e}"))
+            self.events.put((job, "finished", -1))
+            return
+        # Text mode splits on carriage returns as well, so each update of a progress bar is one line
+        for line in job.process.stdout:
+            line = line.rstrip()
+            if line:
+                self.events.put((job, "output", line))
+        self.events.put((job, "finished", job.process.wait()))
+
+    def cancel(self, job):
+        with self.lock:
+            if job.status == "queued":
+                job.status = "cancelled"
+            elif job.status == "running":
+                job.status = "cancelled"
+                if job.process is not None:
+                    job.process.terminate()
+
+    def cancel_all(self):
+        for job in self.jobs:
+            self.cancel(job)
+
+    def poll(self):
+        """
+        Returns the events of the jobs since the last call and starts queued jobs if a slot became free.
+        An event is a tuple (job, "output", line) or (job, "finished", returncode).
+        """
+        events = []
+        while True:
+            try:
+                job, kind, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "output":
+                job.progress = value
+            else:
+                job.returncode = value
+                job.finished = True
+                if job.status != "cancelled":
+                    job.status = "succeeded" if value == 0 else "failed"
+            events.append((job, kind, value))
+        self.start_queued()
+        return events
+
+
+def compute_thumbnails(path, max_size=256):
+    # Reads the orthoslices of a tomogram with a stride, so that only a small part of the file is read
+    with mrcfile.mmap(path, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        factor = bin_factor_for(data.shape, max_size)
+        xy, xz, yz = orthoslices(data, factor)
+        projection = overview(data, factor)
+        shape = data.shape
+    thumbnails = OrderedDict([("XY", xy), ("XZ", xz), ("YZ", yz), ("Overview", projection)])
+    return shape, OrderedDict((name, to_uint8(image)) for name, image in thumbnails.items())
+
+
+class ThumbnailCache:
+    # Keeps the thumbnails of the most recently previewed tomograms, until the file changes
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def key(self, path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+    def get(self, path):
+        key = self.key(path)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        return None
+
+    def put(self, path, thumbnails):
+        self.entries[self.key(path)] = thumbnails
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
 
 class CryoCARE_pipeline:
 
@@ -30,6 +181,10 @@ class CryoCARE_pipeline:
         # Initialize application with main window as parameter
         self.master = master
         self.master.title("CryoCARE - setup")
+        self.job_manager = JobManager(max_running=1)
+        self.thumbnail_cache = ThumbnailCache()
+        self.preview_queue = queue.Queue()
+        self.preview_images = {}
         self.create_widgets()
         self.create_menu()
         self.odd_files_training = []
@@ -37,6 +192,9 @@ class CryoCARE_pipeline:
         self.odd_files_prediction = []
         self.even_files_prediction = []
         self.master.bind("<Configure>", self.on_resize)
+        self.master.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.poll_jobs()
+        self.poll_previews()
 
     def create_widgets(self):
         # Method to create user interface widgets
@@ -118,6 +276,170 @@ class CryoCARE_pipeline:
         self.even_label_predict = tk.Label(self.predict_tab, text="Even Files Selected: ")
         self.even_label_predict.grid(row=len(buttons_predict) + 4, column=0, columnspan=2, padx=10, pady=5, sticky="nsew")
 
+        ## 4th tab
+        self.create_jobs_tab()
+
+        ## 5th tab
+        self.create_preview_tab()
+
+    def create_preview_tab(self):
+        # Method to create the tab showing orthoslices of a tomogram and of its denoised version
+        self.preview_tab = tk.Frame(self.notebook)
+        self.notebook.add(self.preview_tab, text="Preview")
+
+        controls = tk.Frame(self.preview_tab)
+        controls.grid(row=0, column=0, sticky="ew", padx=10, pady=5)
+        self.preview_choice = ttk.Combobox(controls, width=60, state="readonly")
+        self.preview_choice.bind("<<ComboboxSelected>>", lambda event: self.show_preview(self.preview_choice.get(), "before"))
+        self.preview_choice.pack(side="left")
+        Button(controls, text="Open Tomogram", command=self.open_preview_file, font=('Helvetica', 10)).pack(side="left", padx=5)
+        Button(controls, text="Compare with Denoised Output", command=self.compare_denoised, font=('Helvetica', 10)).pack(side="left")
+        self.preview_status = Label(self.preview_tab, text="Select a tomogram to preview.")
+        self.preview_status.grid(row=1, column=0, sticky="w", padx=10)
+
+        # One row of orthoslices before and one after denoising
+        self.preview_labels = {}
+        for row, name in enumerate(["before", "after"]):
+            frame = tk.LabelFrame(self.preview_tab, text="Input" if name == "before" else "Denoised")
+            frame.grid(row=row + 2, column=0, sticky="nsew", padx=10, pady=5)
+            self.preview_labels[name] = {}
+            for column, view in enumerate(["XY", "XZ", "YZ", "Overview"]):
+                Label(frame, text=view).grid(row=0, column=column)
+                self.preview_labels[name][view] = Label(frame)
+                self.preview_labels[name][view].grid(row=1, column=column, padx=5, pady=5)
+
+    def update_preview_choices(self):
+        # Method to offer all selected tomograms in the Preview tab
+        files = list(OrderedDict.fromkeys(self.even_files_training + self.odd_files_training +
+                                          self.even_files_prediction + self.odd_files_prediction))
+        self.preview_choice.config(values=files)
+
+    def open_preview_file(self):
+        file_path = filedialog.askopenfilename(title="Select a tomogram", filetypes=[("MRC files", "*.mrc *.rec"), ("All files", "*.*")])
+        if file_path:
+            self.preview_choice.set(file_path)
+            self.show_preview(file_path, "before")
+
+    def compare_denoised(self):
+        file_path = filedialog.askopenfilename(title="Select the denoised tomogram", filetypes=[("MRC files", "*.mrc *.rec"), ("All files", "*.*")])
+        if file_path:
+            self.show_preview(file_path, "after")
+
+    def show_preview(self, path, row):
+        # Method to show the thumbnails of a tomogram, they are computed in a background thread if not cached
+        if not self.validate_file(path):
+            return
+        thumbnails = self.thumbnail_cache.get(path)
+        if thumbnails is not None:
+            self.display_thumbnails(path, row, thumbnails)
+            return
+        self.preview_status.config(text=f"Loading {os.path.basename(path)} ...")
+
+        def load():
+            try:
+                self.preview_queue.put((path, row, compute_thumbnails(path), None))
+            except Exception as e:
+                self.preview_queue.put((path, row, None, e))
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def poll_previews(self):
+        # Method called periodically on the main thread to show thumbnails computed in the background
+        while True:
+            try:
+                path, row, thumbnails, error = self.preview_queue.get_nowait()
+            except queue.Empty:
+                break
+            if error is not None:
+                self.preview_status.config(text=f"Could not read {os.path.basename(path)}: {error}")
+                continue
+            self.thumbnail_cache.put(path, thumbnails)
+            self.display_thumbnails(path, row, thumbnails)
+        self.master.after(100, self.poll_previews)
+
+    def display_thumbnails(self, path, row, thumbnails):
+        shape, images = thumbnails
+        for view, image in images.items():
+            # The labels do not keep a reference to their image
+            self.preview_images[(row, view)] = tk.PhotoImage(data=to_pgm(image))
+            self.preview_labels[row][view].config(image=self.preview_images[(row, view)])
+        self.preview_status.config(text=f"{os.path.basename(path)}: {shape[2]} x {shape[1]} x {shape[0]} (X x Y x Z)")
+
+    def create_jobs_tab(self):
+        # Method to create the tab listing the queued and running jobs and their output
+        self.jobs_tab = tk.Frame(self.notebook)
+        self.notebook.add(self.jobs_tab, text="Jobs")
+        self.jobs_tab.grid_rowconfigure(2, weight=1)
+        self.jobs_tab.grid_columnconfigure(0, weight=1)
+
+        controls = tk.Frame(self.jobs_tab)
+        controls.grid(row=0, column=0, sticky="ew", padx=10, pady=5)
+        Label(controls, text="Jobs running at the same time:").pack(side="left")
+        self.max_running = tk.IntVar(value=self.job_manager.max_running)
+        tk.Spinbox(controls, from_=1, to=16, width=4, textvariable=self.max_running, command=self.set_max_running).pack(side="left", padx=5)
+        Button(controls, text="Cancel Selected Job", command=self.cancel_selected_job, font=('Helvetica', 10)).pack(side="right")
+
+        self.job_list = ttk.Treeview(self.jobs_tab, columns=("name", "status", "progress"), show="headings", height=6)
+        for column, width in [("name", 150), ("status", 80), ("progress", 400)]:
+            self.job_list.heading(column, text=column.capitalize())
+            self.job_list.column(column, width=width, stretch=column == "progress")
+        self.job_list.grid(row=1, column=0, sticky="nsew", padx=10, pady=5)
+
+        log_frame = tk.Frame(self.jobs_tab)
+        log_frame.grid(row=2, column=0, sticky="nsew", padx=10, pady=5)
+        self.job_log = tk.Text(log_frame, height=15, state="disabled", wrap="none")
+        scrollbar = tk.Scrollbar(log_frame, command=self.job_log.yview)
+        self.job_log.config(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        self.job_log.pack(side="left", fill="both", expand=True)
+
+    def set_max_running(self):
+        # Method called when the concurrency limit is changed
+        self.job_manager.max_running = self.max_running.get()
+        self.job_manager.start_queued()
+
+    def submit_job(self, name, command):
+        # Method to queue a cryoCARE script and show it in the Jobs tab
+        job = self.job_manager.submit(name, command)
+        self.job_list.insert("", "end", iid=str(job.id), values=(job.name, job.status, ""))
+        self.notebook.select(self.jobs_tab)
+
+    def cancel_selected_job(self):
+        # Method to cancel the jobs selected in the Jobs tab
+        for iid in self.job_list.selection():
+            self.job_manager.cancel(self.job_manager.jobs[int(iid) - 1])
+
+    def append_log(self, text):
+        self.job_log.config(state="normal")
+        self.job_log.insert("end", text + "\n")
+        self.job_log.see("end")
+        self.job_log.config(state="disabled")
+
+    def poll_jobs(self):
+        # Method called periodically on the main thread to show the output of the jobs
+        for job, kind, value in self.job_manager.poll():
+            if kind == "output":
+                self.append_log(f"[{job.id} {job.name}] {value}")
+            elif job.status == "cancelled":
+                self.append_log(f"[{job.id} {job.name}] Cancelled")
+            elif job.status == "succeeded":
+                self.append_log(f"[{job.id} {job.name}] Finished successfully")
+                messagebox.showinfo("Success", f"{job.name} completed successfully.")
+            else:
+                self.append_log(f"[{job.id} {job.name}] Failed with exit code {value}")
+                messagebox.showerror("Error", f"{job.name} failed with exit code {value}. See the Jobs tab for its output.")
+        for job in self.job_manager.jobs:
+            self.job_list.item(str(job.id), values=(job.name, job.status, job.progress))
+        self.master.after(200, self.poll_jobs)
+
+    def on_close(self):
+        # Method called when the window is closed, running jobs are stopped
+        if self.job_manager.running():
+            if not messagebox.askokcancel("Quit", "Jobs are still running. Cancel them and quit?"):
+                return
+            self.job_manager.cancel_all()
+        self.master.destroy()
+
     def on_resize(self, event):
         # Method called when resizing the window
         self.master.grid_rowconfigure(0, weight=1)
@@ -144,6 +466,7 @@ class CryoCARE_pipeline:
             if valid_files:
                 self.odd_files_training = valid_files
                 self.odd_label_training.config(text=f"Odd Files Selected: {', '.join(valid_files)}")
+                self.update_preview_choices()
             else:
                 messagebox.showerror("Error", "No valid files selected.")
 
@@ -155,6 +478,7 @@ class CryoCARE_pipeline:
             if valid_files:
                 self.even_files_training = valid_files
                 self.even_label_training.config(text=f"Even Files Selected: {', '.join(valid_files)}")
+                self.update_preview_choices()
             else:
                 messagebox.showerror("Error", "No valid files selected.")
 
@@ -166,6 +490,7 @@ class CryoCARE_pipeline:
             if valid_files:
                 self.odd_files_prediction = valid_files
                 self.odd_label_predict.config(text=f"Odd Files Selected: {', '.join(valid_files)}")
+                self.update_preview_choices()
             else:
                 messagebox.showerror("Error", "No valid files selected.")
 
@@ -177,6 +502,7 @@ class CryoCARE_pipeline:
             if valid_files:
                 self.even_files_prediction = valid_files
                 self.even_label_predict.config(text=f"Even Files Selected: {', '.join(valid_files)}")
+                self.update_preview_choices()
             else:
                 messagebox.showerror("Error", "No valid files selected.")
 
@@ -212,15 +538,10 @@ class CryoCARE_pipeline:
         self.save_json_file(data, "train_data_config.json")
 
     def prepare_training_data(self):
-        # Method to prepare the training data
-        try:
-            file_path = filedialog.askopenfilename(title="Select train_data_config.json", filetypes=[("JSON files", "*.json")])
-            if file_path:
-                subprocess.run(["cryoCARE_extract_train_data.py", "--conf", file_path])
-                print("Prepare training data completed successfully.")
-            messagebox.showinfo("Success", "Training data prepared successfully.")
-        except subprocess.CalledProcessError as e:
-            messagebox.showerror("Error", f"Failed to prepare training data. Error: {str(e)}")
+        # Method to queue the preparation of the training data
+        file_path = filedialog.askopenfilename(title="Select train_data_config.json", filetypes=[("JSON files", "*.json")])
+        if file_path:
+            self.submit_job("Prepare training data", ["cryoCARE_extract_train_data.py", "--conf", file_path])
 
     def generate_train_config(self):
         # Method to generate the training configuration file
@@ -240,16 +561,10 @@ class CryoCARE_pipeline:
         self.save_json_file(data, "train_config.json")
 
     def run_training(self):
-        # Method to run the training process
-        try:
-
-            file_path = filedialog.askopenfilename(title="Select train_config.json", filetypes=[("JSON files", "*.json")])
-            if file_path:
-                subprocess.run(["cryoCARE_train.py", "--conf", file_path])            
-            messagebox.showinfo("Success", "Training completed successfully.")
-
-        except subprocess.CalledProcessError as e:
-            messagebox.showerror("Error", f"Failed to run training. Error: {str(e)}")
+        # Method to queue the training process
+        file_path = filedialog.askopenfilename(title="Select train_config.json", filetypes=[("JSON files", "*.json")])
+        if file_path:
+            self.submit_job("Training", ["cryoCARE_train.py", "--conf", file_path])
 
     def generate_predict_config(self):
         # Method to generate the prediction configuration file
@@ -270,15 +585,10 @@ class CryoCARE_pipeline:
         self.save_json_file(data, "predict_config.json")
 
     def run_prediction(self):
-        # Method to run the prediction process
-        try:
-            file_path = filedialog.askopenfilename(title="Select predict_config.json", filetypes=[("JSON files", "*.json")])
-            if file_path:
-                subprocess.run(["cryoCARE_predict.py", "--conf", file_path])
-            messagebox.showinfo("Success", "Prediction completed successfully.")
-
-        except subprocess.CalledProcessError as e:
-            messagebox.showerror("Error", f"Failed to run prediction. Error: {str(e)}")
+        # Method to queue the prediction process
+        file_path = filedialog.askopenfilename(title="Select predict_config.json", filetypes=[("JSON files", "*.json")])
+        if file_path:
+            self.submit_job("Prediction", ["cryoCARE_predict.py", "--conf", file_path])
 
 def main():
     # Create application instance
@@ -0,0 +1,38 @@
+import argparse
+import json
+
+from cryocare.benchmarks.bench import run, compare
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cryoCARE on synthetic tomograms.')
+    parser.add_argument('--out', help='Write the results to this JSON file.')
+    parser.add_argument('--shape', type=int, nargs=3, default=[128, 128, 128], help='Shape of the synthetic tomograms.')
+    parser.add_argument('--patch_shape', type=int, nargs=3, default=[32, 32, 32])
+    parser.add_argument('--num_slices', type=int, default=200, help='Patches per tomogram.')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--n_tiles', type=int, nargs=3, default=[1, 2, 2])
+    parser.add_argument('--noise', type=float, default=1.0, help='Standard deviation of the noise.')
+    parser.add_argument('--vacuum_fraction', type=float, default=0.0,
+                        help='Fraction of the Z extent without any particles.')
+    parser.add_argument('--mask', action='store_true', help='Restrict patch extraction with a mask.')
+    parser.add_argument('--stages', nargs='+', help='Only run these stages.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two result files instead of running the benchmark.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run(shape=args.shape, patch_shape=args.patch_shape, n_samples_per_tomo=args.num_slices,
+                  batch_size=args.batch_size, n_tiles=args.n_tiles, noise=args.noise,
+                  vacuum_fraction=args.vacuum_fraction, mask=args.mask, stages=args.stages)
+    print(json.dumps(results, indent=4))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join
+
+import mrcfile
+import numpy as np
+from cryocare.benchmarks.synthetic import make_synthetic_pair
+from cryocare.internals.CryoCAREProfiler import PeakRSS
+
+
+def timed(fn, repeats=3):
+    """Returns the best of ``repeats`` wall clock times of ``fn()`` and its last result."""
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def bench_coordinates(dm, repeats=3):
+    t, _ = timed(dm.train_dataset.create_coordinate_lists, repeats)
+    return {'seconds': t, 'coords_per_second': dm.train_dataset.length / t}
+
+
+def bench_normalization(dm, n_samples=200, repeats=3):
+    n_samples = min(n_samples, len(dm.train_dataset))
+    t, _ = timed(lambda: dm.train_dataset.compute_mean_std(n_samples=n_samples), repeats)
+    return {'seconds': t, 'patches_per_second': n_samples / t}
+
+
+def bench_getitem(dm, n_patches=200):
+    ds = dm.train_dataset
+    t0 = time.perf_counter()
+    for i in range(n_patches):
+        ds[i % len(ds)]
+    t = time.perf_counter() - t0
+    return {'seconds': t, 'patches_per_second': n_patches / t}
+
+
+def bench_pipeline(dm, batch_size=4, n_batches=50):
+    it = iter(dm.get_train_dataset(batch_size))
+    next(it)
+    t0 = time.perf_counter()
+    for _ in range(n_batches):
+        next(it)
+    t = time.perf_counter() - t0
+    return {'seconds': t, 'patches_per_second': n_batches * batch_size / t}
+
+
+def bench_train_step(net_conf, dm, n_steps=20):
+    from cryocare.internals.CryoCAREAutotune import run_trial
+    import tensorflow as tf
+
+    return run_trial(net_conf, dm, net_conf.train_batch_size, tf.distribute.get_strategy(), n_steps=n_steps)
+
+
+def bench_convergence(net_conf, dm, even, odd, mask_path, patch_shape, n_samples_per_tomo, workdir, n_steps=200,
+                      eval_every=20):
+    """Trains the same network with uniform and with content-aware patch sampling and records the validation loss.
+
+    Both are validated on the uniformly drawn validation patches of ``dm`` and use its normalization. Reports the loss curves and after how many steps content-aware sampling reaches the
+    final loss of uniform sampling.
+    """
+    import tensorflow as tf
+    from cryocare.internals.CryoCARE import CryoCARE
+    from cryocare.internals.CryoCAREDataModule import CryoCARE_DataModule
+
+    content_dm = CryoCARE_DataModule()
+    content_dm.setup([odd], [even], mask_paths=None if mask_path is None else [mask_path],
+                     n_samples_per_tomo=n_samples_per_tomo, validation_fraction=0.1, sample_shape=patch_shape,
+                     tilt_axis='Y', n_normalization_samples=min(100, int(n_samples_per_tomo * 0.9)),
+                     content_sampling=True, cache_dir=workdir)
+    content_dm.set_normalization(dm.train_dataset.mean, dm.train_dataset.std)
+    val = dm.get_val_dataset().batch(net_conf.train_batch_size).cache()
+
+    results = {}
+    for name, data in [('uniform', dm), ('content', content_dm)]:
+        np.random.seed(0)
+        tf.random.set_seed(0)
+        model = CryoCARE(net_conf, name, basedir=None)
+        model.prepare_for_training()
+        it = iter(data.get_train_dataset(net_conf.train_batch_size))
+        curve = []
+        for step in range(1, n_steps + 1):
+            model.keras_model.train_on_batch(*next(it))
+            if step % eval_every == 0:
+                curve.append(float(np.atleast_1d(model.keras_model.evaluate(val, verbose=0))[0]))
+        results[name] = {'val_loss': curve[-1], 'curve': curve}
+
+    target = results['uniform']['val_loss']
+    reached = [(i + 1) * eval_every for i, loss in enumerate(results['content']['curve']) if loss <= target]
+    results['steps_to_uniform_loss'] = reached[0] if len(reached) > 0 else None
+    results['speedup'] = n_steps / reached[0] if len(reached) > 0 else None
+    content_dm.close()
+    return results
+
+
+def bench_predict(net_conf, even, odd, mean, std, n_tiles, workdir):
+    from cryocare.internals.CryoCARE import CryoCARE
+    from cryocare.scripts.cryoCARE_predict import denoise
+
+    model = CryoCARE(net_conf, 'bench_model', basedir=workdir)
+    model.keras_model.save_weights(join(workdir, 'bench_model', 'weights_last.h5'))
+    config = {'model_name': 'bench_model', 'path': workdir, 'n_tiles': list(n_tiles)}
+    output = join(workdir, 'denoised.mrc')
+
+    with PeakRSS() as rss:
+        t0 = time.perf_counter()
+        denoise(config, mean, std, even=even, odd=odd, output_file=output)
+        t = time.perf_counter() - t0
+    with mrcfile.mmap(even, mode='r', permissive=True) as mrc:
+        n_voxels = int(np.prod(mrc.data.shape))
+    return {'seconds': t, 'voxels_per_second': n_voxels / t, 'peak_rss_mb': rss.peak_mb}
+
+
+def bench_sweep(net_conf, even, odd, mean, std, workdir):
+    """Compares :func:`predict_sweep` with a separate prediction per model, for models of U-Net depth 2 and 3.
+
+    Their block sizes differ, and the region is chosen so that the tile boundaries of the sweep, which lie on the
+    coarsest grid, differ from the ones of the shallower model when predicted on its own.
+    """
+    from csbdeep.models import Config
+    from cryocare.internals.CryoCARE import CryoCARE, predict_sweep
+
+    models = []
+    for depth in (2, 3):
+        conf = Config(**dict(vars(net_conf), unet_n_depth=depth))
+        model = CryoCARE(conf, f'bench_sweep_{depth}', basedir=workdir)
+        model.keras_model.save_weights(join(workdir, f'bench_sweep_{depth}', 'weights_last.h5'))
+        models.append(CryoCARE(None, f'bench_sweep_{depth}', basedir=workdir))
+
+    with mrcfile.mmap(even, mode='r', permissive=True) as even_mrc, mrcfile.mmap(odd, mode='r', permissive=True) as odd_mrc:
+        # Split into two tiles, the boundary is at the middle on the grid of 4 and 8 voxels from it on the grid of 8
+        region = (slice(None),) + tuple(slice(0, ((n - 8) // 16) * 16 + 8) for n in even_mrc.data.shape[1:])
+        shape = (even_mrc.data.shape[0],) + tuple(r.stop for r in region[1:])
+        n_tiles = [1, 2, 2]
+
+        t0 = time.perf_counter()
+        swept = predict_sweep(models, even_mrc.data, odd_mrc.data, [np.empty(shape, np.float32) for _ in models],
+                              [mean] * len(models), [std] * len(models), n_tiles=n_tiles, region=region)
+        sweep_seconds = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        separate = [model.predict(even_mrc.data, odd_mrc.data, np.empty(shape, np.float32), mean=mean, std=std,
+                                  n_tiles=n_tiles, region=region) for model in models]
+        separate_seconds = time.perf_counter() - t0
+
+    return {'seconds': sweep_seconds, 'separate_seconds': separate_seconds,
+            'max_abs_difference': float(max(np.abs(a - b).max() for a, b in zip(swept, separate))),
+            'max_abs_value': float(max(np.abs(b).max() for b in separate))}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def bench_multiworker(dm, batch_size, workdir, n_workers=2, n_steps=10, timeout=600):
+    """Runs the input of distributed training on ``n_workers`` local processes, see
+    :mod:`cryocare.benchmarks.multiworker`. Reports the samples every worker consumed per step and whether they match
+    the sampling state of a checkpoint."""
+    train_data = join(workdir, 'multiworker_data')
+    os.makedirs(train_data, exist_ok=True)
+    dm.save(train_data)
+    workers = [f'localhost:{free_port()}' for _ in range(n_workers)]
+    outs = [join(workdir, f'multiworker_{i}.json') for i in range(n_workers)]
+    procs = []
+    for i in range(n_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': {'worker': workers},
+                                                     'task': {'type': 'worker', 'index': i}}))
+        procs.append(subprocess.Popen([sys.executable, '-m', 'cryocare.benchmarks.multiworker',
+                                       '--train_data', train_data, '--batch_size', str(batch_size),
+                                       '--n_steps', str(n_steps), '--out', outs[i]],
+                                      env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE))
+    results = {'workers': []}
+    for proc, out in zip(procs, outs):
+        _, stderr = proc.communicate(timeout=timeout)
+        if proc.returncode != 0:
+            raise RuntimeError('Worker failed:\n' + stderr.decode()[-2000:])
+        with open(out) as f:
+            results['workers'].append(json.load(f))
+    results['consistent'] = all(w['samples_per_step'] == [batch_size] and w['consumed_in_stream_order'] and
+                                w['resumes_after_consumed'] for w in results['workers'])
+    return results
+
+
+def bench_startup(commands, repeats=3):
+    """Time to run each command line script in a fresh interpreter, and whether it imported TensorFlow.
+
+    ``commands`` maps a name to the script and its arguments.
+    """
+    scripts = join(os.path.dirname(os.path.dirname(__file__)), 'scripts')
+    results = {}
+    for name, (script, args) in commands.items():
+        cmd = [sys.executable, '-X', 'importtime', join(scripts, script)] + args
+        t, proc = timed(lambda: subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE), repeats)
+        # -X importtime lists every imported module on stderr
+        imported = [line.split('|')[-1].strip() for line in proc.stderr.decode().splitlines() if '|' in line]
+        results[name] = {'seconds': t, 'returncode': proc.returncode,
+                         'imports_tensorflow': 'tensorflow' in imported}
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def startup_commands(dm, even, odd, patch_shape, workdir):
+    """The --help and --check calls of the scripts, with configs for the synthetic data."""
+    train_data = join(workdir, 'train_data')
+    os.makedirs(train_data, exist_ok=True)
+    dm.save(train_data)
+    extract_conf = join(workdir, 'extract.json')
+    with open(extract_conf, 'w') as f:
+        json.dump({'even': [even], 'odd': [odd], 'patch_shape': list(patch_shape), 'num_slices': 100, 'split': 0.9,
+                   'tilt_axis': 'Y', 'n_normalization_samples': 100, 'path': train_data}, f)
+    train_conf = join(workdir, 'train.json')
+    with open(train_conf, 'w') as f:
+        json.dump({'train_data': train_data, 'epochs': 1, 'steps_per_epoch': 1, 'batch_size': 1,
+                   'unet_kern_size': 3, 'unet_n_depth': 2, 'unet_n_first': 8, 'learning_rate': 0.0004,
+                   'model_name': 'bench_model', 'path': workdir}, f)
+    return {
+        'extract_help': ('cryoCARE_extract_train_data.py', ['--help']),
+        'extract_check': ('cryoCARE_extract_train_data.py', ['--conf', extract_conf, '--check']),
+        'train_help': ('cryoCARE_train.py', ['--help']),
+        'train_check': ('cryoCARE_train.py', ['--conf', train_conf, '--check']),
+        'predict_help': ('cryoCARE_predict.py', ['--help'])
+    }
+
+
+def run(shape=(128, 128, 128), patch_shape=(32, 32, 32), n_samples_per_tomo=200, batch_size=4, n_tiles=(1, 2, 2),
+        noise=1.0, vacuum_fraction=0.0, mask=False, stages=None, workdir=None):
+    """Generates a synthetic tomogram pair and times every stage of extraction, training and prediction.
+
+    Returns a dict with one entry per stage and the environment the benchmark ran in.
+    """
+    from csbdeep.models import Config
+    from cryocare.internals.CryoCAREDataModule import CryoCARE_DataModule
+
+    all_stages = ['startup', 'coordinates', 'normalization', 'getitem', 'pipeline', 'train_step', 'convergence',
+                  'multiworker', 'predict', 'sweep']
+    stages = all_stages if stages is None else stages
+
+    tmp = tempfile.TemporaryDirectory() if workdir is None else None
+    workdir = tmp.name if tmp is not None else workdir
+
+    results = {
+        'revision': git_revision(),
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'settings': {'shape': list(shape), 'patch_shape': list(patch_shape),
+                     'n_samples_per_tomo': n_samples_per_tomo, 'batch_size': batch_size, 'n_tiles': list(n_tiles),
+                     'noise': noise, 'vacuum_fraction': vacuum_fraction, 'mask': mask},
+        'stages': {}
+    }
+    try:
+        even, odd, mask_path = make_synthetic_pair(join(workdir, 'data'), shape=shape, noise=noise,
+                                                   vacuum_fraction=vacuum_fraction, mask=mask)
+        dm = CryoCARE_DataModule()
+        t0 = time.perf_counter()
+        dm.setup([odd], [even], mask_paths=None if mask_path is None else [mask_path],
+                 n_samples_per_tomo=n_samples_per_tomo, validation_fraction=0.1, sample_shape=patch_shape,
+                 tilt_axis='Y', n_normalization_samples=min(100, int(n_samples_per_tomo * 0.9)))
+        results['stages']['setup'] = {'seconds': time.perf_counter() - t0}
+
+        net_conf = Config(axes='ZYXC', train_loss='mse', train_batch_size=batch_size, unet_kern_size=3,
+                          unet_n_depth=2, unet_n_first=8, train_tensorboard=False)
+
+        for stage in stages:
+            print(f'Benchmarking {stage}')
+            if stage == 'startup':
+                results['stages'][stage] = bench_startup(startup_commands(dm, even, odd, patch_shape, workdir))
+            elif stage == 'coordinates':
+                results['stages'][stage] = bench_coordinates(dm)
+            elif stage == 'normalization':
+                results['stages'][stage] = bench_normalization(dm)
+            elif stage == 'getitem':
+                results['stages'][stage] = bench_getitem(dm)
+            elif stage == 'pipeline':
+                results['stages'][stage] = bench_pipeline(dm, batch_size=batch_size)
+            elif stage == 'train_step':
+                results['stages'][stage] = bench_train_step(net_conf, dm)
+            elif stage == 'convergence':
+                results['stages'][stage] = bench_convergence(net_conf, dm, even, odd, mask_path, patch_shape,
+                                                             n_samples_per_tomo, workdir)
+            elif stage == 'multiworker':
+                results['stages'][stage] = bench_multiworker(dm, batch_size, workdir)
+            elif stage == 'predict':
+                results['stages'][stage] = bench_predict(net_conf, even, odd, dm.train_dataset.mean,
+                                                         dm.train_dataset.std, n_tiles, workdir)
+            elif stage == 'sweep':
+                results['stages'][stage] = bench_sweep(net_conf, even, odd, dm.train_dataset.mean,
+                                                       dm.train_dataset.std, workdir)
+            else:
+                raise ValueError(f'Unknown stage {stage}, choose from {all_stages}')
+        dm.close()
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    return results
+
+
+def compare(old, new):
+    """Prints the ratio new/old for every timing of two benchmark result files."""
+    with open(old) as f:
+        old = json.load(f)
+    with open(new) as f:
+        new = json.load(f)
+
+    def flatten(metrics):
+        # The startup stage has one entry per command
+        flat = {}
+        for metric, value in metrics.items():
+            if isinstance(value, dict):
+                flat.update({f'{metric}.{k}': v for k, v in value.items()})
+            else:
+                flat[metric] = value
+        return flat
+
+    print(f"{'stage':<16}{'metric':<22}{'old':>12}{'new':>12}{'new/old':>10}")
+    for stage, metrics in new['stages'].items():
+        if stage not in old['stages']:
+            continue
+        old_metrics = flatten(old['stages'][stage])
+        for metric, value in flatten(metrics).items():
+            if metric not in old_metrics or metric.endswith('returncode') or isinstance(value, bool) \
+                    or not isinstance(value, (int, float)):
+                continue
+            old_value = old_metrics[metric]
+            ratio = value / old_value if old_value else float('nan')
+            print(f'{stage:<16}{metric:<22}{old_value:>12.4g}{value:>12.4g}{ratio:>10.2f}')
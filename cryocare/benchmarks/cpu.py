@@ -0,0 +1,115 @@
+"""Sweep of CPU profiles for prediction on a synthetic tomogram, see ``cryoCARE_predict.py --tune-cpu``.
+
+Thread pools and oneDNN can only be configured before TensorFlow starts, so every trial runs in a fresh
+interpreter (``python -m cryocare.benchmarks.cpu``).
+"""
+import argparse
+import datetime
+import json
+import subprocess
+import sys
+import tempfile
+from os.path import join
+
+import mrcfile
+import numpy as np
+
+from cryocare.benchmarks.synthetic import make_synthetic_pair
+from cryocare.internals.CryoCAREDevice import numa_nodes, save_cpu_profile, set_cpu_profile, CPU_PROFILES_PATH
+
+
+def run_trial(model_path, even, odd, profile):
+    """Seconds the prediction of ``even``/``odd`` takes with ``profile``, ``None`` if the trial failed."""
+    cmd = [sys.executable, '-m', 'cryocare.benchmarks.cpu', '--model', model_path, '--even', even, '--odd', odd,
+           '--profile', json.dumps(profile)]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        print(f'Trial {profile} failed:\n{proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else ""}')
+        return None
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    if not result['finite']:
+        print(f'Trial {profile} predicted non-finite values.')
+        return None
+    return result['seconds']
+
+
+def tune_cpu(model_path, n_tiles, shape=(128, 256, 256)):
+    """Finds the fastest CPU profile for predicting with the model archive ``model_path`` and stores it for this host.
+
+    Starts from the TensorFlow defaults and ``n_tiles`` and sweeps one setting at a time, keeping a value if it is
+    faster: the intra-op threads, the inter-op threads, oneDNN, pinning to one NUMA node (on multi-socket hosts)
+    and the number of tiles.
+    """
+    nodes = numa_nodes()
+    n_cpus = sum(len(cpus) for cpus in nodes)
+    print(f'{n_cpus} CPUs on {len(nodes)} NUMA nodes')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        even, odd, _ = make_synthetic_pair(tmpdir, shape=shape)
+
+        best = {'n_tiles': list(n_tiles)}
+        best_seconds = run_trial(model_path, even, odd, best)
+        if best_seconds is None:
+            raise RuntimeError('Prediction with the default settings failed.')
+        print(f'Defaults: {best_seconds:.2f}s')
+
+        def sweep(candidates):
+            nonlocal best, best_seconds
+            for update in candidates:
+                profile = dict(best, **update)
+                if profile == best:
+                    continue
+                seconds = run_trial(model_path, even, odd, profile)
+                if seconds is None:
+                    continue
+                print(f'{update}: {seconds:.2f}s')
+                if seconds < best_seconds:
+                    best, best_seconds = profile, seconds
+
+        sweep([{'intra_op_threads': n} for n in sorted({n_cpus, max(1, n_cpus // 2), len(nodes[0])})])
+        sweep([{'inter_op_threads': n} for n in [1, 2, 4] if n <= n_cpus])
+        sweep([{'onednn': value} for value in [True, False]])
+        if len(nodes) > 1:
+            sweep([{'numa_node': 0, 'intra_op_threads': len(nodes[0])}])
+        sweep([{'n_tiles': t} for t in [[1, 1, 1], [1, 2, 2], [2, 2, 2], [2, 4, 4]]])
+
+    profile = dict(best, seconds=best_seconds, voxels_per_second=float(np.prod(shape)) / best_seconds,
+                   shape=list(shape), tuned=datetime.datetime.now().isoformat(timespec='seconds'))
+    save_cpu_profile(profile)
+    print(f'Fastest profile ({best_seconds:.2f}s): {json.dumps(best)}')
+    print(f'Stored in {CPU_PROFILES_PATH}, use it with "cpu_profile": "auto".')
+    return profile
+
+
+def main():
+    # A single trial, run by tune_cpu
+    parser = argparse.ArgumentParser(description='Time one prediction with a CPU profile.')
+    parser.add_argument('--model')
+    parser.add_argument('--even')
+    parser.add_argument('--odd')
+    parser.add_argument('--profile')
+    args = parser.parse_args()
+
+    profile = json.loads(args.profile)
+    set_cpu_profile(profile)
+
+    from cryocare.internals.CryoCAREModelArchive import extract_model_archive
+    from cryocare.internals.CryoCAREProfiler import Profiler
+    from cryocare.scripts.cryoCARE_predict import denoise
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        model_name, norm = extract_model_archive(args.model, tmpdir)
+        config = {'model_name': model_name, 'path': tmpdir, 'n_tiles': profile['n_tiles']}
+        output = join(tmpdir, 'denoised.mrc')
+        # The first prediction includes building the graph, time the second one
+        denoise(config, norm['mean'], norm['std'], even=args.even, odd=args.odd, output_file=output)
+        profiler = Profiler()
+        denoise(config, norm['mean'], norm['std'], even=args.even, odd=args.odd, output_file=output,
+                profiler=profiler)
+        with mrcfile.mmap(output, mode='r', permissive=True) as mrc:
+            finite = bool(np.isfinite(mrc.data).all())
+    print(json.dumps({'seconds': profiler.totals()['predict']['seconds'], 'finite': finite}))
+
+
+if __name__ == "__main__":
+    main()
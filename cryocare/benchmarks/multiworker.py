@@ -0,0 +1,72 @@
+"""One worker of the ``multiworker`` benchmark stage, started with ``TF_CONFIG`` as in distributed training.
+
+Checks that the distributed training input matches the sampling state ``AsyncCheckpoint`` stores: as in
+``cryoCARE_train.py``, the dataset of every worker yields batches of the global batch size, which
+``MultiWorkerMirroredStrategy`` splits into per-worker batches. Every worker has to consume ``batch_size`` samples of
+its own shard per step, in the order of its stream, so that a run resumed after ``n`` steps continues with sample
+``n * batch_size``.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def run_worker(train_data, batch_size, n_steps):
+    from cryocare.internals.CryoCAREDataModule import CryoCARE_DataModule
+    from cryocare.scripts.cryoCARE_train import get_distribution_strategy
+
+    strategy, num_workers, worker_index = get_distribution_strategy({'distributed': True})
+
+    def load(n_samples):
+        dm = CryoCARE_DataModule()
+        dm.load(train_data)
+        dm.shard(num_workers, worker_index)
+        # Same seed for all data modules of this worker, so that their streams can be compared
+        dm.set_state({'train': {'seed': 0, 'n_samples': n_samples}})
+        return dm
+
+    t0 = time.perf_counter()
+    it = iter(strategy.experimental_distribute_dataset(load(0).get_train_dataset(batch_size * num_workers)))
+    batches = []
+    for _ in range(n_steps + 1):
+        x, _ = next(it)
+        batches.append(np.concatenate([v.numpy() for v in strategy.experimental_local_results(x)]))
+    seconds = time.perf_counter() - t0
+
+    stream = [x.numpy() for x, _ in load(0).get_train_dataset().take((n_steps + 1) * batch_size)]
+    # The state of a checkpoint after n_steps and the samples a run resumed from it starts with
+    state = load(0).get_state(n_steps * batch_size)
+    resumed_dm = CryoCARE_DataModule()
+    resumed_dm.load(train_data)
+    resumed_dm.shard(num_workers, worker_index)
+    resumed_dm.set_state(state)
+    resumed = [x.numpy() for x, _ in resumed_dm.get_train_dataset().take(batch_size)]
+
+    return {
+        'worker': worker_index,
+        'num_workers': num_workers,
+        'seconds': seconds,
+        'samples_per_step': sorted(set(len(b) for b in batches)),
+        'consumed_in_stream_order': all(np.allclose(b, np.stack(stream[i * batch_size:(i + 1) * batch_size]))
+                                        for i, b in enumerate(batches)),
+        'resumes_after_consumed': bool(np.allclose(batches[-1], np.stack(resumed)))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker of the multiworker benchmark stage.')
+    parser.add_argument('--train_data', required=True)
+    parser.add_argument('--batch_size', type=int, required=True, help='Samples per step and worker.')
+    parser.add_argument('--n_steps', type=int, default=10)
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args()
+
+    result = run_worker(args.train_data, args.batch_size, args.n_steps)
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
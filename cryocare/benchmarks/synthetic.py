@@ -0,0 +1,58 @@
+import os
+from os.path import join
+
+import mrcfile
+import numpy as np
+
+
+def make_phantom(shape, n_particles=200, radius_range=(2, 8), vacuum_fraction=0.0, seed=0):
+    """Noise-free phantom of random spheres of varying density.
+
+    With ``vacuum_fraction`` > 0, a slab of that fraction of the Z extent (split between top and bottom) contains
+    no particles, like the vacuum above and below a lamella.
+    """
+    rng = np.random.default_rng(seed)
+    phantom = np.zeros(shape, dtype=np.float32)
+    z_margin = int(shape[0] * vacuum_fraction / 2)
+    for _ in range(n_particles):
+        r = rng.integers(radius_range[0], radius_range[1] + 1)
+        center = [rng.integers(z_margin + r, shape[0] - z_margin - r)] + \
+                 [rng.integers(r, s - r) for s in shape[1:]]
+        box = tuple(slice(c - r, c + r + 1) for c in center)
+        zz, yy, xx = np.ogrid[-r:r + 1, -r:r + 1, -r:r + 1]
+        sphere = (zz ** 2 + yy ** 2 + xx ** 2) <= r ** 2
+        phantom[box][sphere] += rng.uniform(0.5, 2.0)
+    return phantom
+
+
+def make_synthetic_pair(path, shape=(128, 128, 128), noise=1.0, n_particles=200, vacuum_fraction=0.0, mask=False,
+                        voxel_size=10.0, seed=0):
+    """Writes an even/odd pair of noisy tomograms of the same phantom to ``path``.
+
+    Returns the paths of the even, odd and (if ``mask`` is set) mask tomogram. The mask excludes the vacuum slab
+    and a border of 10% of every axis.
+    """
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed + 1)
+    phantom = make_phantom(shape, n_particles=n_particles, vacuum_fraction=vacuum_fraction, seed=seed)
+
+    paths = []
+    for name in ['even', 'odd']:
+        p = join(path, f'{name}.mrc')
+        with mrcfile.new(p, overwrite=True) as mrc:
+            mrc.set_data(phantom + rng.normal(scale=noise, size=shape).astype(np.float32))
+            mrc.voxel_size = voxel_size
+        paths.append(p)
+
+    if mask:
+        m = np.zeros(shape, dtype=np.int8)
+        z_margin = max(int(shape[0] * vacuum_fraction / 2), shape[0] // 10)
+        m[z_margin:shape[0] - z_margin, shape[1] // 10:-(shape[1] // 10), shape[2] // 10:-(shape[2] // 10)] = 1
+        p = join(path, 'mask.mrc')
+        with mrcfile.new(p, overwrite=True) as mrc:
+            mrc.set_data(m)
+        paths.append(p)
+    else:
+        paths.append(None)
+
+    return tuple(paths)
@@ -1,29 +1,35 @@
-from csbdeep.data import PadAndCropResizer, PercentileNormalizer, NoResizer
-from csbdeep.internals.predict import Progress, total_n_tiles, tile_iterator_1d, to_tensor, from_tensor
+from csbdeep.internals.predict import Progress
 from csbdeep.models import CARE
 from csbdeep.utils import _raise, axes_check_and_normalize, axes_dict
-import warnings
+import itertools
 import logging
 import numpy as np
 import tensorflow as tf
 
+from cryocare.internals.CryoCAREProfiler import NO_PROFILER
+
 
 class CryoCARE(CARE):
 
-    def train(self, train_dataset, val_dataset, epochs=None, steps_per_epoch=None):
+    def train(self, train_dataset, val_dataset, epochs=None, steps_per_epoch=None, validation_freq=1, callbacks=None,
+              initial_epoch=0):
         """Train the neural network with the given data.
         Parameters
         ----------
-        X : :class:`numpy.ndarray`
-            Array of source images.
-        Y : :class:`numpy.ndarray`
-            Array of target images.
-        validation_data : tuple(:class:`numpy.ndarray`, :class:`numpy.ndarray`)
-            Tuple of arrays for source and target validation images.
+        train_dataset : :class:`tf.data.Dataset`
+            Pairs of source and target patches, either single patches or batches.
+        val_dataset : :class:`tf.data.Dataset`
+            Pairs of source and target validation patches, either single patches or batches.
         epochs : int
             Optional argument to use instead of the value from ``config``.
         steps_per_epoch : int
             Optional argument to use instead of the value from ``config``.
+        validation_freq : int
+            Run validation only every ``validation_freq`` epochs.
+        callbacks : list
+            Optional callbacks which are run after the ones from ``config``.
+        initial_epoch : int
+            Epoch at which to start training, e.g. to resume an interrupted run.
         Returns
         -------
         ``History`` object
@@ -31,10 +37,13 @@ class CryoCARE(CARE):
         """
         logging.getLogger("tensorflow").setLevel(logging.ERROR)
 
-        axes = axes_check_and_normalize('S' + self.config.axes, len(train_dataset.element_spec[0].shape) + 1)
+        # Datasets of single patches are batched here, already batched ones are used as they are
+        batched = len(train_dataset.element_spec[0].shape) == len(self.config.axes) + 1
+        sample_shape = train_dataset.element_spec[0].shape[1:] if batched else train_dataset.element_spec[0].shape
+        axes = axes_check_and_normalize('S' + self.config.axes, len(sample_shape) + 1)
         ax = axes_dict(axes)
 
-        train_shape = (1,) + train_dataset.element_spec[0].shape
+        train_shape = (1,) + tuple(sample_shape)
         for a, div_by in zip(axes, self._axes_div_by(axes)):
             n = train_shape[ax[a]]
             print(ax[a], n)
@@ -52,10 +61,15 @@ class CryoCARE(CARE):
         if not self._model_prepared:
             self.prepare_for_training()
 
-        history = self.keras_model.fit(train_dataset.batch(self.config.train_batch_size),
-                                       validation_data=val_dataset.batch(self.config.train_batch_size),
+        if not batched:
+            train_dataset = train_dataset.batch(self.config.train_batch_size)
+        if len(val_dataset.element_spec[0].shape) == len(sample_shape):
+            val_dataset = val_dataset.batch(self.config.train_batch_size)
+
+        history = self.keras_model.fit(train_dataset, validation_data=val_dataset,
                                        epochs=epochs, steps_per_epoch=steps_per_epoch,
-                                       callbacks=self.callbacks, verbose=1)
+                                       validation_freq=validation_freq, initial_epoch=initial_epoch,
+                                       callbacks=self.callbacks + (callbacks or []), verbose=1)
 
         if self.basedir is not None:
             self.keras_model.save_weights(str(self.logdir / 'weights_last.h5'))
@@ -71,21 +85,21 @@ class CryoCARE(CARE):
 
         return history
 
-    def predict(self, even, odd, output, axes, normalizer=PercentileNormalizer(), resizer=PadAndCropResizer(), mean=0,
-                std=1, n_tiles=None):
-        """Apply neural network to raw image to predict restored image.
+    def predict(self, even, odd, output, axes='ZYX', mean=0, std=1, n_tiles=None, region=None,
+                profiler=NO_PROFILER):
+        """Denoise a tomogram from its even and odd halves.
 
                 Parameters
                 ----------
-                img : :class:`numpy.ndarray`
-                    Raw input image
+                even, odd : array_like
+                    Even and odd tomogram, e.g. the ``data`` of an ``mrcfile.mmap``. They are read tile by tile and
+                    can have any shape.
+                output : array_like
+                    The average of the denoised halves is written into it tile by tile. Has the shape of ``region``.
                 axes : str
-                    Axes of the input ``img``.
-                normalizer : :class:`csbdeep.data.Normalizer` or None
-                    Normalization of input image before prediction and (potentially) transformation back after prediction.
-                resizer : :class:`csbdeep.data.Resizer` or None
-                    If necessary, input image is resized to enable neural network prediction and result is (possibly)
-                    resized to yield original image size.
+                    Axes of the tomograms, only ``'ZYX'`` is supported.
+                mean, std : float
+                    Normalization of the training data. Tiles extending beyond the tomogram are padded with ``mean``.
                 n_tiles : iterable or None
                     Out of memory (OOM) errors can occur if the input image is too large.
                     To avoid this problem, the input image is broken up into (overlapping) tiles
@@ -94,243 +108,273 @@ class CryoCARE(CARE):
                     Note that if the number of tiles is too low, it is adaptively increased until
                     OOM errors are avoided, albeit at the expense of runtime.
                     A value of ``None`` denotes that no tiling should initially be used.
+                region : tuple(slice) or None
+                    Only denoise this part of the tomogram. The voxels around it are used as context.
+                profiler : :class:`cryocare.internals.CryoCAREProfiler.Profiler`
+                    Records the time spent in normalization, prediction and reassembly of every tile.
 
                 Returns
                 -------
-                :class:`numpy.ndarray`
-                    Returns the restored image. If the model is probabilistic, this denotes the `mean` parameter of
-                    the predicted per-pixel Laplace distributions (i.e., the expected restored image).
-                    Axes semantics are the same as in the input image. Only if the output is multi-channel and
-                    the input image didn't have a channel axis, then output channels are appended at the end.
-
+                array_like
+                    ``output``
                 """
-        self._predict_mean_and_scale(self._crop(even), self._crop(odd), self._crop(output), axes, normalizer, resizer=NoResizer(), mean=mean, std=std,
-                                     n_tiles=n_tiles)
-
-    def _crop(self, data):
-        div_by = self._axes_div_by('XYZ')
-        data_shape = data.shape
-        slices = ()
-        for i in range(3):
-            if data_shape[i] % div_by[i] == 0:
-                slices += (slice(None),)
-            else:
-                slices += (slice(0, -(data_shape[i]%div_by[i])),)
-        return data[slices]
-
-    def _predict_mean_and_scale(self, even, odd, output, axes, normalizer, resizer, mean, std, n_tiles=None):
-        """Apply neural network to raw image to predict restored image.
-
-        See :func:`predict` for parameter explanations.
+        axes_check_and_normalize(axes, 3) == 'ZYX' or _raise(ValueError("only ZYX tomograms are supported"))
+        even.shape == odd.shape or _raise(ValueError("even and odd tomogram must have the same shape"))
+        if region is None:
+            region = (slice(None),) * 3
+        region = tuple(slice(*r.indices(n)[:2]) for r, n in zip(region, even.shape))
+        output.shape == tuple(r.stop - r.start for r in region) or _raise(ValueError("output must have the shape of region"))
+
+        n_tiles = [1, 1, 1] if n_tiles is None else list(n_tiles)
+        (len(n_tiles) == 3 and all(np.isscalar(t) and 1 <= t and int(t) == t for t in n_tiles)) or _raise(
+            ValueError("n_tiles must be three integer values >= 1"))
+        n_tiles = [int(t) for t in n_tiles]
+        block_sizes = self._axes_div_by('ZYX')
+        tile_overlaps = self._axes_tile_overlap('ZYX')
 
-        Returns
-        -------
-        tuple(:class:`numpy.ndarray`, :class:`numpy.ndarray` or None)
-            If model is probabilistic, returns a tuple `(mean, scale)` that defines the parameters
-            of per-pixel Laplace distributions. Otherwise, returns the restored image via a tuple `(restored,None)`
-
-        """
-        print(even.shape)
-        normalizer, resizer = self._check_normalizer_resizer(normalizer, resizer)
-        # axes = axes_check_and_normalize(axes,img.ndim)
-
-        # different kinds of axes
-        # -> typical case: net_axes_in = net_axes_out, img_axes_in = img_axes_out
-        img_axes_in = axes_check_and_normalize(axes, even.ndim)
-        net_axes_in = self.config.axes
-        net_axes_out = axes_check_and_normalize(self._axes_out)
-        set(net_axes_out).issubset(set(net_axes_in)) or _raise(ValueError("different kinds of output than input axes"))
-        net_axes_lost = set(net_axes_in).difference(set(net_axes_out))
-        img_axes_out = ''.join(a for a in img_axes_in if a not in net_axes_lost)
-        # print(' -> '.join((img_axes_in, net_axes_in, net_axes_out, img_axes_out)))
-        tiling_axes = net_axes_out.replace('C', '')  # axes eligible for tiling
-
-        _permute_axes = self._make_permute_axes(img_axes_in, net_axes_in, net_axes_out, img_axes_out)
-        # _permute_axes: (img_axes_in -> net_axes_in), undo: (net_axes_out -> img_axes_out)
-        even = _permute_axes(even)
-        odd = _permute_axes(odd)
-        # x has net_axes_in semantics
-        x_tiling_axis = tuple(axes_dict(net_axes_in)[a] for a in tiling_axes)  # numerical axis ids for x
-
-        channel_in = axes_dict(net_axes_in)['C']
-        channel_out = axes_dict(net_axes_out)['C']
-        net_axes_in_div_by = self._axes_div_by(net_axes_in)
-        net_axes_in_overlaps = self._axes_tile_overlap(net_axes_in)
-        self.config.n_channel_in == even.shape[channel_in] or _raise(ValueError())
-
-        # TODO: refactor tiling stuff to make code more readable
-
-        def _total_n_tiles(n_tiles):
-            n_block_overlaps = [int(np.ceil(1. * tile_overlap / block_size)) for tile_overlap, block_size in
-                                zip(net_axes_in_overlaps, net_axes_in_div_by)]
-            return total_n_tiles(even, n_tiles=n_tiles, block_sizes=net_axes_in_div_by,
-                                 n_block_overlaps=n_block_overlaps, guarantee='size')
-
-        _permute_axes_n_tiles = self._make_permute_axes(img_axes_in, net_axes_in)
-
-        # _permute_axes_n_tiles: (img_axes_in <-> net_axes_in) to convert n_tiles between img and net axes
-        def _permute_n_tiles(n, undo=False):
-            # hack: move tiling axis around in the same way as the image was permuted by creating an array
-            return _permute_axes_n_tiles(np.empty(n, np.bool_), undo=undo).shape
-
-        # to support old api: set scalar n_tiles value for the largest tiling axis
-        if np.isscalar(n_tiles) and int(n_tiles) == n_tiles and 1 <= n_tiles:
-            largest_tiling_axis = [i for i in np.argsort(even.shape) if i in x_tiling_axis][-1]
-            _n_tiles = [n_tiles if i == largest_tiling_axis else 1 for i in range(x.ndim)]
-            n_tiles = _permute_n_tiles(_n_tiles, undo=True)
-            warnings.warn("n_tiles should be a tuple with an entry for each image axis")
-            print("Changing n_tiles to %s" % str(n_tiles))
-
-        if n_tiles is None:
-            n_tiles = [1] * even.ndim
-        try:
-            n_tiles = tuple(n_tiles)
-            even.ndim == len(n_tiles) or _raise(TypeError())
-        except TypeError:
-            raise ValueError("n_tiles must be an iterable of length %d" % even.ndim)
-
-        all(np.isscalar(t) and 1 <= t and int(t) == t for t in n_tiles) or _raise(
-            ValueError("all values of n_tiles must be integer values >= 1"))
-        n_tiles = tuple(map(int, n_tiles))
-        n_tiles = _permute_n_tiles(n_tiles)
-        (all(n_tiles[i] == 1 for i in range(even.ndim) if i not in x_tiling_axis) or
-         _raise(ValueError("entry of n_tiles > 1 only allowed for axes '%s'" % tiling_axes)))
-        # n_tiles_limited = self._limit_tiling(x.shape,n_tiles,net_axes_in_div_by)
-        # if any(np.array(n_tiles) != np.array(n_tiles_limited)):
-        #     print("Limiting n_tiles to %s" % str(_permute_n_tiles(n_tiles_limited,undo=True)))
-        # n_tiles = n_tiles_limited
-        n_tiles = list(n_tiles)
-
-        # normalize & resize
-        even = resizer.before(even, net_axes_in, net_axes_in_div_by)
-        odd = resizer.before(odd, net_axes_in, net_axes_in_div_by)
-
-        done = False
-        progress = Progress(_total_n_tiles(n_tiles), 1)
         c = 0
-        while not done:
+        while True:
+            progress = Progress(len(tile_layout(even.shape, region, n_tiles, block_sizes, tile_overlaps)), 1)
             try:
-                # raise tf.errors.ResourceExhaustedError(None,None,None) # tmp
-                pred = predict_tiled(self.keras_model, even, odd, output, [4 * (slice(None),)], 4 * (slice(None),),
-                                     mean=mean, std=std,
-                                     axes_in=net_axes_in, axes_out=net_axes_out,
-                                     n_tiles=n_tiles, block_sizes=net_axes_in_div_by,
-                                     tile_overlaps=net_axes_in_overlaps, pbar=progress)
-                output = pred
-                # x has net_axes_out semantics
-                done = True
+                predict_tiled(self.keras_model, even, odd, output, mean=mean, std=std, n_tiles=n_tiles,
+                              block_sizes=block_sizes, tile_overlaps=tile_overlaps, region=region, pbar=progress,
+                              profiler=profiler)
                 progress.close()
+                return output
             except tf.errors.ResourceExhaustedError:
-                # TODO: how to test this code?
-                # n_tiles_prev = list(n_tiles) # make a copy
-                tile_sizes_approx = np.array(even.shape) / np.array(n_tiles)
-                t = [i for i in np.argsort(tile_sizes_approx) if i in x_tiling_axis][-1]
-                n_tiles[t] *= 2
-                # n_tiles = self._limit_tiling(x.shape,n_tiles,net_axes_in_div_by)
-                # if all(np.array(n_tiles) == np.array(n_tiles_prev)):
-                # raise MemoryError("Tile limit exceeded. Memory occupied by another process (notebook)?")
+                progress.close()
+                # Split the axis with the largest tiles
+                tile_sizes_approx = np.array([r.stop - r.start for r in region]) / np.array(n_tiles)
+                n_tiles[int(np.argmax(tile_sizes_approx))] *= 2
                 if c >= 16:
                     raise MemoryError(
                         "Giving up increasing number of tiles. Memory occupied by another process (notebook)?")
-                print('Out of memory, retrying with n_tiles = %s' % str(_permute_n_tiles(n_tiles, undo=True)))
-                progress.total = _total_n_tiles(n_tiles)
+                print('Out of memory, retrying with n_tiles = %s' % str(n_tiles))
                 c += 1
 
-        n_channel_predicted = self.config.n_channel_out * (2 if self.config.probabilistic else 1)
-
-        output.data.shape[channel_out] == n_channel_predicted or _raise(ValueError())
-
-        resizer.after(output, net_axes_out)
+    def predict_regions(self, even, odd, regions, mean=0, std=1, batch_size=8, profiler=NO_PROFILER):
+        """Denoise small regions of a tomogram, each in a single tile.
 
+        Regions whose input windows have the same shape are predicted together in batches of up to ``batch_size``
+        regions. The batch size is halved on out of memory errors.
 
-def predict_tiled(keras_model, even, odd, output, s_src_out, s_dst_out, mean, std, n_tiles, block_sizes, tile_overlaps,
-                  axes_in,
-                  axes_out=None, pbar=None, **kwargs):
-    """TODO."""
-    if all(t == 1 for t in n_tiles):
-        even_pred = predict_direct(keras_model, even, mean, std, axes_in, axes_out, **kwargs)
-        odd_pred = predict_direct(keras_model, odd, mean, std, axes_in, axes_out, **kwargs)
-        pred = (even_pred + odd_pred) / 2.
-        for src in s_src_out:
-            pred = pred[src]
+        Parameters
+        ----------
+        even, odd : array_like
+            Even and odd tomogram, only the windows around the regions are read.
+        regions : list of tuple(slice)
+            The regions to denoise, each needs to fit into one tile.
+
+        Yields
+        ------
+        tuple(slice), :class:`numpy.ndarray`
+            Every region with the average of its denoised halves.
+        """
+        block_sizes = self._axes_div_by('ZYX')
+        tile_overlaps = self._axes_tile_overlap('ZYX')
+        groups = {}
+        for region in regions:
+            (window, _), = tile_layout(even.shape, region, [1, 1, 1], block_sizes, tile_overlaps)
+            groups.setdefault(tuple(w1 - w0 for w0, w1 in window), []).append((region, window))
+
+        for shape, items in groups.items():
+            i = 0
+            while i < len(items):
+                batch = items[i:i + batch_size]
+                try:
+                    with profiler.stage('normalize'):
+                        x = np.stack([read_tile(half, window, mean, std) for half in (even, odd)
+                                      for _, window in batch])
+                    with profiler.stage('keras_predict', shape=list(shape), batch_size=len(batch)):
+                        pred = np.asarray(self.keras_model.predict_on_batch(x[..., np.newaxis]))[..., 0]
+                except tf.errors.ResourceExhaustedError:
+                    if batch_size == 1:
+                        raise
+                    batch_size //= 2
+                    print('Out of memory, retrying with batch size %d' % batch_size)
+                    continue
+                with profiler.stage('denormalize'):
+                    denoised = []
+                    for j, (region, window) in enumerate(batch):
+                        crop = tuple(slice(r.start - w0, r.stop - w0) for r, (w0, _) in zip(region, window))
+                        denoised.append((region, (pred[j][crop] + pred[len(batch) + j][crop]) * (std / 2.) + mean))
+                yield from denoised
+                i += len(batch)
+
+
+def _tile_bounds(start, stop, n_tiles, block_size):
+    # The inner boundaries lie on the block grid of the volume, so all tiles see the same pooling grid
+    bounds = [int(round((start + (stop - start) * i / n_tiles) / block_size)) * block_size for i in range(1, n_tiles)]
+    bounds = sorted(set([start, stop] + [b for b in bounds if start < b < stop]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def slab_region(shape, index, n_slabs, block_size):
+    """Region of slab ``index`` when a volume of ``shape`` is split into ``n_slabs`` slabs along Z.
+
+    Like the tiles, the slabs are aligned to the block grid, so that denoising in slabs gives the same result as
+    denoising the whole volume. Returns ``None`` for slabs beyond the last one if the volume is too thin for
+    ``n_slabs`` slabs.
+    """
+    bounds = _tile_bounds(0, shape[0], n_slabs, block_size)
+    if index >= len(bounds):
+        return None
+    return (slice(*bounds[index]), slice(0, shape[1]), slice(0, shape[2]))
+
+
+def tile_layout(shape, region, n_tiles, block_sizes, tile_overlaps):
+    """The tiles of ``region`` of a volume of ``shape``, as pairs of the window read as input and the core written.
+
+    The window extends the core by ``tile_overlaps`` on both sides, starts on the block grid and has a size
+    divisible by ``block_sizes``. Both are tuples of ``(start, stop)`` in volume coordinates per axis. If the
+    volume size is not divisible, the windows at its end extend beyond it and are padded when the tile is read.
+    """
+    per_axis = []
+    for n, r, t, b, o in zip(shape, region, n_tiles, block_sizes, tile_overlaps):
+        start, stop, _ = r.indices(n)
+        per_axis.append([(_tile_window(n, c0, c1, b, o), (c0, c1)) for c0, c1 in _tile_bounds(start, stop, t, b)])
+    return [(tuple(w for w, _ in tile), tuple(c for _, c in tile)) for tile in itertools.product(*per_axis)]
+
+
+def _tile_window(n, c0, c1, block_size, overlap):
+    # Like the network's own padding at the borders, the window does not extend beyond the volume, except to make
+    # its size divisible
+    w0 = max(((c0 - overlap) // block_size) * block_size, 0)
+    w1 = min(w0 + -(-(c1 + overlap - w0) // block_size) * block_size, -(-n // block_size) * block_size)
+    return w0, w1
+
+
+def read_tile(volume, window, mean, std):
+    """Reads and normalizes ``window`` of ``volume`` into a new buffer.
+
+    Voxels outside of the volume are set to ``mean``, i.e. to zero after normalization.
+    """
+    tile = np.zeros(tuple(w1 - w0 for w0, w1 in window), dtype=np.float32)
+    src = tuple(slice(max(w0, 0), min(w1, n)) for (w0, w1), n in zip(window, volume.shape))
+    dst = tuple(slice(s.start - w0, s.stop - w0) for s, (w0, _) in zip(src, window))
+    tile[dst] = volume[src]
+    tile[dst] -= mean
+    tile[dst] /= std
+    return tile
+
+
+def predict_tiled(keras_model, even, odd, output, mean, std, n_tiles, block_sizes, tile_overlaps, region,
+                  pbar=None, profiler=NO_PROFILER):
+    """Denoises ``region`` of ``even`` and ``odd`` tile by tile and writes the average of both into ``output``.
+
+    Only one tile of each half is in memory at a time, padded in its own small buffer where it extends beyond
+    the volume. Neither the inputs nor the output are ever copied as a whole.
+    """
+    offset = tuple(r.start for r in region)
+    for window, core in tile_layout(even.shape, region, n_tiles, block_sizes, tile_overlaps):
+        with profiler.stage('tile', shape=[w1 - w0 for w0, w1 in window]):
+            pred = None
+            for half in (even, odd):
+                with profiler.stage('normalize'):
+                    tile = read_tile(half, window, mean, std)
+                with profiler.stage('keras_predict'):
+                    tile_pred = np.asarray(keras_model.predict_on_batch(tile[np.newaxis, ..., np.newaxis]))[0, ..., 0]
+                pred = tile_pred if pred is None else pred + tile_pred
+            with profiler.stage('denormalize'):
+                crop = tuple(slice(c0 - w0, c1 - w0) for (c0, c1), (w0, _) in zip(core, window))
+                pred = pred[crop] * (std / 2.) + mean
+        with profiler.stage('reassemble'):
+            output[tuple(slice(c0 - o, c1 - o) for (c0, c1), o in zip(core, offset))] = pred
         if pbar is not None:
             pbar.update()
-
-        if output.shape == pred.shape:
-            output[:] = pred[:]
-
-        return pred
-
-    ###
-
-    if axes_out is None:
-        axes_out = axes_in
-    axes_in, axes_out = axes_check_and_normalize(axes_in, even.ndim), axes_check_and_normalize(axes_out)
-    assert 'S' not in axes_in
-    assert 'C' in axes_in and 'C' in axes_out
-    ax_in, ax_out = axes_dict(axes_in), axes_dict(axes_out)
-    channel_in, channel_out = ax_in['C'], ax_out['C']
-
-    assert set(axes_out).issubset(set(axes_in))
-    axes_lost = set(axes_in).difference(set(axes_out))
-
-    def _to_axes_out(seq, elem):
-        # assumption: prediction size is same as input size along all axes, except for channel (and lost axes)
-        assert len(seq) == len(axes_in)
-        # 1. re-order 'seq' from axes_in to axes_out semantics
-        seq = [seq[ax_in[a]] for a in axes_out]
-        # 2. replace value at channel position with 'elem'
-        seq[ax_out['C']] = elem
-        return tuple(seq)
-
-    ###
-
-    assert even.ndim == len(n_tiles) == len(block_sizes)
-    assert odd.ndim == len(n_tiles) == len(block_sizes)
-    assert n_tiles[channel_in] == 1
-    assert all(n_tiles[ax_in[a]] == 1 for a in axes_lost)
-    assert all(np.isscalar(t) and 1 <= t and int(t) == t for t in n_tiles)
-
-    # first axis > 1
-    axis = next(i for i, t in enumerate(n_tiles) if t > 1)
-
-    block_size = block_sizes[axis]
-    tile_overlap = tile_overlaps[axis]
-    n_block_overlap = int(np.ceil(1. * tile_overlap / block_size))
-
-    # print(f"axis={axis},n_tiles={n_tiles[axis]},block_size={block_size},tile_overlap={tile_overlap},n_block_overlap={n_block_overlap}")
-
-    n_tiles_remaining = list(n_tiles)
-    n_tiles_remaining[axis] = 1
-
-    for ((even_tile, s_src, s_dst), (odd_tile, _, _), (output_tile, _, _)) in zip(
-            tile_iterator_1d(even, axis=axis, n_tiles=n_tiles[axis], block_size=block_size,
-                             n_block_overlap=n_block_overlap),
-            tile_iterator_1d(odd, axis=axis, n_tiles=n_tiles[axis], block_size=block_size,
-                             n_block_overlap=n_block_overlap),
-            tile_iterator_1d(output, axis=axis, n_tiles=n_tiles[axis], block_size=block_size,
-                             n_block_overlap=n_block_overlap)):
-        pred = predict_tiled(keras_model, even_tile, odd_tile, output_tile[s_src_out[-1]], s_src_out + [s_src], s_dst,
-                             mean, std, n_tiles_remaining, block_sizes, tile_overlaps, axes_in, axes_out, pbar=pbar,
-                             **kwargs)
-
-        s_dst = _to_axes_out(s_dst, slice(None))
-        output[s_dst][s_src_out[-1]] = pred
-
-    return output[s_src_out[-1]]
-
-
-def predict_direct(keras_model, x, mean, std, axes_in, axes_out=None, **kwargs):
-    """TODO."""
-    if axes_out is None:
-        axes_out = axes_in
-    ax_in, ax_out = axes_dict(axes_in), axes_dict(axes_out)
-    channel_in, channel_out = ax_in['C'], ax_out['C']
-    single_sample = ax_in['S'] is None
-    len(axes_in) == x.ndim or _raise(ValueError())
-    x = (x - mean) / std
-    x = to_tensor(x, channel=channel_in, single_sample=single_sample)
-    pred = from_tensor(keras_model.predict(x, **kwargs), channel=channel_out, single_sample=single_sample)
-    len(axes_out) == pred.ndim or _raise(ValueError())
-    pred = (pred * std) + mean
-    return pred
+    return output
+
+
+def predict_sweep(models, even, odd, outputs, means, stds, n_tiles=None, region=None, profiler=NO_PROFILER):
+    """Denoises a tomogram with several models, reading every tile of the inputs only once.
+
+    Every tile is read with the context all models need and normalized with the ``means`` and ``stds`` of the
+    models. Models with the same block size and tile overlap are run together in one call. Each model writes the
+    average of its denoised halves into its entry of ``outputs``. The tile boundaries lie on the grid of the largest
+    block size, so with several tiles, a model with a smaller block size can be tiled differently than by
+    :meth:`CryoCARE.predict`. Every tile is still read with the full overlap of the model, so the results only
+    differ by the floating point effects of the other tile sizes, which the ``sweep`` benchmark stage measures.
+    Like there, ``n_tiles`` is increased on out of memory errors.
+    """
+    even.shape == odd.shape or _raise(ValueError("even and odd tomogram must have the same shape"))
+    if region is None:
+        region = (slice(None),) * 3
+    region = tuple(slice(*r.indices(n)[:2]) for r, n in zip(region, even.shape))
+    n_tiles = [1, 1, 1] if n_tiles is None else [int(t) for t in n_tiles]
+
+    groups = {}
+    for i, model in enumerate(models):
+        key = (tuple(model._axes_div_by('ZYX')), tuple(model._axes_tile_overlap('ZYX')))
+        groups.setdefault(key, []).append(i)
+    runners = {key: _batch_runner([models[i].keras_model for i in idx]) for key, idx in groups.items()}
+    # Block sizes are powers of two, tile boundaries on the coarsest grid lie on the grid of every model
+    block_sizes = [int(b) for b in np.max([key[0] for key in groups], axis=0)]
+
+    c = 0
+    while True:
+        progress = Progress(len(tile_layout(even.shape, region, n_tiles, block_sizes, [0, 0, 0])), 1)
+        try:
+            sweep_tiled(runners, groups, even, odd, outputs, means, stds, n_tiles, block_sizes, region,
+                        pbar=progress, profiler=profiler)
+            progress.close()
+            return outputs
+        except tf.errors.ResourceExhaustedError:
+            progress.close()
+            tile_sizes_approx = np.array([r.stop - r.start for r in region]) / np.array(n_tiles)
+            n_tiles[int(np.argmax(tile_sizes_approx))] *= 2
+            if c >= 16:
+                raise MemoryError(
+                    "Giving up increasing number of tiles. Memory occupied by another process (notebook)?")
+            print('Out of memory, retrying with n_tiles = %s' % str(n_tiles))
+            c += 1
+
+
+def _batch_runner(keras_models):
+    # One traced function for all tile shapes that predicts a batch with every model
+    spec = tf.TensorSpec([None, None, None, None, 1], tf.float32)
+
+    @tf.function(input_signature=[spec] * len(keras_models))
+    def run(*batches):
+        return [model(x, training=False) for model, x in zip(keras_models, batches)]
+    return run
+
+
+def _normalize_window(raw, union, window, shape, mean, std):
+    # Like read_tile, for a window of the already read ``union`` of windows
+    tile = np.zeros(tuple(w1 - w0 for w0, w1 in window), dtype=np.float32)
+    dst = tuple(slice(0, min(w1, n) - w0) for (w0, w1), n in zip(window, shape))
+    src = tuple(slice(w0 - u0, min(w1, n) - u0) for (w0, w1), (u0, _), n in zip(window, union, shape))
+    tile[dst] = raw[src]
+    tile[dst] -= mean
+    tile[dst] /= std
+    return tile
+
+
+def sweep_tiled(runners, groups, even, odd, outputs, means, stds, n_tiles, block_sizes, region, pbar=None,
+                profiler=NO_PROFILER):
+    """Denoises ``region`` tile by tile with the models of all ``groups``, see :func:`predict_sweep`."""
+    offset = tuple(r.start for r in region)
+    for _, core in tile_layout(even.shape, region, n_tiles, block_sizes, [0, 0, 0]):
+        windows = {key: tuple(_tile_window(n, c0, c1, b, o) for n, (c0, c1), b, o in zip(even.shape, core, *key))
+                   for key in groups}
+        union = tuple((min(w[a][0] for w in windows.values()), max(w[a][1] for w in windows.values()))
+                      for a in range(3))
+        with profiler.stage('tile', shape=[w1 - w0 for w0, w1 in union]):
+            with profiler.stage('read'):
+                raw = [read_tile(half, union, 0, 1) for half in (even, odd)]
+            for key, idx in groups.items():
+                window = windows[key]
+                with profiler.stage('normalize'):
+                    x = [np.stack([_normalize_window(r, union, window, even.shape, means[i], stds[i])
+                                   for r in raw])[..., np.newaxis] for i in idx]
+                with profiler.stage('keras_predict', models=len(idx)):
+                    preds = [np.asarray(p)[..., 0] for p in runners[key](*x)]
+                crop = tuple(slice(c0 - w0, c1 - w0) for (c0, c1), (w0, _) in zip(core, window))
+                for i, pred in zip(idx, preds):
+                    with profiler.stage('denormalize'):
+                        pred = (pred[0] + pred[1])[crop] * (stds[i] / 2.) + means[i]
+                    with profiler.stage('reassemble'):
+                        outputs[i][tuple(slice(c0 - o, c1 - o) for (c0, c1), o in zip(core, offset))] = pred
+        if pbar is not None:
+            pbar.update()
+    return outputs
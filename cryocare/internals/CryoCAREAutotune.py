@@ -0,0 +1,107 @@
+import copy
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from cryocare.internals.CryoCARE import CryoCARE
+from cryocare.internals.CryoCAREProfiler import PeakRSS
+
+
+def run_trial(net_conf, dm, batch_size, strategy, n_steps=10, n_warmup=3):
+    """Times ``n_steps`` training steps with the given batch size on the current sample shape of ``dm``.
+
+    Returns a dict with the mean step time, the mean time spent waiting for the input pipeline, the throughput
+    and the peak memory during the trial: of the GPUs if there are any, otherwise the peak resident memory of the
+    process. Raises ``tf.errors.ResourceExhaustedError`` if the batch does not fit.
+    """
+    gpus = tf.config.list_logical_devices('GPU')
+    for gpu in gpus:
+        tf.config.experimental.reset_memory_stats(gpu.name)
+    with PeakRSS() as rss:
+        step_time, input_stall = _time_steps(net_conf, dm, batch_size, strategy, n_steps, n_warmup)
+    if len(gpus) > 0:
+        peak_mb = max(tf.config.experimental.get_memory_info(gpu.name)['peak'] for gpu in gpus) / 1024 ** 2
+    else:
+        peak_mb = rss.peak_mb
+
+    return {
+        'batch_size': batch_size,
+        'patch_shape': [int(s) for s in dm.train_dataset.sample_shape],
+        'step_time': step_time,
+        'input_stall': input_stall,
+        'samples_per_second': batch_size / step_time,
+        'voxels_per_second': batch_size * float(np.prod(dm.train_dataset.sample_shape)) / step_time,
+        'peak_memory_mb': peak_mb
+    }
+
+
+def _time_steps(net_conf, dm, batch_size, strategy, n_steps, n_warmup):
+    """Mean step time and mean time spent waiting for the next batch."""
+    with strategy.scope():
+        model = CryoCARE(net_conf, 'autotune', basedir=None)
+        model.prepare_for_training()
+
+    # Every trial samples from its own copy of the training data. Iterators of earlier trials may still be
+    # prefetching in the background and would otherwise move the sampling position of this trial and of training.
+    trial_dm = copy.copy(dm)
+    trial_dm.train_dataset = copy.copy(dm.train_dataset)
+    trial_dm.train_dataset.position = 0
+    it = iter(trial_dm.get_train_dataset(batch_size))
+    fetch_times, step_times = [], []
+    for i in range(n_warmup + n_steps):
+        t0 = time.perf_counter()
+        x, y = next(it)
+        t1 = time.perf_counter()
+        model.keras_model.train_on_batch(x, y)
+        t2 = time.perf_counter()
+        if i >= n_warmup:
+            fetch_times.append(t1 - t0)
+            step_times.append(t2 - t0)
+
+    return float(np.mean(step_times)), float(np.mean(fetch_times))
+
+
+def autotune(net_conf, dm, batch_sizes, patch_shapes, strategy, n_steps=10):
+    """Runs short training trials over candidate batch sizes and patch shapes.
+
+    Patch shapes that are larger than the extracted patches or not evenly divisible as required by
+    ``CryoCARE.train`` are skipped, as are batch sizes that can not be split evenly over the replicas of
+    ``strategy``.
+    For every patch shape, batch sizes are tried in increasing order until one runs out of memory.
+
+    Returns all trial results and the one with the highest throughput in voxels per second.
+    """
+    div_by = CryoCARE(net_conf, 'autotune', basedir=None)._axes_div_by('ZYX')
+    extracted_shape = [int(s) for s in dm.train_dataset.extracted_sample_shape]
+
+    results = []
+    for patch_shape in patch_shapes:
+        if any(p % d != 0 for p, d in zip(patch_shape, div_by)):
+            print(f'Skipping patch shape {patch_shape}: not divisible by {div_by}.')
+            continue
+        if any(p > e for p, e in zip(patch_shape, extracted_shape)):
+            print(f'Skipping patch shape {patch_shape}: larger than the extracted patches {extracted_shape}.')
+            continue
+        dm.set_sample_shape(patch_shape)
+
+        for batch_size in sorted(batch_sizes):
+            if batch_size % strategy.num_replicas_in_sync != 0:
+                continue
+            try:
+                result = run_trial(net_conf, dm, batch_size, strategy, n_steps=n_steps)
+            except tf.errors.ResourceExhaustedError:
+                print(f'Patch shape {patch_shape}, batch size {batch_size}: out of memory')
+                break
+            finally:
+                tf.keras.backend.clear_session()
+            print('Patch shape {patch_shape}, batch size {batch_size}: {step_time:.3f}s per step '
+                  '({input_stall:.3f}s input stall), {samples_per_second:.1f} samples/s, '
+                  '{peak_memory_mb:.0f} MB peak memory'.format(**result))
+            results.append(result)
+
+    dm.set_sample_shape(extracted_shape)
+    if len(results) == 0:
+        raise RuntimeError('No valid configuration found for autotuning.')
+    best = max(results, key=lambda r: r['voxels_per_second'])
+    return results, best
@@ -0,0 +1,161 @@
+"""Pairing, validation and bookkeeping of the tomograms denoised by ``cryoCARE_predict.py``.
+
+Only depends on NumPy and mrcfile, so batches can be planned and checked without importing TensorFlow.
+"""
+import csv
+import hashlib
+import json
+import os
+from glob import glob
+from os.path import join
+
+import mrcfile
+import numpy as np
+
+
+def output_path(config, even):
+    prefix = f"denoised_bin{config['preview_bin']}_" if 'preview_bin' in config else "denoised_"
+    return join(config['output'], prefix + os.path.basename(even))
+
+
+def read_manifest(path):
+    """Reads the pairs of a manifest, a CSV file with the columns ``even``, ``odd`` and optionally ``output``, or
+    a JSON list of objects with these keys. Relative paths are relative to the manifest."""
+    with open(path) as f:
+        if path.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(p):
+        return p if p is None or os.path.isabs(p) else join(base, p)
+
+    return [(resolve(row['even']), resolve(row['odd']), resolve(row['output']) if row.get('output') else None)
+            for row in rows]
+
+
+def pair_by_name(even_dir, odd_dir, even_pattern='*.mrc', odd_pattern='*.mrc'):
+    """Pairs the files of two directories by the part of their name matched by ``*`` in the patterns.
+
+    With the default patterns, files with the same name are paired. Files without a partner are paired with
+    ``None``, so they show up in :func:`check_pairs`.
+    """
+    def by_key(directory, pattern):
+        prefix, suffix = pattern.split('*')
+        files = {}
+        for f in glob(join(directory, pattern)):
+            name = os.path.basename(f)
+            files[name[len(prefix):len(name) - len(suffix)]] = f
+        return files
+
+    even, odd = by_key(even_dir, even_pattern), by_key(odd_dir, odd_pattern)
+    return [(even.get(key), odd.get(key)) for key in sorted(set(even) | set(odd))]
+
+
+def get_input_pairs(config):
+    """The even and odd tomograms to denoise and their output file.
+
+    They are read from a ``manifest``, paired by name if ``even`` and ``odd`` are directories, or taken in the
+    given order from two lists or two files.
+    """
+    if 'manifest' in config:
+        pairs = read_manifest(config['manifest'])
+        return [(even, odd, output if output is not None else output_path(config, even))
+                for even, odd, output in pairs]
+
+    if type(config['even']) is list:
+        pairs = list(zip(config['even'], config['odd']))
+    elif os.path.isdir(config['even']) and os.path.isdir(config['odd']):
+        pairs = pair_by_name(config['even'], config['odd'],
+                             config['even_pattern'] if 'even_pattern' in config else '*.mrc',
+                             config['odd_pattern'] if 'odd_pattern' in config else '*.mrc')
+    else:
+        pairs = [(config['even'], config['odd'])]
+    return [(even, odd, output_path(config, even if even is not None else odd)) for even, odd in pairs]
+
+
+def check_pairs(pairs):
+    """Checks that every pair is complete, readable and that both halves have the same shape.
+
+    Returns a list of errors and the shape of every pair (``None`` if it could not be read).
+    """
+    errors, shapes = [], []
+    outputs = [output for _, _, output in pairs]
+    for even, odd, output in pairs:
+        shape = None
+        if even is None or odd is None:
+            errors.append(f'No partner found for {even if even is not None else odd}.')
+        else:
+            try:
+                with mrcfile.mmap(even, mode='r', permissive=True) as e, mrcfile.mmap(odd, mode='r', permissive=True) as o:
+                    if e.data.shape != o.data.shape:
+                        errors.append(f'{even} {e.data.shape} and {odd} {o.data.shape} have different shapes.')
+                    else:
+                        shape = e.data.shape
+            except (OSError, ValueError) as err:
+                errors.append(f'Could not read {even} or {odd}: {err}')
+        if outputs.count(output) > 1:
+            errors.append(f'{output} would be written more than once.')
+        shapes.append(shape)
+    return list(dict.fromkeys(errors)), shapes
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def provenance_path(output):
+    return output + '.json'
+
+
+def provenance(even, odd, model_sha256):
+    """What an output was computed from, the model hash and the path, size and modification time of the inputs."""
+    def describe(path):
+        stat = os.stat(path)
+        return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    return {'even': describe(even), 'odd': describe(odd), 'model_sha256': model_sha256}
+
+
+def is_up_to_date(even, odd, output, model_sha256):
+    """Whether ``output`` exists and was computed from the same inputs with the same model."""
+    if not os.path.isfile(output) or not os.path.isfile(provenance_path(output)):
+        return False
+    with open(provenance_path(output)) as f:
+        try:
+            recorded = json.load(f)
+        except ValueError:
+            return False
+    return recorded == provenance(even, odd, model_sha256)
+
+
+def write_provenance(even, odd, output, model_sha256):
+    with open(provenance_path(output), 'w') as f:
+        json.dump(provenance(even, odd, model_sha256), f, indent=4)
+
+
+def model_stem(model_path):
+    """The name of a model archive without ``.tar.gz``."""
+    name = os.path.basename(model_path)
+    return name[:-len('.tar.gz')] if name.endswith('.tar.gz') else os.path.splitext(name)[0]
+
+
+def sweep_output_path(output, model_path):
+    """Where a sweep over several models writes ``output`` for the model archive ``model_path``: in a directory
+    named like the model next to ``output``."""
+    return join(os.path.dirname(output), model_stem(model_path), os.path.basename(output))
+
+
+def largest_first(pairs, shapes):
+    """Orders the pairs by decreasing number of voxels.
+
+    Workers that take the next pair from this order finish close together, because the small tomograms at the
+    end fill the gaps (longest processing time first).
+    """
+    order = sorted(range(len(pairs)), key=lambda i: -int(np.prod(shapes[i])))
+    return [pairs[i] for i in order], [shapes[i] for i in order]
@@ -0,0 +1,89 @@
+"""Binned and strided reads of memory-mapped tomograms.
+
+The functions take the ``data`` of an ``mrcfile.mmap`` and only read the voxels they need, so they work on
+tomograms that do not fit into memory. Only depends on NumPy and mrcfile.
+"""
+import mrcfile
+import numpy as np
+
+
+def bin_factor_for(shape, max_size):
+    """Smallest integer factor that bins every axis of ``shape`` to at most ``max_size`` voxels."""
+    return max(1, int(np.ceil(max(shape) / max_size)))
+
+
+def read_binned(data, factor):
+    """Bins a volume by averaging blocks of ``factor`` x ``factor`` x ``factor`` voxels.
+
+    The volume is read slab by slab, so only ``factor`` slices are in memory at a time. Voxels beyond the last
+    full block are dropped.
+    """
+    nz, ny, nx = (s // factor for s in data.shape)
+    binned = np.empty((nz, ny, nx), dtype=np.float32)
+    for z in range(nz):
+        slab = np.asarray(data[z * factor:(z + 1) * factor, :ny * factor, :nx * factor], dtype=np.float32)
+        binned[z] = slab.reshape(factor, ny, factor, nx, factor).mean(axis=(0, 2, 4))
+    return binned
+
+
+def content_map(even, odd, factor):
+    """Local signal variance of an even/odd pair in blocks of ``factor`` x ``factor`` x ``factor`` voxels.
+
+    The noise of the two halves is independent, so their covariance within a block only contains the signal and is
+    close to zero in vacuum and empty ice. Like :func:`read_binned`, the volumes are read slab by slab.
+    """
+    nz, ny, nx = (s // factor for s in even.shape)
+    content = np.empty((nz, ny, nx), dtype=np.float32)
+    for z in range(nz):
+        e, o = (np.asarray(data[z * factor:(z + 1) * factor, :ny * factor, :nx * factor], dtype=np.float32)
+                .reshape(factor, ny, factor, nx, factor) for data in (even, odd))
+        content[z] = (e * o).mean(axis=(0, 2, 4)) - e.mean(axis=(0, 2, 4)) * o.mean(axis=(0, 2, 4))
+    return content
+
+
+def write_binned(path, binned_path, factor):
+    """Writes a copy of the tomogram ``path`` binned by ``factor``, with the pixel size scaled accordingly."""
+    with mrcfile.mmap(path, mode='r', permissive=True) as mrc:
+        binned = read_binned(mrc.data, factor)
+        voxel_size = mrc.voxel_size
+    with mrcfile.new(binned_path, binned, overwrite=True) as mrc:
+        mrc.voxel_size = (voxel_size.x * factor, voxel_size.y * factor, voxel_size.z * factor)
+
+
+def orthoslices(data, factor=1):
+    """The central XY, XZ and YZ slices, read with a stride of ``factor``."""
+    nz, ny, nx = data.shape
+    xy = np.asarray(data[nz // 2, ::factor, ::factor], dtype=np.float32)
+    xz = np.asarray(data[::factor, ny // 2, ::factor], dtype=np.float32)
+    yz = np.asarray(data[::factor, ::factor, nx // 2], dtype=np.float32)
+    return xy, xz, yz
+
+
+def overview(data, factor=1, n_slices=16):
+    """XY projection of the central half in Z, averaged over at most ``n_slices`` slices read with a stride of
+    ``factor`` in Y and X.
+
+    A projection shows the content of a noisy tomogram much better than a single slice.
+    """
+    nz = data.shape[0]
+    z0, z1 = nz // 4, max(nz // 4 + 1, 3 * nz // 4)
+    step = max(1, (z1 - z0) // n_slices)
+    projection = None
+    for z in range(z0, z1, step):
+        s = np.asarray(data[z, ::factor, ::factor], dtype=np.float32)
+        projection = s if projection is None else projection + s
+    return projection / len(range(z0, z1, step))
+
+
+def to_uint8(image, low=1, high=99):
+    """Scales ``image`` to 0-255 between its ``low`` and ``high`` percentiles."""
+    lo, hi = np.percentile(image, [low, high])
+    if hi <= lo:
+        return np.zeros(image.shape, dtype=np.uint8)
+    return (np.clip((image - lo) / (hi - lo), 0, 1) * 255).astype(np.uint8)
+
+
+def to_pgm(image):
+    """Encodes a 2D uint8 array as binary PGM, which ``tk.PhotoImage(data=...)`` reads without Pillow."""
+    h, w = image.shape
+    return f'P5 {w} {h} 255\n'.encode() + np.ascontiguousarray(image).tobytes()
@@ -0,0 +1,323 @@
+import collections
+import json
+import os
+import pickle
+import queue
+import threading
+import time
+
+import numpy as np
+import psutil
+import tensorflow as tf
+
+
+def _optimizer_variables(optimizer):
+    # A method for Keras optimizers up to TF 2.10, a property afterwards
+    variables = optimizer.variables
+    return variables() if callable(variables) else variables
+
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    """Periodically checkpoints the training state without stalling the training steps.
+
+    A checkpoint holds the model weights, the optimizer state, the epoch and step counters, the state of the
+    other callbacks (best loss, learning rate schedule), the history so far and the sampling state of the
+    data module after the ``samples_per_step`` samples of every step run so far. The state is copied to host
+    memory at the end of an epoch and written to disk by a background thread. Files are replaced atomically, so an
+    interrupted write never destroys the previous checkpoint. With ``write=False``, e.g. on all but the chief of
+    several workers, nothing is written.
+
+    When resuming, the model and optimizer state is restored once training begins. The sampling state has to be
+    restored with ``data_module.set_state`` before the datasets are created.
+    """
+
+    # Attributes that describe the progress of the stock Keras callbacks and of TrainingBudget
+    CALLBACK_STATE = ('best', 'wait', 'cooldown_counter', 'stopped_epoch', 'elapsed_seconds')
+
+    def __init__(self, path, data_module, samples_per_step, every_n_epochs=1, resume_from=None, write=True):
+        super().__init__()
+        self.path = path
+        self.data_module = data_module
+        self.samples_per_step = samples_per_step
+        self.every_n_epochs = every_n_epochs
+        self.write = write
+        self.resume_from = resume_from
+        self.history = {} if resume_from is None else resume_from['history']
+        self.callbacks = []
+        self._queue = queue.Queue(maxsize=1)
+        self._writer = None
+
+    @staticmethod
+    def load(path):
+        """Returns the checkpoint stored at ``path`` or ``None`` if there is none."""
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def on_train_begin(self, logs=None):
+        self._writer = threading.Thread(target=self.__write_loop__, daemon=True)
+        self._writer.start()
+
+        if self.resume_from is None:
+            return
+        ckpt = self.resume_from
+        self.model.set_weights(ckpt['model'])
+        # Slot variables are created lazily, so they have to exist before the state can be restored
+        optimizer = self.model.optimizer
+        if hasattr(optimizer, '_create_all_weights'):
+            optimizer._create_all_weights(self.model.trainable_variables)
+        else:
+            optimizer.build(self.model.trainable_variables)
+        for var, value in zip(_optimizer_variables(optimizer), ckpt['optimizer']):
+            var.assign(value)
+        tf.keras.backend.set_value(optimizer.learning_rate, ckpt['learning_rate'])
+        for cb, state in zip(self.callbacks, ckpt['callbacks']):
+            for k, v in state.items():
+                setattr(cb, k, v)
+        print('Resuming training after epoch {}.'.format(ckpt['epoch'] + 1))
+
+    def on_epoch_end(self, epoch, logs=None):
+        for k, v in (logs or {}).items():
+            self.history.setdefault(k, []).append(v)
+
+        if not self.write or (epoch + 1) % self.every_n_epochs != 0:
+            return
+        step = int(tf.keras.backend.get_value(self.model.optimizer.iterations))
+        ckpt = {
+            'epoch': epoch,
+            'step': step,
+            'model': self.model.get_weights(),
+            'optimizer': [var.numpy() for var in _optimizer_variables(self.model.optimizer)],
+            'learning_rate': float(tf.keras.backend.get_value(self.model.optimizer.learning_rate)),
+            'callbacks': [{k: getattr(cb, k) for k in self.CALLBACK_STATE if hasattr(cb, k)}
+                          for cb in self.callbacks],
+            'history': {k: list(v) for k, v in self.history.items()},
+            'data': self.data_module.get_state(step * self.samples_per_step)
+        }
+        # Blocks only if the previous checkpoint is still being written
+        self._queue.put(ckpt)
+
+    def on_train_end(self, logs=None):
+        self._queue.put(None)
+        self._writer.join()
+
+    def __write_loop__(self):
+        while True:
+            ckpt = self._queue.get()
+            if ckpt is None:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(ckpt, f)
+            os.replace(tmp_path, self.path)
+
+
+class TrainingMetrics(tf.keras.callbacks.Callback):
+    """Measures the training throughput per epoch and whether it is limited by the input pipeline or by compute.
+
+    Written to ``path`` as a JSON list with one entry per epoch:
+
+    * ``samples_per_second``: training samples per second of training time (validation excluded).
+    * ``step_seconds``: percentiles of the step times.
+    * ``input_wait_seconds``: time the training steps waited for their batch, measured by the last stage of the
+      training dataset, see :meth:`timed_input`. A step waits from its start until its batch leaves the input
+      pipeline, if the batch was not ready before. The first step of a run also traces the training step, it is
+      not counted.
+    * ``compute_seconds``: the rest of the step time.
+    * ``patch_read_ms``: percentiles of the patch read latencies in the generator of ``CryoCARE_Dataset`` and the
+      number of patches read. Reads run ahead of training due to prefetching.
+    * ``host_memory_mb``: resident memory of this process and available memory of the host.
+
+    In distributed training, every batch of the training dataset is split over ``steps_per_batch`` steps, the
+    number of workers. Only the first of them can wait for input.
+    """
+
+    def __init__(self, path, dataset, batch_size, resume=False, steps_per_batch=1):
+        super().__init__()
+        self.path = path
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.steps_per_batch = steps_per_batch
+        self.epochs = []
+        if resume and os.path.isfile(path):
+            with open(path) as f:
+                self.epochs = json.load(f)
+        self._process = psutil.Process()
+        # Times at which batches left the training dataset, in the order of the batches
+        self._ready_times = collections.deque()
+
+    def timed_input(self, dataset):
+        """Adds a last stage to the training ``dataset`` that records when every batch leaves it."""
+        def record():
+            self._ready_times.append(time.perf_counter())
+            return np.float64(0)
+
+        def stamp(x, y):
+            with tf.control_dependencies([tf.py_function(record, [], tf.float64)]):
+                return tf.identity(x), tf.identity(y)
+
+        return dataset.map(stamp)
+
+    def on_train_begin(self, logs=None):
+        self.dataset.record_latencies()
+        self._step = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._step_times = []
+        self._wait_times = []
+        self._validation_time = 0.0
+        self._epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._train_end = time.perf_counter()
+        self._step_times.append(self._train_end - self._step_start)
+        wait = 0.0
+        if self._step % self.steps_per_batch == 0 and len(self._ready_times) > 0:
+            ready = self._ready_times.popleft()
+            if self._step > 0:
+                wait = max(0.0, ready - self._step_start)
+        self._wait_times.append(wait)
+        self._step += 1
+
+    def on_test_begin(self, logs=None):
+        self._test_start = time.perf_counter()
+
+    def on_test_end(self, logs=None):
+        self._validation_time = time.perf_counter() - self._test_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        if len(self._step_times) == 0:
+            return
+        step_times = np.array(self._step_times)
+        train_time = self._train_end - self._epoch_start
+        wait_time = float(np.sum(self._wait_times))
+        latencies = np.array(self.dataset.drain_latencies()) * 1000
+
+        metrics = {
+            'epoch': epoch + 1,
+            'train_seconds': train_time,
+            'validation_seconds': self._validation_time,
+            'samples_per_second': len(step_times) * self.batch_size / train_time,
+            'step_seconds': {'p50': float(np.percentile(step_times, 50)),
+                             'p90': float(np.percentile(step_times, 90)),
+                             'max': float(step_times.max())},
+            'input_wait_seconds': wait_time,
+            'compute_seconds': float(step_times.sum()) - wait_time,
+            'patch_read_ms': {'count': int(latencies.size)},
+            'host_memory_mb': {'rss': self._process.memory_info().rss / 1024 ** 2,
+                               'available': psutil.virtual_memory().available / 1024 ** 2}
+        }
+        if latencies.size > 0:
+            metrics['patch_read_ms'].update({'p50': float(np.percentile(latencies, 50)),
+                                             'p90': float(np.percentile(latencies, 90)),
+                                             'p99': float(np.percentile(latencies, 99))})
+        self.epochs.append(metrics)
+
+        with open(self.path, 'w') as f:
+            json.dump(self.epochs, f, indent=4)
+
+
+class PatchPoolRefresh(tf.keras.callbacks.Callback):
+    """Refreshes a ``CryoCARE_PatchPool`` after every epoch.
+
+    Logs the patches read from storage per training sample of the epoch as ``reads_per_sample``. The first epoch
+    includes filling the pool. Has to come before callbacks that record the logs, like :class:`AsyncCheckpoint`.
+    """
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def on_epoch_end(self, epoch, logs=None):
+        n_reads, n_samples = self.pool.drain_counts()
+        if n_samples > 0:
+            print('Patch pool: {:.3f} reads per sample'.format(n_reads / n_samples))
+            if logs is not None:
+                logs['reads_per_sample'] = n_reads / n_samples
+        self.pool.refresh()
+
+    def on_train_end(self, logs=None):
+        self.pool.wait()
+
+
+class TrainingBudget(tf.keras.callbacks.Callback):
+    """Stops training once a wall-clock or step budget is used up and summarizes how training ended.
+
+    The time budget ``max_seconds`` counts the time spent in epochs, including the ones before a resume. An epoch
+    is not started if the previous one suggests that it would not finish within the budget, and a running epoch
+    is cut short once the budget is exceeded. ``max_steps`` limits the training steps of the whole run. Stopped
+    runs end like completed ones: validation runs for the last epoch and the best weights are kept.
+
+    :meth:`summary` reports why training stopped and the epochs, steps and (estimated) time saved compared to the
+    planned ``epochs``. ``early_stopping`` is the ``EarlyStopping`` callback of the run, if any.
+    """
+
+    def __init__(self, epochs, steps_per_epoch, max_seconds=None, max_steps=None, early_stopping=None):
+        super().__init__()
+        self.epochs = epochs
+        self.steps_per_epoch = steps_per_epoch
+        self.max_seconds = max_seconds
+        self.max_steps = max_steps
+        self.early_stopping = early_stopping
+        # Restored by AsyncCheckpoint on resume
+        self.elapsed_seconds = 0.0
+        self.stop_reason = None
+        self._epoch_seconds = []
+        self._last_epoch = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.max_steps is not None and \
+                int(tf.keras.backend.get_value(self.model.optimizer.iterations)) >= self.max_steps:
+            self.__stop__('step budget')
+        elif self.max_seconds is not None and \
+                self.elapsed_seconds + time.perf_counter() - self._epoch_start >= self.max_seconds:
+            self.__stop__('time budget')
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self._epoch_start
+        self.elapsed_seconds += seconds
+        self._epoch_seconds.append(seconds)
+        self._last_epoch = epoch
+        # The first epoch after starting or resuming includes tracing the training step
+        next_seconds = seconds if len(self._epoch_seconds) > 1 else min(seconds, self.elapsed_seconds / (epoch + 1))
+        if self.max_seconds is not None and not self.model.stop_training and epoch + 1 < self.epochs and \
+                self.elapsed_seconds + next_seconds > self.max_seconds:
+            self.__stop__('time budget')
+
+    def __stop__(self, reason):
+        if not self.model.stop_training:
+            print(f'\nStopping training, the {reason} is used up.')
+            self.stop_reason = reason
+        self.model.stop_training = True
+
+    def summary(self):
+        epochs_run = 0 if self._last_epoch is None else self._last_epoch + 1
+        steps_run = int(tf.keras.backend.get_value(self.model.optimizer.iterations))
+        reason = self.stop_reason
+        if reason is None:
+            if self.early_stopping is not None and self.early_stopping.stopped_epoch > 0:
+                reason = 'early stopping'
+            else:
+                reason = 'completed' if epochs_run >= self.epochs else 'stopped'
+        planned_steps = self.epochs * self.steps_per_epoch
+        summary = {
+            'stop_reason': reason,
+            'epochs_planned': self.epochs,
+            'epochs_run': epochs_run,
+            'steps_planned': planned_steps,
+            'steps_run': steps_run,
+            'steps_saved': max(planned_steps - steps_run, 0),
+            'seconds': self.elapsed_seconds
+        }
+        if len(self._epoch_seconds) > 1:
+            seconds_per_step = float(np.mean(self._epoch_seconds[1:])) / self.steps_per_epoch
+            summary['seconds_saved'] = summary['steps_saved'] * seconds_per_step
+        return summary
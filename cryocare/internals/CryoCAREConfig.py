@@ -0,0 +1,202 @@
+"""Checks of the json configurations of the cryoCARE scripts.
+
+Only depends on NumPy, so configs can be checked without importing TensorFlow. Every check returns a list of
+error messages, which is empty if the config is valid.
+"""
+import os
+from os.path import join
+
+import numpy as np
+
+
+def _check_keys(config, keys):
+    return [f'Missing parameter "{key}".' for key in keys if key not in config]
+
+
+def _check_files(paths, name):
+    return [f'{name} file {p} does not exist.' for p in paths if not os.path.isfile(p)]
+
+
+def _check_shape(config, key, min_value=1):
+    if key not in config:
+        return []
+    value = config[key]
+    if type(value) is not list or len(value) != 3 or any(type(v) is not int or v < min_value for v in value):
+        return [f'"{key}" has to be a list of three integers >= {min_value}.']
+    return []
+
+
+def _as_list(paths):
+    return paths if type(paths) is list else [paths]
+
+
+def _check_cpu_profile(config):
+    if 'cpu_profile' not in config or config['cpu_profile'] in [None, 'auto']:
+        return []
+    profile = config['cpu_profile']
+    if type(profile) is not dict:
+        return ['"cpu_profile" has to be "auto" or a profile.']
+    errors = []
+    for key in ['intra_op_threads', 'inter_op_threads', 'numa_node']:
+        if key in profile and profile[key] is not None and (type(profile[key]) is not int or profile[key] < 0):
+            errors.append(f'"cpu_profile.{key}" has to be a non-negative integer.')
+    if 'onednn' in profile and type(profile['onednn']) is not bool:
+        errors.append('"cpu_profile.onednn" has to be true or false.')
+    return errors + _check_shape(profile, 'n_tiles')
+
+
+def check_train_data_config(config):
+    errors = _check_keys(config, ['even', 'odd', 'patch_shape', 'num_slices', 'split', 'tilt_axis',
+                                  'n_normalization_samples', 'path'])
+    if len(errors) > 0:
+        return errors
+
+    if len(config['even']) != len(config['odd']):
+        errors.append('"even" and "odd" need the same number of tomograms.')
+    errors += _check_files(config['even'], 'Even')
+    errors += _check_files(config['odd'], 'Odd')
+    if 'mask' in config:
+        if len(config['mask']) != len(config['even']):
+            errors.append('"mask" needs one mask per tomogram.')
+        errors += _check_files(config['mask'], 'Mask')
+    errors += _check_shape(config, 'patch_shape')
+    if not 0 < config['split'] < 1:
+        errors.append('"split" has to be between 0 and 1.')
+    if config['tilt_axis'] not in ['Z', 'Y', 'X']:
+        errors.append('"tilt_axis" has to be one of "Z", "Y" or "X".')
+    if 'bin' in config and (type(config['bin']) is not int or config['bin'] < 1):
+        errors.append('"bin" has to be a positive integer.')
+    if 'content_bin' in config and (type(config['content_bin']) is not int or config['content_bin'] < 1):
+        errors.append('"content_bin" has to be a positive integer.')
+    if 'seed' in config and (type(config['seed']) is not int or config['seed'] < 0):
+        errors.append('"seed" has to be a non-negative integer.')
+    return errors
+
+
+def check_train_config(config):
+    errors = _check_keys(config, ['train_data', 'epochs', 'steps_per_epoch', 'batch_size', 'unet_kern_size',
+                                  'unet_n_depth', 'unet_n_first', 'learning_rate', 'model_name', 'path'])
+    if len(errors) > 0:
+        return errors
+
+    if config['unet_kern_size'] % 2 != 1:
+        errors.append('"unet_kern_size" has to be odd.')
+    errors += _check_files([join(config['train_data'], 'train_data.npz'), join(config['train_data'], 'val_data.npz')],
+                           'Training data')
+    errors += _check_coordinates(config['train_data'])
+    errors += _check_files([config[key] for key in ['base_model', 'teacher_model', 'baseline_model'] if key in config],
+                           'Model')
+    errors += _check_shape(config, 'patch_shape')
+    if 'patch_pool_mb' in config and not (type(config['patch_pool_mb']) in [int, float] and config['patch_pool_mb'] > 0):
+        errors.append('"patch_pool_mb" has to be a positive number.')
+    if 'patch_pool_refresh' in config and not (type(config['patch_pool_refresh']) in [int, float] and
+                                               0 <= config['patch_pool_refresh'] <= 1):
+        errors.append('"patch_pool_refresh" has to be between 0 and 1.')
+    errors += _check_cpu_profile(config)
+    errors += _check_budget(config)
+
+    if len(errors) == 0:
+        patch_shape = config['patch_shape'] if 'patch_shape' in config else \
+            np.load(join(config['train_data'], 'train_data.npz'))['sample_shape']
+        # The U-Net pools by a factor of two at every level, see CryoCARE.train
+        div_by = 2 ** config['unet_n_depth']
+        if any(int(s) % div_by != 0 for s in patch_shape):
+            errors.append(f'The patch shape {[int(s) for s in patch_shape]} has to be divisible by {div_by} for '
+                          f'unet_n_depth={config["unet_n_depth"]}.')
+    return errors
+
+
+def _check_coordinates(train_data):
+    # Since the coordinates are stored in their own file, see CryoCARE_Dataset.save. Older files hold them inside.
+    errors = []
+    for name in ['train_data', 'val_data']:
+        path = join(train_data, name + '.npz')
+        if not os.path.isfile(path):
+            continue
+        with np.load(path) as data:
+            stored_inside = 'coords' in data.files or 'online' in data.files and bool(data['online'])
+        errors += [] if stored_inside else _check_files([join(train_data, name + '_coords.npy')], 'Coordinate')
+    return errors
+
+
+def _check_budget(config):
+    errors = []
+    for key in ['early_stopping_patience', 'max_steps']:
+        if key in config and not (type(config[key]) is int and config[key] > 0):
+            errors.append(f'"{key}" has to be a positive integer.')
+    for key in ['early_stopping_min_delta']:
+        if key in config and not (type(config[key]) in [int, float] and config[key] >= 0):
+            errors.append(f'"{key}" can not be negative.')
+    if 'max_hours' in config and not (type(config['max_hours']) in [int, float] and config['max_hours'] > 0):
+        errors.append('"max_hours" has to be a positive number.')
+    if 'reduce_lr' in config and config['reduce_lr'] is not None:
+        if type(config['reduce_lr']) is not dict:
+            errors.append('"reduce_lr" has to be an object or null.')
+        else:
+            unknown = [key for key in config['reduce_lr'] if key not in ['factor', 'patience', 'min_delta', 'cooldown', 'min_lr']]
+            if len(unknown) > 0:
+                errors.append(f'Unknown "reduce_lr" settings: {", ".join(unknown)}.')
+            if 'factor' in config['reduce_lr'] and not (type(config['reduce_lr']['factor']) in [int, float] and
+                                                        0 < config['reduce_lr']['factor'] < 1):
+                errors.append('"reduce_lr": "factor" has to be between 0 and 1.')
+    return errors
+
+
+def _check_sweep(config):
+    errors = []
+    if len(config['path']) == 0:
+        errors.append('"path" needs at least one model.')
+    names = [os.path.basename(p) for p in config['path']]
+    if len(set(names)) != len(names):
+        errors.append('The models of a sweep need different file names, their outputs are written to directories '
+                      'named like them.')
+    for key in ['coordinates', 'cooperative', 'workers']:
+        if key in config and config[key] not in [None, False, 1]:
+            errors.append(f'"{key}" can not be combined with several models in "path".')
+    return errors
+
+
+def check_predict_config(config):
+    errors = _check_keys(config, ['path', 'n_tiles', 'output'] + ([] if 'manifest' in config else ['even', 'odd']))
+    if len(errors) > 0:
+        return errors
+
+    for p in _as_list(config['path']):
+        if not os.path.exists(p):
+            errors.append(f'Model {p} does not exist.')
+    if type(config['path']) is list:
+        errors += _check_sweep(config)
+    if 'manifest' in config:
+        errors += _check_files([config['manifest']], 'Manifest')
+    else:
+        for key in ['even', 'odd']:
+            for p in _as_list(config[key]):
+                if not os.path.exists(p):
+                    errors.append(f'{p} does not exist.')
+    for key in ['even_pattern', 'odd_pattern']:
+        if key in config and config[key].count('*') != 1:
+            errors.append(f'"{key}" has to contain exactly one "*".')
+    if 'workers' in config and (type(config['workers']) is not int or config['workers'] < 1):
+        errors.append('"workers" has to be a positive integer.')
+    if 'preview_bin' in config and (type(config['preview_bin']) is not int or config['preview_bin'] < 2):
+        errors.append('"preview_bin" has to be an integer >= 2.')
+    if 'slabs' in config and (type(config['slabs']) is not int or config['slabs'] < 1):
+        errors.append('"slabs" has to be a positive integer.')
+    if 'lease_seconds' in config and not (type(config['lease_seconds']) in [int, float] and config['lease_seconds'] > 0):
+        errors.append('"lease_seconds" has to be a positive number.')
+    if 'cooperative' in config and config['cooperative'] and 'workers' in config and config['workers'] > 1:
+        errors.append('"workers" can not be combined with "cooperative", start several processes instead.')
+    if 'coordinates' in config:
+        if not os.path.exists(config['coordinates']):
+            errors.append(f'Coordinates {config["coordinates"]} do not exist.')
+        if 'slabs' in config and config['slabs'] > 1:
+            errors.append('"coordinates" can not be combined with "slabs".')
+    if 'box_size' in config and (type(config['box_size']) is not int or config['box_size'] < 1):
+        errors.append('"box_size" has to be a positive integer.')
+    if 'coordinate_output' in config and config['coordinate_output'] not in ['stack', 'sparse']:
+        errors.append('"coordinate_output" has to be "stack" or "sparse".')
+    if 'batch_size' in config and (type(config['batch_size']) is not int or config['batch_size'] < 1):
+        errors.append('"batch_size" has to be a positive integer.')
+    errors += _check_shape(config, 'n_tiles')
+    errors += _check_cpu_profile(config)
+    return errors
@@ -1,37 +1,70 @@
 import numpy as np
-import tensorflow as tf
 
 import mrcfile
 import tqdm
 
+import os
+import threading
+import time
+from glob import glob
 from os.path import join
 
+from cryocare.internals.CryoCAREBinning import content_map
+
+
+def coordinates_path(path):
+    """The memory-mappable ``.npy`` file of the patch coordinates of the dataset saved to ``path``."""
+    return os.path.splitext(path)[0] + '_coords.npy'
+
+
+def compact_coordinates(per_tomo):
+    """Concatenates the patch coordinates of every tomogram into one array of the smallest unsigned integer type
+    that holds them. Returns it and the number of coordinates per tomogram."""
+    counts = np.array([len(c) for c in per_tomo], dtype=np.int64)
+    coords = np.concatenate([np.asarray(c).reshape(-1, 3) for c in per_tomo]) if len(per_tomo) > 0 else \
+        np.zeros((0, 3))
+    dtype = np.uint16 if coords.size == 0 or coords.max() < 2 ** 16 else np.uint32
+    return coords.astype(dtype), counts
+
+
+# TensorFlow is only imported where the tf.data pipelines are built, so that extracting training data does not
+# pay for importing it.
+class CryoCARE_Dataset(object):
+    # Number of samples whose positions the generator looks up at once
+    GATHER_CHUNK = 4096
 
-class CryoCARE_Dataset(tf.keras.utils.Sequence):
     def __init__(self, tomo_paths_odd=None, tomo_paths_even=None, mask_paths=None,
                  n_samples_per_tomo=None, extraction_shapes=None, mean=None, std=None,
-                 sample_shape=(64, 64, 64), shuffle=True, n_normalization_samples=500, tilt_axis=None):
+                 sample_shape=(64, 64, 64), shuffle=True, n_normalization_samples=500, tilt_axis=None,
+                 weight_maps=None, weight_bin=1, online=False, seed=None, boxes=None, block_weights=None,
+                 coords=None, coord_counts=None):
         self.tomo_paths_odd = tomo_paths_odd
         self.tomo_paths_even = tomo_paths_even
         self.mask_paths = mask_paths
+        # Binned maps of how often patches are drawn around each location, uniform if None
+        self.weight_maps = weight_maps
+        self.weight_bin = weight_bin
         self.n_samples_per_tomo = n_samples_per_tomo
         self.tilt_axis = tilt_axis
 
-        if self.tilt_axis is not None:
-            tilt_axis_index = ["Z", "Y", "X"].index(self.tilt_axis)
-            rot_axes = [0, 1, 2]
-            rot_axes.remove(tilt_axis_index)
-            self.rot_axes = tuple(rot_axes)
-        else:
-            self.rot_axes = None
-
         self.extraction_shapes = extraction_shapes
         self.mean = mean
         self.std = std
 
         self.sample_shape = np.array(list(sample_shape))
+        self.extracted_sample_shape = self.sample_shape.copy()
         self.shuffle = shuffle
-        self.coords = None
+        # Patch positions (Z, Y, X) of all tomograms in one array, the ones of tomogram i start at coord_offsets[i]
+        self.coords = coords
+        self.coord_counts = coord_counts
+        self.coord_offsets = None
+        # In online mode, patches are drawn from blocks of the extraction boxes instead of from fixed coordinates
+        self.online = online
+        self.seed = int(np.random.SeedSequence().generate_state(1)[0]) if seed is None else int(seed)
+        self.boxes = boxes
+        self.block_weights = block_weights
+        self.tomo_indices = None
+        self.block_cdfs = None
 
         self.tomos_odd = [mrcfile.mmap(p, mode='r', permissive=True) for p in self.tomo_paths_odd]
         self.tomos_even = [mrcfile.mmap(p, mode='r', permissive=True) for p in self.tomo_paths_even]
@@ -39,34 +72,88 @@ class CryoCARE_Dataset(tf.keras.utils.Sequence):
 
         if self.mask_paths is None:
             self.mask_paths = [None] * self.n_tomos
-
-        self.create_coordinate_lists()
-        self.length = sum([c.shape[0] for c in self.coords])
-
-        if self.shuffle:
-            self.indices = np.random.permutation(self.length)
+        if self.weight_maps is None:
+            self.weight_maps = [None] * self.n_tomos
+
+        if self.online:
+            if self.boxes is None:
+                self.create_sampling_blocks()
+            self.tomo_indices = np.arange(self.n_tomos)
+            self.block_cdfs = [np.cumsum(w, dtype=np.float64).ravel() for w in self.block_weights]
+            # The number of patches of an epoch, every epoch draws new ones
+            self.length = self.n_tomos * int(self.n_samples_per_tomo)
         else:
-            self.indices = np.arange(self.length)
+            if self.coords is None:
+                self.create_coordinate_lists()
+            self.coord_offsets = np.concatenate([[0], np.cumsum(self.coord_counts)[:-1]]).astype(np.int64)
+            self.length = len(self.coords)
+
+        # Samples this dataset draws from, a subset if the dataset is sharded over several workers. Online indices
+        # grow with every epoch.
+        self.sample_indices = np.arange(self.length, dtype=np.int64 if self.online or self.length >= 2 ** 32
+                                        else np.uint32)
+        # Epoch of the generator and position of its next sample in the epoch
+        self.epoch = 0
+        self.position = 0
+        # Patch read latencies, only recorded on request
+        self.latencies = None
+        self.indices = self.epoch_indices(self.epoch)
 
         if self.mean == None or self.std == None:
             self.compute_mean_std(n_samples=n_normalization_samples)
 
     def save(self, path):
-        np.savez(path,
-                 tomo_paths_odd=self.tomo_paths_odd,
-                 tomo_paths_even=self.tomo_paths_even,
+        """Saves the dataset to the ``.npz`` file ``path`` and its coordinates next to it, see
+        :func:`coordinates_path`. Both files are replaced atomically and can be loaded without pickle."""
+        if self.online:
+            online = {'online': True,
+                      'seed': self.seed,
+                      'boxes': np.array(self.boxes),
+                      'block_shapes': np.array([w.shape for w in self.block_weights]),
+                      'block_weights': np.concatenate([w.ravel() for w in self.block_weights])}
+        else:
+            online = {'coord_counts': self.coord_counts}
+            tmp_path = coordinates_path(path) + '.tmp.npy'
+            np.save(tmp_path, np.asarray(self.coords))
+            os.replace(tmp_path, coordinates_path(path))
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+                 tomo_paths_odd=np.array(self.tomo_paths_odd, dtype=str),
+                 tomo_paths_even=np.array(self.tomo_paths_even, dtype=str),
                  mean=self.mean,
                  std=self.std,
                  n_samples_per_tomo=self.n_samples_per_tomo,
-                 extraction_shapes=self.extraction_shapes,
-                 sample_shape=self.sample_shape,
+                 extraction_shapes=np.array(self.extraction_shapes),
+                 sample_shape=self.extracted_sample_shape,
                  shuffle=self.shuffle,
-                 coords=self.coords,
-                 tilt_axis=self.tilt_axis)
+                 # Empty for None, which would need pickle
+                 tilt_axis='' if self.tilt_axis is None else self.tilt_axis,
+                 weight_bin=self.weight_bin,
+                 **online)
+        os.replace(tmp_path, path)
 
     @classmethod
-    def load(cls, path):
-        tmp = np.load(path, allow_pickle=True)
+    def load(cls, path, convert=True):
+        """Loads a dataset saved with :meth:`save`, with memory-mapped coordinates.
+
+        Files of earlier versions, which stored the coordinates per tomogram as a pickled array inside the ``.npz``,
+        are converted to the current format, in place if possible. With ``convert=False``, they are only read, e.g.
+        to inspect them without changing anything.
+        """
+        with np.load(path) as tmp:
+            legacy = 'coords' in tmp.files
+        with np.load(path, allow_pickle=legacy) as tmp:
+            ds = cls.__from_npz__(path, tmp, legacy)
+        if legacy and convert:
+            try:
+                ds.save(path)
+                print(f'Converted {path} to the current format.')
+            except OSError as e:
+                print(f'Could not convert {path} to the current format ({e}), it is converted on every load.')
+        return ds
+
+    @classmethod
+    def __from_npz__(cls, path, tmp, legacy):
         tomo_paths_odd = [str(p) for p in tmp['tomo_paths_odd']]
         tomo_paths_even = [str(p) for p in tmp['tomo_paths_even']]
         mean = tmp['mean']
@@ -75,11 +162,23 @@ class CryoCARE_Dataset(tf.keras.utils.Sequence):
         extraction_shapes = tmp['extraction_shapes']
         sample_shape = tmp['sample_shape']
         shuffle = tmp['shuffle']
-        coords = tmp['coords']
-        if isinstance(tmp['tilt_axis'], np.ndarray):
-            tilt_axis = None
+        if legacy:
+            # Stored as a 0-d array, holding None for the validation data
+            tilt_axis = tmp['tilt_axis'].item()
+        else:
+            tilt_axis = str(tmp['tilt_axis']) or None
+        online = 'online' in tmp and bool(tmp['online'])
+        if online:
+            coords, coord_counts = None, None
+        elif legacy:
+            # An object array of per tomogram arrays, or a 3D array if all tomograms had the same number of patches
+            coords, coord_counts = compact_coordinates(list(tmp['coords']))
         else:
-            tilt_axis = tmp['tilt_axis']
+            coords, coord_counts = np.load(coordinates_path(path), mmap_mode='r'), tmp['coord_counts']
+        if online:
+            sizes = np.prod(tmp['block_shapes'], axis=1)
+            block_weights = [w.reshape(shape) for w, shape in
+                             zip(np.split(tmp['block_weights'], np.cumsum(sizes)[:-1]), tmp['block_shapes'])]
 
         ds = cls(tomo_paths_odd=tomo_paths_odd,
                  tomo_paths_even=tomo_paths_even,
@@ -89,8 +188,14 @@ class CryoCARE_Dataset(tf.keras.utils.Sequence):
                  extraction_shapes=extraction_shapes,
                  sample_shape=sample_shape,
                  shuffle=shuffle,
-                 tilt_axis=tilt_axis)
-        ds.coords = coords
+                 tilt_axis=tilt_axis,
+                 weight_bin=int(tmp['weight_bin']) if 'weight_bin' in tmp else 1,
+                 online=online,
+                 seed=tmp['seed'] if online else None,
+                 boxes=tmp['boxes'] if online else None,
+                 block_weights=block_weights if online else None,
+                 coords=coords,
+                 coord_counts=coord_counts)
         return ds
 
     def compute_mean_std(self, n_samples=2000):
@@ -105,14 +210,15 @@ class CryoCARE_Dataset(tf.keras.utils.Sequence):
         del (samples)
 
     def create_coordinate_lists(self):
-        self.coords = []
+        coords = []
         
-        for odd, even, es, maskfile in zip(self.tomo_paths_odd, self.tomo_paths_even, self.extraction_shapes, self.mask_paths):
-            self.coords.append(self.__create_coords_for_tomo__(even, odd, es, maskfile))
+        for odd, even, es, maskfile, weights in zip(self.tomo_paths_odd, self.tomo_paths_even, self.extraction_shapes,
+                                                    self.mask_paths, self.weight_maps):
+            coords.append(self.__create_coords_for_tomo__(even, odd, es, maskfile, weights))
 
-        self.coords = np.array(self.coords)
+        self.coords, self.coord_counts = compact_coordinates(coords)
 
-    def __create_coords_for_tomo__(self, even_path, odd_path, extraction_shape, mask_path):
+    def __create_coords_for_tomo__(self, even_path, odd_path, extraction_shape, mask_path, weights=None):
         even = mrcfile.mmap(even_path, mode='r')
         odd = mrcfile.mmap(odd_path, mode='r')
         
@@ -136,14 +242,15 @@ class CryoCARE_Dataset(tf.keras.utils.Sequence):
                                            extraction_shape[1],
                                            extraction_shape[2],
                                            mask,
-                                           n_samples=self.n_samples_per_tomo)
+                                           n_samples=self.n_samples_per_tomo,
+                                           weights=weights)
 
         even.close()
         odd.close()
 
         return coords
 
-    def create_random_coords(self, z, y, x, mask, n_samples):
+    def create_random_coords(self, z, y, x, mask, n_samples, weights=None):
         # Inspired by isonet preprocessing.cubes:create_cube_seeds()
         
         # Get permissible locations based on extraction_shape and sample_shape
@@ -155,38 +262,104 @@ class CryoCARE_Dataset(tf.keras.utils.Sequence):
         valid_inds = np.where(mask[slices])
         
         valid_inds = [v + s.start for s, v in zip(slices, valid_inds)]
-        
+
+        p = None
+        if weights is not None:
+            # Weight of the block at the center of each patch
+            centers = tuple(np.minimum((v + s // 2) // self.weight_bin, n - 1)
+                            for v, s, n in zip(valid_inds, self.sample_shape, weights.shape))
+            p = weights[centers].astype(np.float64)
+            p /= p.sum()
+
         sample_inds = np.random.choice(len(valid_inds[0]),
                                        n_samples,
-                                       replace=len(valid_inds[0]) < n_samples)
+                                       replace=len(valid_inds[0]) < n_samples,
+                                       p=p)
         
         rand_inds = [v[sample_inds] for v in valid_inds]
         
 
         return np.stack([rand_inds[0],rand_inds[1], rand_inds[2]], -1)
 
-    def augment(self, x, y):
-        if self.tilt_axis is not None:
-            if self.sample_shape[0] == self.sample_shape[1] and \
-                    self.sample_shape[0] == self.sample_shape[2]:
-                rot_k = np.random.randint(0, 4, 1)
+    def create_sampling_blocks(self):
+        self.boxes = []
+        self.block_weights = []
+        for es, maskfile, weights in zip(self.extraction_shapes, self.mask_paths, self.weight_maps):
+            box, block_weights = self.__create_blocks_for_tomo__(es, maskfile, weights)
+            self.boxes.append(box)
+            self.block_weights.append(block_weights)
+
+    def __create_blocks_for_tomo__(self, extraction_shape, mask_path, weights):
+        """Splits the permissible patch positions into blocks of ``weight_bin`` voxels per axis.
+
+        A block is weighted by its number of positions inside the mask, times the content weight at the patch
+        center if there is one. Within a block, positions are drawn uniformly, so a block partially covered by the
+        mask can yield positions just outside of it.
+        """
+        # Same permissible positions as in create_random_coords
+        box = np.array([[extraction_shape[0][0], extraction_shape[0][1] - self.sample_shape[2]],
+                        [extraction_shape[1][0], extraction_shape[1][1] - self.sample_shape[1]],
+                        [extraction_shape[2][0], extraction_shape[2][1] - self.sample_shape[0]]])
+        starts = [np.arange(lo, hi, self.weight_bin) for lo, hi in box]
 
-                x[...,0] = np.rot90(x[...,0], k=rot_k, axes=self.rot_axes)
-                y[...,0] = np.rot90(y[...,0], k=rot_k, axes=self.rot_axes)
-
-
-        if np.random.rand() > 0.5:
-            return y, x
+        if mask_path is None:
+            sizes = [np.minimum(st + self.weight_bin, hi) - st for st, (_, hi) in zip(starts, box)]
+            counts = sizes[0][:, None, None] * sizes[1][None, :, None] * sizes[2][None, None, :]
         else:
-            return x, y
+            counts = mrcfile.read(mask_path)[box[0][0]:box[0][1], box[1][0]:box[1][1], box[2][0]:box[2][1]] != 0
+            counts = counts.astype(np.int64)
+            for axis, st in enumerate(starts):
+                counts = np.add.reduceat(counts, st - st[0], axis=axis)
+        block_weights = counts.astype(np.float32)
+
+        if weights is not None:
+            centers = [np.minimum((st + self.weight_bin // 2 + s // 2) // self.weight_bin, n - 1)
+                       for st, s, n in zip(starts, self.sample_shape, weights.shape)]
+            block_weights *= weights[np.ix_(*centers)]
+        return box, block_weights
+
+    def draw_coordinate(self, idx):
+        """Position of patch ``idx`` in online mode, drawn from a generator seeded with the dataset seed and ``idx``.
+
+        Every index yields another patch, so the number of distinct patches is not limited, and the same index
+        always yields the same patch.
+        """
+        rng = np.random.default_rng([self.seed, idx])
+        tomo_index = self.tomo_indices[rng.integers(len(self.tomo_indices))]
+        cdf = self.block_cdfs[tomo_index]
+        block = np.searchsorted(cdf, rng.random() * cdf[-1], side='right')
+        block = np.unravel_index(min(block, len(cdf) - 1), self.block_weights[tomo_index].shape)
+        coord = []
+        for b, (lo, hi) in zip(block, self.boxes[tomo_index]):
+            start = lo + b * self.weight_bin
+            coord.append(start + rng.integers(min(self.weight_bin, hi - start)))
+        return tomo_index, coord
 
     def __len__(self):
         return self.length
 
+    def nbytes(self):
+        # even and odd float32 patches
+        return 2 * self.length * int(np.prod(self.sample_shape)) * np.dtype(np.float32).itemsize
+
+    def gather(self, indices):
+        """Tomogram indices and positions of the samples ``indices`` (not in online mode), for many samples at
+        once."""
+        indices = np.asarray(indices)
+        tomo_indices = np.searchsorted(self.coord_offsets, indices, side='right') - 1
+        return tomo_indices, np.asarray(self.coords[indices])
+
     def __getitem__(self, idx):
-        tomo_index, coord_index = idx // self.n_samples_per_tomo, idx % self.n_samples_per_tomo
-        z, y, x = self.coords[tomo_index][coord_index]
+        if self.online:
+            tomo_index, coord = self.draw_coordinate(idx)
+        else:
+            tomo_indices, coords = self.gather([idx])
+            tomo_index, coord = tomo_indices[0], coords[0]
+        return self.read_patch(tomo_index, coord)
 
+    def read_patch(self, tomo_index, coord):
+        """The even and odd patch of tomogram ``tomo_index`` at ``coord`` (Z, Y, X)."""
+        z, y, x = (int(c) for c in coord)
         even_subvolume = self.tomos_even[tomo_index].data[z:z + self.sample_shape[0],
                          y:y + self.sample_shape[1],
                          x:x + self.sample_shape[2]]
@@ -194,16 +367,87 @@ class CryoCARE_Dataset(tf.keras.utils.Sequence):
         odd_subvolume = self.tomos_odd[tomo_index].data[z:z + self.sample_shape[0],
                         y:y + self.sample_shape[1],
                         x:x + self.sample_shape[2]]
-        return self.augment(np.array(even_subvolume)[..., np.newaxis], np.array(odd_subvolume)[..., np.newaxis])
+        # Augmentation happens batch-wise in the tf.data pipeline, see CryoCARE_DataModule.get_augmenter
+        return np.array(even_subvolume)[..., np.newaxis], np.array(odd_subvolume)[..., np.newaxis]
 
     def __iter__(self):
-        for idx in self.indices:
-            yield self.__getitem__(idx)
+        while self.position < len(self.indices):
+            chunk = self.indices[self.position:self.position + self.GATHER_CHUNK]
+            if self.online:
+                locations = [self.draw_coordinate(idx) for idx in chunk]
+            else:
+                locations = zip(*self.gather(chunk))
+            for tomo_index, coord in locations:
+                self.position += 1
+                if self.latencies is None:
+                    yield self.read_patch(tomo_index, coord)
+                else:
+                    t0 = time.perf_counter()
+                    item = self.read_patch(tomo_index, coord)
+                    self.latencies.append(time.perf_counter() - t0)
+                    yield item
+        self.position = 0
         self.on_epoch_end()
 
-    def on_epoch_end(self):
+    def record_latencies(self):
+        """Start recording how long every patch read of the generator takes."""
+        self.latencies = []
+
+    def drain_latencies(self):
+        """Returns the patch read latencies in seconds since the last call."""
+        latencies, self.latencies = self.latencies, []
+        return latencies
+
+    def epoch_indices(self, epoch):
+        """Samples of ``epoch`` in the order they are drawn, which only depends on the seed and the shard."""
+        if self.online:
+            # Every epoch draws new patches
+            return self.sample_indices + epoch * self.length
         if self.shuffle:
-            self.indices = np.random.permutation(self.length)
+            return np.random.default_rng([self.seed, epoch]).permutation(self.sample_indices)
+        return self.sample_indices
+
+    def n_drawn(self):
+        """Number of samples the generator has drawn before its current position, over all epochs."""
+        return self.epoch * len(self.sample_indices) + self.position
+
+    def get_state(self, n_samples):
+        """Sampling state after the first ``n_samples`` samples of the training, which allows to continue an
+        interrupted run with the same patches.
+
+        The generator runs ahead of training due to prefetching, so its own position is not the one to save.
+        """
+        return {'seed': self.seed, 'n_samples': int(n_samples)}
+
+    def set_state(self, state):
+        """Continues sampling after ``state['n_samples']`` samples. Has to be called after :meth:`shard`, every
+        worker derives the position in its own shard."""
+        self.seed = state['seed']
+        self.epoch, self.position = divmod(state['n_samples'], len(self.sample_indices))
+        self.indices = self.epoch_indices(self.epoch)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.indices = self.epoch_indices(self.epoch)
+
+    def shard(self, num_shards, index):
+        """Restrict sampling to shard ``index`` of ``num_shards``.
+
+        If there are at least as many tomograms as shards, every shard gets its own tomograms. Otherwise the
+        samples are split round-robin.
+        """
+        assert 0 <= index < num_shards, 'Shard index {} out of range for {} shards.'.format(index, num_shards)
+        if self.online and self.n_tomos >= num_shards:
+            self.tomo_indices = np.arange(self.n_tomos)[index::num_shards]
+            self.sample_indices = np.arange(len(self.tomo_indices) * int(self.n_samples_per_tomo))
+        elif self.n_tomos >= num_shards:
+            tomo_indices = np.arange(self.n_tomos)[index::num_shards]
+            self.sample_indices = np.concatenate([np.arange(self.coord_offsets[t],
+                                                            self.coord_offsets[t] + self.coord_counts[t])
+                                                  for t in tomo_indices])
+        else:
+            self.sample_indices = self.sample_indices[index::num_shards]
+        self.indices = self.epoch_indices(self.epoch)
 
     def close(self):
         for even, odd in zip(self.tomos_even, self.tomos_odd):
@@ -211,13 +455,115 @@ class CryoCARE_Dataset(tf.keras.utils.Sequence):
             odd.close()
 
 
+class CryoCARE_PatchPool(object):
+    """Bounded in-memory pool of even/odd training patches, which training samples from instead of the tomograms.
+
+    The pool is filled from ``dataset`` once. Afterwards, :meth:`refresh` replaces ``refresh_fraction`` of the
+    patches with new ones from ``dataset`` in a background thread, so storage is read for only that fraction of the
+    pool per epoch. Patches are drawn from the pool at random and augmented anew every time they are used.
+
+    As the refreshes run in the background, the pool is not checkpointed. A training resumed after ``start`` samples
+    refills the pool with the patches that follow the ones read before and draws from it in a new order, but does
+    not continue with exactly the patches of the interrupted run.
+    """
+
+    def __init__(self, dataset, size, refresh_fraction=0.1, seed=None, start=0):
+        self.dataset = dataset
+        self.size = size
+        self.refresh_fraction = refresh_fraction
+        self.start = start
+        sample_rng, refresh_rng = np.random.SeedSequence(seed, spawn_key=(start,)).spawn(2)
+        self._sample_rng = np.random.default_rng(sample_rng)
+        self._refresh_rng = np.random.default_rng(refresh_rng)
+        self._source = self.__source__()
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        # Patches read from the tomograms and patches handed out since the last call of drain_counts
+        self.n_reads = 0
+        self.n_samples = 0
+        # Samples of the training data drawn before the pool and by the pool, the sampling state of the training data
+        self._n_drawn = dataset.n_drawn()
+
+        shape = (size,) + tuple(int(s) for s in dataset.sample_shape) + (1,)
+        self.even = np.empty(shape, dtype=np.float32)
+        self.odd = np.empty(shape, dtype=np.float32)
+        print('Filling patch pool with {} patches ({:.1f} MB)'.format(size, self.nbytes() / 1024 ** 2))
+        for i in tqdm.trange(size):
+            self.even[i], self.odd[i] = next(self._source)
+        self.n_reads += size
+        self._n_drawn += size
+
+    def __source__(self):
+        while True:
+            yield from self.dataset
+
+    def nbytes(self):
+        return self.even.nbytes + self.odd.nbytes
+
+    def __iter__(self):
+        while True:
+            i = self._sample_rng.integers(self.size)
+            with self._lock:
+                even, odd = self.even[i].copy(), self.odd[i].copy()
+                self.n_samples += 1
+            yield even, odd
+
+    def refresh(self):
+        """Starts replacing ``refresh_fraction`` of the pool in the background, unless the last refresh is still
+        running."""
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        n = int(round(self.size * self.refresh_fraction))
+        if n == 0:
+            return
+        slots = self._refresh_rng.choice(self.size, n, replace=False)
+        self._refresh_thread = threading.Thread(target=self.__replace__, args=(slots,), daemon=True)
+        self._refresh_thread.start()
+
+    def __replace__(self, slots):
+        for i in slots:
+            # Read outside of the lock, so that training does not wait for storage
+            even, odd = next(self._source)
+            with self._lock:
+                self.even[i], self.odd[i] = even, odd
+                self.n_reads += 1
+                self._n_drawn += 1
+
+    def wait(self):
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+
+    def n_drawn(self):
+        """Number of samples of the training data read so far, including the ones before the pool."""
+        with self._lock:
+            return self._n_drawn
+
+    def drain_counts(self):
+        """Returns the number of patches read and handed out since the last call."""
+        with self._lock:
+            counts = self.n_reads, self.n_samples
+            self.n_reads, self.n_samples = 0, 0
+        return counts
+
+
 class CryoCARE_DataModule(object):
     def __init__(self):
         self.train_dataset = None
         self.val_dataset = None
+        self.num_shards = 1
+        self.patch_pool = None
+        # Training samples drawn from the patch pool before a resume
+        self.pool_start = 0
 
     def setup(self, tomo_paths_odd, tomo_paths_even, mask_paths, n_samples_per_tomo = 1200, validation_fraction=0.1,
-              sample_shape=(64, 64, 64), tilt_axis='Y', n_normalization_samples=500):
+              sample_shape=(64, 64, 64), tilt_axis='Y', n_normalization_samples=500, content_sampling=False,
+              content_bin=8, cache_dir=None, online_sampling=False, seed=None):
+        weight_maps = None
+        if content_sampling:
+            weight_maps = [self.get_content_weights(e, o, content_bin,
+                                                    None if cache_dir is None else join(cache_dir, f'content_map_{i}.npz'))
+                           for i, (e, o) in enumerate(zip(tomo_paths_even, tomo_paths_odd))]
+
         train_extraction_shapes = []
         val_extraction_shapes = []
         for e, o in zip(tomo_paths_even, tomo_paths_odd):
@@ -237,7 +583,11 @@ class CryoCARE_DataModule(object):
                                               extraction_shapes=train_extraction_shapes,
                                               sample_shape=sample_shape,
                                               shuffle=True, n_normalization_samples=n_normalization_samples,
-                                              tilt_axis=tilt_axis)
+                                              tilt_axis=tilt_axis,
+                                              weight_maps=weight_maps,
+                                              weight_bin=content_bin,
+                                              online=online_sampling,
+                                              seed=seed)
 
         self.val_dataset = CryoCARE_Dataset(tomo_paths_odd=tomo_paths_odd,
                                             tomo_paths_even=tomo_paths_even,
@@ -248,15 +598,45 @@ class CryoCARE_DataModule(object):
                                             extraction_shapes=val_extraction_shapes,
                                             sample_shape=sample_shape,
                                             shuffle=False,
-                                            tilt_axis=None)
+                                            tilt_axis=None,
+                                            # Uniform, so that validation losses stay comparable with and without
+                                            # content-aware sampling
+                                            weight_maps=None)
 
     def save(self, path):
         self.train_dataset.save(join(path, 'train_data.npz'))
         self.val_dataset.save(join(path, 'val_data.npz'))
 
-    def load(self, path):
-        self.train_dataset = CryoCARE_Dataset.load(join(path, 'train_data.npz'))
-        self.val_dataset = CryoCARE_Dataset.load(join(path, 'val_data.npz'))
+    def load(self, path, convert=True):
+        self.train_dataset = CryoCARE_Dataset.load(join(path, 'train_data.npz'), convert=convert)
+        self.val_dataset = CryoCARE_Dataset.load(join(path, 'val_data.npz'), convert=convert)
+
+    def get_content_weights(self, even_path, odd_path, factor, cache_path=None, uniform_fraction=0.1):
+        """Sampling weights from the content map of an even/odd pair, see ``CryoCAREBinning.content_map``.
+
+        The map is cached in ``cache_path`` and only recomputed if the tomograms or ``factor`` change. A share of
+        ``uniform_fraction`` of the weights is spread uniformly, so that vacuum and ice are still sampled now and
+        then.
+        """
+        mtimes = [os.path.getmtime(even_path), os.path.getmtime(odd_path)]
+        content = None
+        if cache_path is not None and os.path.isfile(cache_path):
+            cached = np.load(cache_path)
+            if str(cached['even']) == even_path and str(cached['odd']) == odd_path and \
+                    int(cached['factor']) == factor and np.array_equal(cached['mtimes'], mtimes):
+                content = cached['content']
+        if content is None:
+            print('Computing content map of {}'.format(even_path))
+            with mrcfile.mmap(even_path, mode='r', permissive=True) as even, \
+                    mrcfile.mmap(odd_path, mode='r', permissive=True) as odd:
+                content = content_map(even.data, odd.data, factor)
+            if cache_path is not None:
+                np.savez(cache_path, content=content, factor=factor, even=even_path, odd=odd_path, mtimes=mtimes)
+
+        weights = np.maximum(content, 0)
+        if weights.mean() == 0:
+            return np.ones_like(weights)
+        return (1 - uniform_fraction) * weights / weights.mean() + uniform_fraction
 
     def __compute_extraction_shapes__(self, even_path, odd_path, tilt_axis_index, sample_shape, validation_fraction):
         even = mrcfile.mmap(even_path, mode='r')
@@ -279,6 +659,50 @@ class CryoCARE_DataModule(object):
 
         return extraction_shape_train, extraction_shape_val
 
+    def set_normalization(self, mean, std):
+        for dataset in [self.train_dataset, self.val_dataset]:
+            dataset.mean = mean
+            dataset.std = std
+
+    def set_sample_shape(self, sample_shape):
+        """Use patches smaller than the extracted ones. The extracted coordinates remain valid for them."""
+        for dataset in [self.train_dataset, self.val_dataset]:
+            assert all(s <= e for s, e in zip(sample_shape, dataset.extracted_sample_shape)), \
+                'Patch shape {} is larger than the extracted patch shape {}.'.format(
+                    list(sample_shape), list(dataset.extracted_sample_shape))
+            dataset.sample_shape = np.array(list(sample_shape))
+
+    def get_state(self, n_samples):
+        """Sampling state after ``n_samples`` training samples, see :meth:`CryoCARE_Dataset.get_state`.
+
+        With a patch pool, the training data is read by the pool independently of the samples used for training.
+        """
+        if self.patch_pool is None:
+            return {'train': self.train_dataset.get_state(n_samples)}
+        return {'train': self.train_dataset.get_state(self.patch_pool.n_drawn()),
+                'pool': {'n_samples': int(n_samples)}}
+
+    def set_state(self, state):
+        self.train_dataset.set_state(state['train'])
+        self.pool_start = state['pool']['n_samples'] if 'pool' in state else 0
+
+    def shard(self, num_shards, index):
+        """Let this worker sample training patches only from its own shard of the training data."""
+        self.num_shards = num_shards
+        self.train_dataset.shard(num_shards, index)
+
+    def use_patch_pool(self, size_mb, refresh_fraction=0.1):
+        """Train from a :class:`CryoCARE_PatchPool` of at most ``size_mb`` instead of reading every patch from disk.
+
+        Has to be called after the sampling state is restored and before the training dataset is created. The pool
+        itself is not restored, see :class:`CryoCARE_PatchPool`.
+        """
+        patch_mb = 2 * int(np.prod(self.train_dataset.sample_shape)) * np.dtype(np.float32).itemsize / 1024 ** 2
+        size = max(1, int(size_mb / patch_mb))
+        self.patch_pool = CryoCARE_PatchPool(self.train_dataset, size, refresh_fraction=refresh_fraction,
+                                             seed=self.train_dataset.seed, start=self.pool_start)
+        return self.patch_pool
+
     def get_normalizer(self, mean, std):
         def normalize(x, y):
             x = (x - mean) / std
@@ -287,21 +711,146 @@ class CryoCARE_DataModule(object):
 
         return normalize
 
-    def get_train_dataset(self):
+    def __disable_auto_shard__(self, ds):
+        import tensorflow as tf
+
+        if self.num_shards == 1:
+            return ds
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return ds.with_options(options)
+
+    def get_augmenter(self, tilt_axis, sample_shape, seed):
+        """Random augmentation of batches of even and odd patches, drawn independently for every sample.
+
+        Patches are rotated by a random multiple of 90 degrees about the tilt axis and flipped along the tilt axis,
+        which keeps the missing wedge in place. Quarter turns need the two other axes to be equally long,
+        otherwise only half turns are used. Finally, even and odd patches are swapped for half of the samples.
+
+        The augmentation of a sample only depends on ``seed`` and the index of the sample in the training stream,
+        which is passed along with the batch, so a resumed training augments every sample as before.
+        """
+        import tensorflow as tf
+
+        # Axes of the batched patches, which have a leading batch and a trailing channel axis
+        tilt = ['Z', 'Y', 'X'].index(tilt_axis) + 1
+        a1, a2 = [a for a in [1, 2, 3] if a != tilt]
+        quarter_turns = sample_shape[a1 - 1] == sample_shape[a2 - 1]
+        perm = [0, 1, 2, 3, 4]
+        perm[a1], perm[a2] = a2, a1
+
+        def select(condition, a, b):
+            return tf.where(tf.reshape(condition, [-1, 1, 1, 1, 1]), a, b)
+
+        seed = tf.constant(seed, dtype=tf.int64)
+
+        def augment(indices, x, y):
+            u = tf.map_fn(lambda i: tf.random.stateless_uniform([3], seed=tf.stack([seed, i])), indices,
+                          fn_output_signature=tf.float32)
+            if quarter_turns:
+                k = tf.cast(u[:, 0] * 4, tf.int32)
+            else:
+                k = 2 * tf.cast(u[:, 0] * 2, tf.int32)
+            flip = u[:, 1] < 0.5
+            swap = u[:, 2] < 0.5
+
+            def transform(v):
+                # Same as np.rot90(v, k, axes=(a1, a2)): transpose for odd k, then flip
+                if quarter_turns:
+                    v = select(k % 2 == 1, tf.transpose(v, perm), v)
+                v = select((k == 1) | (k == 2), tf.reverse(v, [a1]), v)
+                v = select(k >= 2, tf.reverse(v, [a2]), v)
+                return select(flip, tf.reverse(v, [tilt]), v)
+
+            x, y = transform(x), transform(y)
+            return select(swap, y, x), select(swap, x, y)
+
+        return augment
+
+    def get_train_dataset(self, batch_size=None):
+        """The normalized and augmented training patches, endlessly repeated.
+
+        With ``batch_size``, the dataset yields batches, which are normalized and augmented in parallel by
+        TensorFlow. Without, it yields single patches.
+        """
+        import tensorflow as tf
+
+        def repeat():
+            if self.patch_pool is not None:
+                yield from self.patch_pool
+            else:
+                # Repeating inside the generator rather than with Dataset.repeat, which stops at the first pass
+                # without samples, e.g. if an earlier iterator over this dataset just finished the epoch
+                while True:
+                    yield from self.train_dataset
+
         sample_shape = self.train_dataset.sample_shape
-        ds = tf.data.Dataset.from_generator(self.train_dataset.__iter__,
+        ds = tf.data.Dataset.from_generator(repeat,
                                             output_types=(tf.float32, tf.float32),
                                             output_shapes=(
                                                 tuple(sample_shape) + (1,), tuple(sample_shape) + (1,)))
-        return ds.map(self.get_normalizer(self.train_dataset.mean, self.train_dataset.std)).prefetch(tf.data.experimental.AUTOTUNE).repeat()
+        # The generator is already sharded, every worker has to consume its own stream
+        ds = self.__disable_auto_shard__(ds)
+        # Index of every sample in the stream, continuing after the samples drawn before, e.g. of a resumed run
+        ds = ds.enumerate(start=self.train_dataset.n_drawn() if self.patch_pool is None else self.patch_pool.start)
+        normalize = self.get_normalizer(self.train_dataset.mean, self.train_dataset.std)
+        if self.train_dataset.tilt_axis is not None:
+            augment = self.get_augmenter(self.train_dataset.tilt_axis, [int(s) for s in sample_shape],
+                                         self.train_dataset.seed)
+        else:
+            augment = lambda indices, x, y: (x, y)
+
+        if batch_size is None:
+            def transform(i, xy):
+                x, y = augment(i[tf.newaxis], *normalize(xy[0][tf.newaxis], xy[1][tf.newaxis]))
+                return x[0], y[0]
+
+            return ds.map(transform).prefetch(tf.data.experimental.AUTOTUNE)
+
+        return ds.batch(batch_size).map(lambda indices, xy: augment(indices, *normalize(*xy)),
+                                                 num_parallel_calls=tf.data.experimental.AUTOTUNE) \
+            .prefetch(tf.data.experimental.AUTOTUNE)
+
+    def get_val_dataset(self, cache_budget_mb=None, cache_dir=None, transform=None):
+        """Validation data is deterministic, so it is read and normalized once and served from a cache afterwards.
+
+        If the validation set fits into ``cache_budget_mb`` it is kept in memory, otherwise it is cached to a file
+        in ``cache_dir``. Without a budget or if neither applies, the patches are re-read every epoch.
+        ``transform`` is applied to the normalized dataset before caching, e.g. to replace the targets, and has to
+        keep the shape of the patches.
+        """
+        import tensorflow as tf
 
-    def get_val_dataset(self):
         sample_shape = self.val_dataset.sample_shape
         ds = tf.data.Dataset.from_generator(self.val_dataset.__iter__,
                                             output_types=(tf.float32, tf.float32),
                                             output_shapes=(
                                                 tuple(sample_shape) + (1,), tuple(sample_shape) + (1,)))
-        return ds.map(self.get_normalizer(self.train_dataset.mean, self.train_dataset.std))
+        # Every worker validates on the full validation set
+        ds = self.__disable_auto_shard__(ds)
+        ds = ds.map(self.get_normalizer(self.train_dataset.mean, self.train_dataset.std))
+        if transform is not None:
+            ds = transform(ds)
+
+        if cache_budget_mb is None:
+            return ds
+
+        size_mb = self.val_dataset.nbytes() / 1024 ** 2
+        if size_mb <= cache_budget_mb:
+            print('Caching {:.1f} MB of validation data in memory.'.format(size_mb))
+            return ds.cache()
+        elif cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_file = join(cache_dir, 'val_cache')
+            # Never serve patches of a previous run
+            for f in glob(cache_file + '*'):
+                os.remove(f)
+            print('Caching {:.1f} MB of validation data in {}.'.format(size_mb, cache_dir))
+            return ds.cache(cache_file)
+        else:
+            print('Validation data ({:.1f} MB) exceeds the cache budget of {} MB and no cache directory is set. '
+                  'Validation patches are re-read every epoch.'.format(size_mb, cache_budget_mb))
+            return ds
 
     def close(self):
         self.train_dataset.close()
@@ -0,0 +1,131 @@
+import json
+import os
+import platform
+from glob import glob
+
+CPU_PROFILES_PATH = os.path.join(os.path.expanduser('~'), '.cryocare', 'cpu_profiles.json')
+
+
+def get_gpu_ids(config: dict):
+    """The IDs of the GPUs given by ``gpu_id`` in the config, otherwise of all GPUs found by TensorFlow."""
+    if 'gpu_id' in config:
+        if type(config['gpu_id']) is list:
+            gpu_ids = config['gpu_id']
+            if len(gpu_ids) == 0:
+                raise RuntimeError('ERROR: List of GPU IDs is empty')
+        elif type(config['gpu_id']) is int:
+            gpu_ids = [config['gpu_id']]
+        else:
+            raise RuntimeError('gpu_id in json is neither a list nor an integer')
+    else:
+        import tensorflow as tf
+
+        if len(tf.config.list_physical_devices('GPU')) > 0:
+            gpu_ids = list(range(0,len(tf.config.list_physical_devices('GPU'))))
+        else:
+            print('WARNING: No GPUs found by tensorflow')
+            gpu_ids = []
+    return gpu_ids
+
+
+def set_gpu_id(config: dict):
+    import tensorflow as tf
+
+    gpu_ids = get_gpu_ids(config)
+    
+    #Check GPUs given by IDs exist and set_memory_growth to True
+    physical_devices = []
+    try:
+        for gpu in gpu_ids:
+            print(f'Looking for GPU with ID: {gpu}')
+            physical_devices = physical_devices + [tf.config.list_physical_devices('GPU')[gpu]]
+            print(f'GPU {gpu} successfully found')
+            tf.config.experimental.set_memory_growth(tf.config.list_physical_devices('GPU')[gpu], True)
+    except IndexError:
+        print(f'WARNING: GPU {gpu} not found')
+    
+    if len(physical_devices) > 0:
+        tf.config.set_visible_devices(physical_devices, 'GPU')
+
+
+def _parse_cpulist(cpulist):
+    # Like "0-15,32-47"
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part != '':
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes():
+    """The CPUs of every NUMA node this process may run on, a single node if the topology is unknown."""
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for path in sorted(glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                       key=lambda p: int(os.path.basename(os.path.dirname(p))[4:])):
+        with open(path) as f:
+            cpus = [c for c in _parse_cpulist(f.read()) if c in allowed]
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    return nodes if len(nodes) > 0 else [sorted(allowed)]
+
+
+def load_cpu_profiles(path=CPU_PROFILES_PATH):
+    """The tuned CPU profiles of all hosts, by host name."""
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cpu_profile(profile: dict, path=CPU_PROFILES_PATH):
+    """Stores ``profile`` as the CPU profile of this host."""
+    profiles = load_cpu_profiles(path)
+    profiles[platform.node()] = profile
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(profiles, f, indent=4)
+
+
+def get_cpu_profile(config: dict):
+    """The CPU profile given by ``cpu_profile`` in the config, ``None`` if there is none.
+
+    ``cpu_profile`` is either a profile or ``"auto"`` for the profile that ``--tune-cpu`` stored for this host.
+    """
+    if 'cpu_profile' not in config or config['cpu_profile'] is None:
+        return None
+    if config['cpu_profile'] == 'auto':
+        profiles = load_cpu_profiles()
+        if platform.node() not in profiles:
+            print(f'No tuned CPU profile for {platform.node()} in {CPU_PROFILES_PATH}, run with --tune-cpu first.')
+            return None
+        return profiles[platform.node()]
+    return config['cpu_profile']
+
+
+def set_cpu_profile(profile: dict):
+    """Applies a CPU profile to this process.
+
+    Has to be called before TensorFlow runs any operation, and for ``onednn`` even before it is imported.
+
+    * ``intra_op_threads``, ``inter_op_threads``: sizes of TensorFlow's thread pools.
+    * ``onednn``: whether TensorFlow uses the oneDNN kernels.
+    * ``numa_node``: pin the process to the CPUs of this NUMA node.
+    """
+    if profile is None:
+        return
+    if 'onednn' in profile:
+        os.environ['TF_ENABLE_ONEDNN_OPTS'] = '1' if profile['onednn'] else '0'
+    if 'numa_node' in profile and profile['numa_node'] is not None:
+        nodes = numa_nodes()
+        os.sched_setaffinity(0, nodes[profile['numa_node'] % len(nodes)])
+
+    import tensorflow as tf
+
+    if 'intra_op_threads' in profile:
+        tf.config.threading.set_intra_op_parallelism_threads(profile['intra_op_threads'])
+    if 'inter_op_threads' in profile:
+        tf.config.threading.set_inter_op_parallelism_threads(profile['inter_op_threads'])
@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def get_distillation_dataset(dataset, teacher_model, batch_size):
+    """Replaces the targets of ``dataset`` by the predictions of ``teacher_model``.
+
+    The teacher runs eagerly on whole batches, so it is placed on the GPU rather than inside the tf.data
+    pipeline. A dataset of single patches is batched with ``batch_size`` for the teacher and unbatched again,
+    an already batched dataset stays batched.
+    """
+    x_spec, _ = dataset.element_spec
+    batched = len(x_spec.shape) == 5
+    patch_shape = tuple(x_spec.shape)[1:] if batched else tuple(x_spec.shape)
+
+    def generator():
+        for x, _ in (dataset if batched else dataset.batch(batch_size)):
+            yield x, teacher_model(x, training=False)
+
+    ds = tf.data.Dataset.from_generator(generator,
+                                        output_types=(tf.float32, tf.float32),
+                                        output_shapes=((None,) + patch_shape, (None,) + patch_shape))
+    if not batched:
+        ds = ds.unbatch()
+    return ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def measure_inference_time(keras_model, patch_shape, batch_size=1, n_repeats=10):
+    """Mean time in seconds to predict a batch of ``batch_size`` patches of ``patch_shape``."""
+    x = np.random.normal(size=(batch_size,) + tuple(patch_shape) + (1,)).astype(np.float32)
+    keras_model.predict_on_batch(x)
+    t0 = time.perf_counter()
+    for _ in range(n_repeats):
+        keras_model.predict_on_batch(x)
+    return (time.perf_counter() - t0) / n_repeats
+
+
+def measure_fidelity(student_model, teacher_model, val_dataset, batch_size):
+    """MSE and PSNR of the student predictions against the teacher predictions on the validation patches.
+
+    The PSNR uses the value range of the teacher predictions.
+    """
+    squared_errors, n_voxels = 0.0, 0
+    t_min, t_max = np.inf, -np.inf
+    for x, _ in val_dataset.batch(batch_size):
+        t = teacher_model.predict_on_batch(x)
+        s = student_model.predict_on_batch(x)
+        squared_errors += float(np.sum((s - t) ** 2))
+        n_voxels += t.size
+        t_min, t_max = min(t_min, float(t.min())), max(t_max, float(t.max()))
+    mse = squared_errors / n_voxels
+    return {'mse': mse, 'psnr': float(10 * np.log10((t_max - t_min) ** 2 / mse))}
@@ -0,0 +1,126 @@
+"""Leases on files of a shared filesystem, so that several processes, also on different machines, can share work.
+
+A lease is a file created with ``O_CREAT | O_EXCL``, which succeeds for exactly one process. Its owner renews it
+by touching the file. A lease whose file was not touched for ``ttl`` seconds is expired and can be taken over,
+e.g. after its owner crashed. The clocks of the machines have to agree to well within ``ttl``.
+"""
+import contextlib
+import json
+import os
+import platform
+import threading
+import time
+import uuid
+
+
+def new_owner():
+    """A name for this process that is unique across machines."""
+    return f'{platform.node()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class Lease(object):
+    def __init__(self, path, owner, ttl=300):
+        self.path = path
+        self.owner = owner
+        self.ttl = ttl
+        # Set if another process took over the lease while we held it
+        self.lost = False
+
+    def acquire(self):
+        """Takes the lease if it is free or expired. Returns whether this process holds it now."""
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            seen = self.__observe__(self.path)
+            if seen is None or time.time() - seen[2] / 1e9 <= self.ttl:
+                return False
+            # Only one process succeeds in moving the lease out of the way. By then, it need not be the expired one
+            # anymore: it may have been renewed, or another process took over first and created a new lease.
+            stale = f'{self.path}.{self.owner}.stale'
+            try:
+                os.rename(self.path, stale)
+            except FileNotFoundError:
+                return False
+            if self.__observe__(stale) != seen:
+                # Put it back, unless yet another lease was created in the meantime
+                try:
+                    os.link(stale, self.path)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            print(f'Took over expired lease {os.path.basename(self.path)}')
+            return self.acquire()
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': self.owner, 'host': platform.node(), 'pid': os.getpid()}, f)
+        self.lost = False
+        return True
+
+    @staticmethod
+    def __observe__(path):
+        """Owner, inode and modification time of the lease file ``path``, or ``None`` if there is none."""
+        try:
+            stat = os.stat(path)
+            with open(path) as f:
+                owner = json.load(f)['owner']
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Its creator is just writing it
+            owner = None
+        return owner, stat.st_ino, stat.st_mtime_ns
+
+    def owned(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)['owner'] == self.owner
+        except (FileNotFoundError, ValueError):
+            # Missing, or another process is just writing it
+            return False
+
+    def renew(self):
+        """Extends the lease by another ``ttl``. Returns ``False`` if it was lost to another process."""
+        if not self.owned():
+            self.lost = True
+            return False
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            # Moved away by a process taking over the lease, which it only does after we failed to renew in time
+            self.lost = True
+            return False
+        return True
+
+    def release(self):
+        if self.owned():
+            os.remove(self.path)
+
+    @contextlib.contextmanager
+    def kept_alive(self):
+        """Renews the lease in the background while the block runs and releases it afterwards."""
+        stop = threading.Event()
+
+        def renew_loop():
+            while not stop.wait(self.ttl / 3):
+                if not self.renew():
+                    return
+
+        thread = threading.Thread(target=renew_loop, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+            self.release()
+
+
+def wait_for(path, lease, poll=5):
+    """Waits until the file ``path`` exists or ``lease`` can be acquired, e.g. to let exactly one process create
+    a shared file. Returns whether the lease was acquired, in which case the caller has to create ``path``."""
+    while not os.path.exists(path):
+        if lease.acquire():
+            return True
+        time.sleep(poll)
+    return False
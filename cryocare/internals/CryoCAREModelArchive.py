@@ -0,0 +1,43 @@
+import json
+import os
+import pickle
+import tarfile
+from os.path import join
+
+
+def extract_model_archive(path, target_dir):
+    """Extracts a model archive written by ``cryoCARE_train.py`` into ``target_dir``.
+
+    Returns the model name and the normalization parameters stored with the model.
+    """
+    with tarfile.open(path, "r:gz") as tar:
+        tar.extractall(target_dir)
+    model_name = os.listdir(target_dir)[0]
+    with open(join(target_dir, model_name, "norm.json")) as f:
+        norm = json.load(f)
+    return model_name, norm
+
+
+def write_model_archive(basedir, model_name):
+    """Packs the model directory ``basedir/model_name`` into ``basedir/model_name.tar.gz``, without checkpoints."""
+    with tarfile.open(join(basedir, f"{model_name}.tar.gz"), "w:gz") as tar:
+        tar.add(join(basedir, model_name), arcname=model_name,
+                filter=lambda info: None if 'checkpoint' in info.name.split('/') else info)
+
+
+def load_model_config(model_dir):
+    with open(join(model_dir, 'config.json')) as f:
+        return json.load(f)
+
+
+def load_history(model_dir):
+    with open(join(model_dir, 'history.dat'), 'rb') as f:
+        return pickle.load(f)
+
+
+def find_weights(model_dir):
+    """Returns the best weights of a trained model, or the last ones if no best weights were kept."""
+    for name in ['weights_best.h5', 'weights_last.h5']:
+        if os.path.isfile(join(model_dir, name)):
+            return join(model_dir, name)
+    raise FileNotFoundError(f'No weights found in {model_dir}')
@@ -0,0 +1,140 @@
+"""Particle coordinates and the boxes around them, for denoising only the parts of a tomogram that are needed.
+
+Only depends on NumPy.
+"""
+import csv
+import os
+
+import numpy as np
+
+STAR_COLUMNS = ['_rlnCoordinateX', '_rlnCoordinateY', '_rlnCoordinateZ']
+
+
+def _read_star(path):
+    columns = []
+    rows = []
+    in_loop = False
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('loop_'):
+                columns, rows, in_loop = [], [], True
+            elif line.startswith('_') and in_loop:
+                columns.append(line.split()[0])
+            elif line.startswith('data_'):
+                if all(c in columns for c in STAR_COLUMNS):
+                    break
+                in_loop = False
+            elif in_loop and line != '' and not line.startswith('#'):
+                rows.append(line.split())
+    if not all(c in columns for c in STAR_COLUMNS):
+        raise ValueError(f'{path} has no {", ".join(STAR_COLUMNS)} columns.')
+    idx = [columns.index(c) for c in STAR_COLUMNS]
+    return np.array([[float(row[i]) for i in idx] for row in rows]).reshape(-1, 3), None
+
+
+def _read_table(path):
+    with open(path, newline='') as f:
+        lines = [line for line in f if line.strip() != '' and not line.startswith('#')]
+    delimiter = ',' if ',' in lines[0] else None
+    rows = list(csv.reader(lines)) if delimiter == ',' else [line.split() for line in lines]
+    rows = [[v.strip() for v in row] for row in rows]
+    try:
+        float(rows[0][0])
+        header = None
+    except ValueError:
+        header, rows = [v.lower() for v in rows[0]], rows[1:]
+
+    if header is None:
+        xyz = [0, 1, 2]
+        box = 3 if len(rows) > 0 and len(rows[0]) > 3 else None
+    else:
+        if not all(c in header for c in ['x', 'y', 'z']):
+            raise ValueError(f'{path} needs the columns x, y and z.')
+        xyz = [header.index(c) for c in ['x', 'y', 'z']]
+        box = [header.index(c) for c in ['box', 'box_size'] if c in header]
+        box = box[0] if len(box) > 0 else None
+    coords = np.array([[float(row[i]) for i in xyz] for row in rows]).reshape(-1, 3)
+    box_sizes = None if box is None else np.array([int(float(row[box])) for row in rows])
+    return coords, box_sizes
+
+
+def read_coordinates(path):
+    """Reads particle coordinates in voxels from a STAR file or a CSV or whitespace separated text file.
+
+    Text files have the columns ``x``, ``y``, ``z`` and optionally ``box`` (or ``box_size``), either named in a
+    header or in this order. Returns the coordinates in X, Y, Z order and the box sizes, ``None`` if the file has
+    none.
+    """
+    if os.path.splitext(path)[1].lower() == '.star':
+        return _read_star(path)
+    return _read_table(path)
+
+
+def find_coordinates(coordinates, even):
+    """The coordinate file for the tomogram ``even``: ``coordinates`` itself, or if it is a directory, the file in it
+    that is named like ``even``."""
+    if not os.path.isdir(coordinates):
+        return coordinates
+    stem = os.path.splitext(os.path.basename(even))[0]
+    for ext in ['.star', '.csv', '.txt', '.coords']:
+        if os.path.isfile(os.path.join(coordinates, stem + ext)):
+            return os.path.join(coordinates, stem + ext)
+    raise FileNotFoundError(f'No coordinates for {even} in {coordinates}.')
+
+
+def pick_boxes(coords, box_sizes, shape):
+    """The boxes around ``coords`` (X, Y, Z) as ``(start, stop)`` arrays in Z, Y, X order, clipped to ``shape``.
+
+    Boxes of picks outside of the tomogram are empty.
+    """
+    centers = np.round(coords[:, ::-1]).astype(int)
+    box_sizes = np.asarray(box_sizes).reshape(-1, 1)
+    start = np.clip(centers - box_sizes // 2, 0, shape)
+    stop = np.clip(centers - box_sizes // 2 + box_sizes, 0, shape)
+    return start, stop
+
+
+def merge_boxes(start, stop, margin, max_size=256):
+    """Merges boxes into regions that are cheaper to denoise together than one by one.
+
+    Every box is denoised with ``margin`` voxels of context on each side. Two regions are merged if their bounding
+    box, with margin, has no more voxels than both of them with margin and is at most ``max_size`` along every
+    axis. Returns the start and stop of the regions and for every box the index of its region. Empty boxes are
+    left out.
+    """
+    margin = np.asarray(margin)
+    keep = np.all(stop > start, axis=1)
+    lo, hi = start[keep].copy(), stop[keep].copy()
+    members = [[i] for i in np.flatnonzero(keep)]
+    alive = np.ones(len(lo), dtype=bool)
+
+    def volume(a, b):
+        return np.prod(b - a + 2 * margin, axis=-1)
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(lo)):
+            while alive[i]:
+                others = np.flatnonzero(alive)
+                others = others[others != i]
+                if len(others) == 0:
+                    break
+                ulo = np.minimum(lo[i], lo[others])
+                uhi = np.maximum(hi[i], hi[others])
+                cheaper = (volume(ulo, uhi) <= volume(lo[i], hi[i]) + volume(lo[others], hi[others])) & \
+                          np.all(uhi - ulo <= max_size, axis=1)
+                if not cheaper.any():
+                    break
+                j = others[np.argmax(cheaper)]
+                lo[i], hi[i] = np.minimum(lo[i], lo[j]), np.maximum(hi[i], hi[j])
+                members[i] += members[j]
+                alive[j] = False
+                merged = True
+
+    regions = np.flatnonzero(alive)
+    region_of = np.full(len(start), -1)
+    for r, i in enumerate(regions):
+        region_of[members[i]] = r
+    return lo[regions], hi[regions], region_of
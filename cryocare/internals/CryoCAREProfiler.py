@@ -0,0 +1,124 @@
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+import psutil
+
+
+class Profiler(object):
+    """Records the wall clock time and memory of named stages.
+
+    Stages can be nested. Every stage records the resident memory of the process at its end and the peak resident
+    memory of the process so far. Events are tagged with the tomogram currently processed, which allows a summary
+    per tomogram. The events can be exported as JSON or in the Chrome trace format (``chrome://tracing``).
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+        self.tomogram = None
+        self._process = psutil.Process()
+        self._t0 = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.events.append({
+                'name': name,
+                'tomogram': self.tomogram,
+                'start': start - self._t0,
+                'duration': end - start,
+                'rss_mb': self._process.memory_info().rss / 1024 ** 2,
+                # ru_maxrss is in kB on Linux
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                'thread': threading.get_ident(),
+                'args': args
+            })
+
+    def totals(self, tomogram=None):
+        """Total time and number of calls per stage, optionally only for one tomogram."""
+        totals = {}
+        for e in self.events:
+            if tomogram is not None and e['tomogram'] != tomogram:
+                continue
+            t = totals.setdefault(e['name'], {'seconds': 0.0, 'calls': 0})
+            t['seconds'] += e['duration']
+            t['calls'] += 1
+        return totals
+
+    def summary_line(self, tomogram):
+        events = [e for e in self.events if e['tomogram'] == tomogram]
+        if len(events) == 0:
+            return f'{tomogram}: no stages recorded'
+        stages = ' | '.join('{} {:.2f}s'.format(name, t['seconds']) + (' ({}x)'.format(t['calls']) if t['calls'] > 1 else '')
+                            for name, t in self.totals(tomogram).items())
+        peak = max(e['peak_rss_mb'] for e in events)
+        return f'{tomogram}: {stages} | peak RSS {peak:.0f} MB'
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'events': self.events, 'totals': self.totals()}, f, indent=4)
+
+    def write_chrome_trace(self, path):
+        pid = os.getpid()
+        trace = [{
+            'name': e['name'],
+            'ph': 'X',
+            'ts': e['start'] * 1e6,
+            'dur': e['duration'] * 1e6,
+            'pid': pid,
+            'tid': e['thread'],
+            'args': dict(e['args'], tomogram=e['tomogram'], rss_mb=e['rss_mb'], peak_rss_mb=e['peak_rss_mb'])
+        } for e in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+class PeakRSS(object):
+    """Samples the resident memory of this process in the background to find its peak within a block."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self._process = psutil.Process()
+        self.peak = self._process.memory_info().rss
+        self._thread = threading.Thread(target=self.__sample__, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+    def __sample__(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._process.memory_info().rss)
+
+    @property
+    def peak_mb(self):
+        return self.peak / 1024 ** 2
+
+
+class NullProfiler(object):
+    """Stand-in for :class:`Profiler` if profiling is switched off."""
+
+    enabled = False
+    tomogram = None
+
+    def stage(self, name, **args):
+        return contextlib.nullcontext()
+
+
+NO_PROFILER = NullProfiler()
@@ -4,6 +4,10 @@ import json
 import warnings
 import os
 import sys
+import mrcfile
+import numpy as np
+from cryocare.internals.CryoCAREBinning import write_binned
+from cryocare.internals.CryoCAREConfig import check_train_data_config
 from cryocare.internals.CryoCAREDataModule import CryoCARE_DataModule
 
 
@@ -15,19 +19,31 @@ def custom_formatwarning(msg, *args, **kwargs):
 warnings.formatwarning = custom_formatwarning
 
 
+def print_check(config, errors):
+    if len(errors) == 0:
+        for even, odd in zip(config['even'], config['odd']):
+            with mrcfile.mmap(even, mode='r', permissive=True) as mrc:
+                shape = mrc.data.shape
+            print(f'{even} + {odd} {shape}: {config["num_slices"]} patches of {config["patch_shape"]}')
+        print(f"{config['split']:.0%} training, {1 - config['split']:.0%} validation -> {config['path']}")
+    else:
+        print('\n'.join(errors))
+    sys.exit(0 if len(errors) == 0 else 1)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Load training data generation config.')
     parser.add_argument('--conf')
+    parser.add_argument('--check', action='store_true',
+                        help='Only check the config and list the tomograms to extract from.')
 
     args = parser.parse_args()
     with open(args.conf, 'r') as f:
         config = json.load(f)
 
-    dm = CryoCARE_DataModule()
-    dm.setup(config['odd'], config['even'], mask_paths=config['mask'] if 'mask' in config else None, n_samples_per_tomo=config['num_slices'],
-                             validation_fraction=(1.0 - config['split']), sample_shape=config['patch_shape'],
-                             tilt_axis=config['tilt_axis'], n_normalization_samples=config['n_normalization_samples'])
-    
+    if args.check:
+        print_check(config, check_train_data_config(config))
+
     try:
         os.makedirs(config['path'])
     except OSError:
@@ -36,6 +52,33 @@ def main():
         else:
             print("Output directory already exists. Please choose a new output directory or set 'overwrite' to 'true' in your configuration file.")
             sys.exit(1)
+
+    if 'bin' in config and config['bin'] > 1:
+        # Train on binned copies of the tomograms, for quick-look predictions at the same binning
+        binned_dir = os.path.join(config['path'], f"bin{config['bin']}")
+        os.makedirs(binned_dir, exist_ok=True)
+        for key in ['even', 'odd'] + (['mask'] if 'mask' in config else []):
+            binned = []
+            for i, p in enumerate(config[key]):
+                binned.append(os.path.join(binned_dir, f'{key}_{i}_' + os.path.basename(p)))
+                print(f'Binning {p} by {config["bin"]}')
+                write_binned(p, binned[-1], config['bin'])
+            config[key] = binned
+        if 'mask' in config:
+            # Averaging turns the mask into fractions, keep the blocks that were mostly inside
+            for p in config['mask']:
+                with mrcfile.open(p, mode='r+') as mrc:
+                    mrc.set_data((mrc.data > 0.5).astype(np.int8))
+
+    dm = CryoCARE_DataModule()
+    dm.setup(config['odd'], config['even'], mask_paths=config['mask'] if 'mask' in config else None, n_samples_per_tomo=config['num_slices'],
+                             validation_fraction=(1.0 - config['split']), sample_shape=config['patch_shape'],
+                             tilt_axis=config['tilt_axis'], n_normalization_samples=config['n_normalization_samples'],
+                             content_sampling=config['content_sampling'] if 'content_sampling' in config else False,
+                             content_bin=config['content_bin'] if 'content_bin' in config else 8,
+                             cache_dir=config['path'],
+                             online_sampling=config['online_sampling'] if 'online_sampling' in config else False,
+                             seed=config['seed'] if 'seed' in config else None)
             
     dm.save(config['path'])
 
@@ -3,94 +3,197 @@ import argparse
 import json
 from os.path import join
 import os
-import tarfile
 import tempfile
 import datetime
 import mrcfile
 import numpy as np
 import sys
-import tensorflow as tf
-from typing import Tuple
-
-from cryocare.internals.CryoCARE import CryoCARE
+import multiprocessing
+import hashlib
+import time
+
+from cryocare.internals.CryoCAREBinning import read_binned
+from cryocare.internals.CryoCAREPicks import read_coordinates, find_coordinates, pick_boxes, merge_boxes
+from cryocare.internals.CryoCAREBatch import get_input_pairs, check_pairs, file_sha256, is_up_to_date, \
+    provenance, write_provenance, largest_first, sweep_output_path
+from cryocare.internals.CryoCAREConfig import check_predict_config
 from cryocare.internals.CryoCAREDataModule import CryoCARE_DataModule
-
-import psutil
-
-def set_gpu_id(config: dict):
-    if 'gpu_id' in config:
-        if type(config['gpu_id']) is list:
-            gpu_ids = config['gpu_id']
-            if len(gpu_ids) == 0:
-                raise RuntimeError('ERROR: List of GPU IDs is empty')
-        elif type(config['gpu_id']) is int:
-            gpu_ids = [config['gpu_id']]
+from cryocare.internals.CryoCARELease import Lease, new_owner, wait_for
+from cryocare.internals.CryoCAREDevice import set_gpu_id, get_gpu_ids, get_cpu_profile, set_cpu_profile, numa_nodes
+from cryocare.internals.CryoCAREModelArchive import extract_model_archive
+from cryocare.internals.CryoCAREProfiler import Profiler, NO_PROFILER
+
+
+def denoise(config: dict, mean: float, std: float, even: str, odd: str, output_file: str, profiler=NO_PROFILER,
+            bin_factor: int = 1, slab: tuple = None):
+    """Denoises the pair ``even``/``odd`` into ``output_file``.
+
+    With ``slab = (index, n_slabs)``, only that Z slab is denoised into an existing output, see
+    :func:`create_output`. The slab is denoised in memory and written with :func:`write_slab`.
+    """
+    # Importing the model pulls in TensorFlow, which --check does not need
+    from cryocare.internals.CryoCARE import CryoCARE, slab_region
+
+    with profiler.stage('model_build'):
+        model = CryoCARE(None, config['model_name'], basedir=config['path'])
+
+    with profiler.stage('open_inputs'):
+        even = mrcfile.mmap(even, mode='r', permissive=True)
+        odd = mrcfile.mmap(odd, mode='r', permissive=True)
+    if bin_factor > 1:
+        with profiler.stage('bin'):
+            even_vol = read_binned(even.data, bin_factor)
+            odd_vol = read_binned(odd.data, bin_factor)
+    else:
+        even_vol = even.data
+        odd_vol = odd.data
+
+    with profiler.stage('open_output'):
+        if slab is None:
+            mrc = mrcfile.new_mmap(output_file, even_vol.shape, mrc_mode=2, overwrite=True)
+            region = None
+            output = mrc.data
         else:
-            raise RuntimeError('gpu_id in json is neither a list nor an integer')
+            region = slab_region(even_vol.shape, slab[0], slab[1], model._axes_div_by('ZYX')[0])
+            output = None if region is None else np.empty(tuple(r.stop - r.start for r in region), dtype=np.float32)
+
+    if output is not None:
+        with profiler.stage('predict'):
+            model.predict(even_vol, odd_vol, output, axes='ZYX', mean=mean, std=std, n_tiles=config['n_tiles'],
+                          region=region, profiler=profiler)
+
+    if slab is None:
+        with profiler.stage('copy_header'):
+            copy_header(mrc, even, bin_factor)
+        mrc.close()
+    elif output is not None:
+        with profiler.stage('write_slab'):
+            write_slab(output_file, output, region[0].start)
+
+
+def denoise_coordinates(config: dict, mean: float, std: float, even: str, odd: str, output_file: str,
+                        profiler=NO_PROFILER, bin_factor: int = 1):
+    """Denoises only boxes around the particles in the coordinate file for ``even``, see ``coordinates``.
+
+    Overlapping and nearby boxes are merged into regions that are denoised together. With ``coordinate_output``
+    ``"stack"`` (default), ``output_file`` is a stack with one box per particle, listed in a CSV file next to it.
+    With ``"sparse"``, it is a tomogram which is zero outside of the boxes.
+    """
+    from cryocare.internals.CryoCARE import CryoCARE
+
+    with profiler.stage('model_build'):
+        model = CryoCARE(None, config['model_name'], basedir=config['path'])
+
+    with profiler.stage('open_inputs'):
+        coordinates = find_coordinates(config['coordinates'], even)
+        name = os.path.basename(even)
+        even = mrcfile.mmap(even, mode='r', permissive=True)
+        odd = mrcfile.mmap(odd, mode='r', permissive=True)
+    if bin_factor > 1:
+        with profiler.stage('bin'):
+            even_vol = read_binned(even.data, bin_factor)
+            odd_vol = read_binned(odd.data, bin_factor)
     else:
-        if len(tf.config.list_physical_devices('GPU')) > 0:
-            gpu_ids = list(range(0,len(tf.config.list_physical_devices('GPU'))))
+        even_vol = even.data
+        odd_vol = odd.data
+
+    stack = 'coordinate_output' not in config or config['coordinate_output'] == 'stack'
+    with profiler.stage('read_coordinates'):
+        coords, box_sizes = read_coordinates(coordinates)
+        if 'box_size' in config and (box_sizes is None or stack):
+            box_sizes = np.full(len(coords), config['box_size'])
+        elif box_sizes is None:
+            raise ValueError(f'{coordinates} has no box sizes, set "box_size".')
+        elif stack and len(coords) > 0:
+            # A stack needs boxes of the same size
+            box_sizes = np.full(len(coords), box_sizes.max())
+        coords = coords / bin_factor
+        box_sizes = np.maximum(box_sizes // bin_factor, 1)
+        start, stop = pick_boxes(coords, box_sizes, even_vol.shape)
+        lo, hi, region_of = merge_boxes(start, stop, model._axes_tile_overlap('ZYX'))
+    regions = [tuple(slice(int(a), int(b)) for a, b in zip(l, h)) for l, h in zip(lo, hi)]
+    n_voxels = sum(int(np.prod(h - l)) for l, h in zip(lo, hi))
+    print(f'{len(coords)} particles in {len(regions)} regions, {n_voxels / np.prod(even_vol.shape):.2%} of '
+          f'{name}')
+
+    with profiler.stage('open_output'):
+        if stack:
+            box = int(box_sizes.max()) if len(box_sizes) > 0 else 1
+            mrc = mrcfile.new_mmap(output_file, (len(coords), box, box, box), mrc_mode=2, overwrite=True)
         else:
-            print('WARNING: No GPUs found by tensorflow')
-    
-    #Check GPUs given by IDs exist and set_memory_growth to True
-    physical_devices = []
-    try:
-        for gpu in gpu_ids:
-            print(f'Looking for GPU with ID: {gpu}')
-            physical_devices = physical_devices + [tf.config.list_physical_devices('GPU')[gpu]]
-            print(f'GPU {gpu} successfully found')
-            tf.config.experimental.set_memory_growth(tf.config.list_physical_devices('GPU')[gpu], True)
-    except IndexError:
-        print(f'WARNING: GPU {gpu} not found')
-    
-    if len(physical_devices) > 0:
-        tf.config.set_visible_devices(physical_devices, 'GPU') 
-
-def pad(volume: np.array, div_by: Tuple) -> np.array:
-    pads = []
-    for axis_index, axis_size in enumerate(volume.shape):
-        pad_by = axis_size%div_by[axis_index]
-        pads.append([0,pad_by])
-    volume_padded = np.pad(volume, pads, mode='mean')
-
-    return volume_padded
-
-
-
-def denoise(config: dict, mean: float, std: float, even: str, odd: str, output_file: str):
-    model = CryoCARE(None, config['model_name'], basedir=config['path'])
-
-    even = mrcfile.mmap(even, mode='r', permissive=True)
-    odd = mrcfile.mmap(odd, mode='r', permissive=True)
-    shape_before_pad = even.data.shape
-    even_vol = even.data
-    odd_vol = odd.data
-    even_vol = even_vol
-    odd_vol = odd_vol
-
-    div_by = model._axes_div_by('XYZ')
-
-    even_vol = pad(even_vol,div_by=div_by)
-    odd_vol = pad(odd_vol, div_by=div_by)
-
-    denoised = np.zeros(even_vol.shape)
-
-    even_vol.shape += (1,)
-    odd_vol.shape += (1,)
-    denoised.shape += (1,)
-
-    model.predict(even_vol, odd_vol, denoised, axes='ZYXC', normalizer=None, mean=mean, std=std,
-                  n_tiles=config['n_tiles'] + [1, ])
-
-    denoised = denoised[slice(0, shape_before_pad[0]), slice(0, shape_before_pad[1]), slice(0, shape_before_pad[2])]
-    mrc = mrcfile.new_mmap(output_file, denoised.shape, mrc_mode=2, overwrite=True)
-    mrc.data[:] = denoised
-
+            mrc = mrcfile.new_mmap(output_file, even_vol.shape, mrc_mode=2, overwrite=True)
+
+    index = {tuple((r.start, r.stop) for r in region): i for i, region in enumerate(regions)}
+    with profiler.stage('predict'):
+        for region, denoised in model.predict_regions(even_vol, odd_vol, regions, mean=mean, std=std,
+                                                      batch_size=config['batch_size'] if 'batch_size' in config else 8,
+                                                      profiler=profiler):
+            with profiler.stage('reassemble'):
+                if not stack:
+                    mrc.data[region] = denoised
+                    continue
+                offset = np.array([r.start for r in region])
+                for p in np.flatnonzero(region_of == index[tuple((r.start, r.stop) for r in region)]):
+                    # The box of the particle in the stack entry, which is cut off at the tomogram borders
+                    box_start = np.round(coords[p, ::-1]).astype(int) - box // 2
+                    src = tuple(slice(a - o, b - o) for a, b, o in zip(start[p], stop[p], offset))
+                    dst = tuple(slice(a - s0, b - s0) for a, b, s0 in zip(start[p], stop[p], box_start))
+                    mrc.data[(p,) + dst] = denoised[src]
+
+    with profiler.stage('copy_header'):
+        voxel_size = even.voxel_size
+        mrc.voxel_size = (voxel_size.x * bin_factor, voxel_size.y * bin_factor, voxel_size.z * bin_factor)
+        mrc.close()
+    if stack:
+        with open(os.path.splitext(output_file)[0] + '_particles.csv', 'w') as f:
+            f.write('index,x,y,z,box\n')
+            for p, (x, y, z) in enumerate(coords):
+                f.write(f'{p},{x:g},{y:g},{z:g},{box}\n')
+
+
+def denoise_pair(config: dict, mean: float, std: float, even: str, odd: str, output_file: str, profiler=NO_PROFILER):
+    """Denoises a pair of tomograms as the config asks for: entirely, binned or only around particles."""
+    if 'coordinates' in config:
+        denoise_coordinates(config, mean, std, even=even, odd=odd, output_file=output_file, profiler=profiler,
+                            bin_factor=get_bin_factor(config))
+    else:
+        denoise(config, mean, std, even=even, odd=odd, output_file=output_file, profiler=profiler,
+                bin_factor=get_bin_factor(config))
 
 
+def denoise_sweep(models: list, means: list, stds: list, config: dict, even: str, odd: str, output_files: list,
+                  profiler=NO_PROFILER, bin_factor: int = 1):
+    """Denoises the pair ``even``/``odd`` with every model in ``models`` into the matching ``output_files``.
 
+    The inputs are read and binned only once for all models, see :func:`predict_sweep`.
+    """
+    from cryocare.internals.CryoCARE import predict_sweep
 
+    with profiler.stage('open_inputs'):
+        even = mrcfile.mmap(even, mode='r', permissive=True)
+        odd = mrcfile.mmap(odd, mode='r', permissive=True)
+    if bin_factor > 1:
+        with profiler.stage('bin'):
+            even_vol = read_binned(even.data, bin_factor)
+            odd_vol = read_binned(odd.data, bin_factor)
+    else:
+        even_vol = even.data
+        odd_vol = odd.data
+
+    with profiler.stage('open_output'):
+        mrcs = [mrcfile.new_mmap(output_file, even_vol.shape, mrc_mode=2, overwrite=True)
+                for output_file in output_files]
+    with profiler.stage('predict'):
+        predict_sweep(models, even_vol, odd_vol, [mrc.data for mrc in mrcs], means, stds, n_tiles=config['n_tiles'],
+                      profiler=profiler)
+    with profiler.stage('copy_header'):
+        for mrc in mrcs:
+            copy_header(mrc, even, bin_factor)
+            mrc.close()
+
+
+def copy_header(mrc, even, bin_factor: int = 1):
+    """Copies the header of the ``even`` tomogram to the denoised ``mrc`` and adds a label."""
     for l in even.header.dtype.names:
         if l == 'label':
             new_label = np.concatenate((even.header[l][1:-1], np.array([
@@ -102,56 +205,354 @@ def denoise(config: dict, mean: float, std: float, even: str, odd: str, output_f
         else:
             mrc.header[l] = even.header[l]
     mrc.header['mode'] = 2
+    if bin_factor > 1:
+        # The copied header describes the unbinned input
+        mrc.update_header_from_data()
+        voxel_size = even.voxel_size
+        mrc.voxel_size = (voxel_size.x * bin_factor, voxel_size.y * bin_factor, voxel_size.z * bin_factor)
     mrc.set_extended_header(even.extended_header)
 
+
+def create_output(even: str, output_file: str, bin_factor: int = 1):
+    """Creates the output for denoising ``even`` slab by slab, with the header of ``even``."""
+    with mrcfile.mmap(even, mode='r', permissive=True) as even_mrc:
+        shape = tuple(s // bin_factor for s in even_mrc.data.shape)
+        with mrcfile.new_mmap(output_file, shape, mrc_mode=2, overwrite=True) as mrc:
+            copy_header(mrc, even_mrc, bin_factor)
+
+
+def write_slab(output_file: str, slab, z_start: int):
+    """Writes the Z planes ``slab`` into the output created by :func:`create_output`, starting at plane ``z_start``.
+
+    Other processes write their slabs into the same output at the same time, possibly from other nodes. Instead of
+    a memory map, which writes back whole pages that slabs share at their edges, and rewrites the header on close,
+    only the bytes of the planes of ``slab`` are written. They are synced before returning, so that a done marker
+    written afterwards is only seen once the slab is on storage.
+    """
+    with mrcfile.open(output_file, mode='r', header_only=True, permissive=True) as mrc:
+        offset = mrc.header.nbytes + mrc.extended_header.nbytes
+        dtype = mrcfile.utils.data_dtype_from_header(mrc.header)
+    data = np.ascontiguousarray(slab, dtype=dtype)
+    buffer = memoryview(data).cast('B')
+    position = offset + z_start * data[0].nbytes
+    fd = os.open(output_file, os.O_WRONLY)
+    try:
+        while len(buffer) > 0:
+            n = os.pwrite(fd, buffer, position)
+            buffer = buffer[n:]
+            position += n
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_bin_factor(config: dict):
+    """The binning of a quick-look prediction, 1 for a full resolution prediction."""
+    return config['preview_bin'] if 'preview_bin' in config else 1
+
+
+def get_profiler(config: dict):
+    """A :class:`Profiler` if ``profile`` is set in the config, otherwise a no-op stand-in."""
+    if 'profile' in config and config['profile']:
+        return Profiler()
+    return NO_PROFILER
+
+
+def write_profile(config: dict, profiler):
+    if not profiler.enabled:
+        return
+    profiler.write_json(os.path.join(config['output'], 'profile.json'))
+    if 'profile_trace' in config:
+        profiler.write_chrome_trace(config['profile_trace'])
+
+
+def plan(config: dict):
+    """Pairs and checks the tomograms to denoise and leaves out the ones whose output is up to date.
+
+    Returns the remaining pairs and their shapes, largest first, the number of skipped pairs, the hash of the
+    model and a list of errors.
+    """
+    pairs = get_input_pairs(config)
+    errors, shapes = check_pairs(pairs)
+    if len(errors) > 0:
+        return [], [], 0, None, errors
+    model_sha256 = file_sha256(config['path'])
+    force = 'force' in config and config['force']
+    todo = [i for i, (even, odd, output) in enumerate(pairs) if force or not is_up_to_date(even, odd, output, model_sha256)]
+    n_skipped = len(pairs) - len(todo)
+    pairs, shapes = largest_first([pairs[i] for i in todo], [shapes[i] for i in todo])
+    return pairs, shapes, n_skipped, model_sha256, []
+
+
+def plan_sweep(config: dict):
+    """Like :func:`plan`, for a sweep over the models in ``path``.
+
+    Every pair comes with the output of every model, ``None`` where it is up to date. Returns the hashes of all
+    models.
+    """
+    pairs = get_input_pairs(config)
+    errors, shapes = check_pairs(pairs)
+    if len(errors) > 0:
+        return [], [], 0, None, errors
+    model_sha256 = [file_sha256(path) for path in config['path']]
+    force = 'force' in config and config['force']
+    todo, todo_shapes = [], []
+    for (even, odd, output), shape in zip(pairs, shapes):
+        outputs = [sweep_output_path(output, path) for path in config['path']]
+        outputs = [out if force or not is_up_to_date(even, odd, out, sha) else None
+                   for out, sha in zip(outputs, model_sha256)]
+        if any(out is not None for out in outputs):
+            todo.append((even, odd, outputs))
+            todo_shapes.append(shape)
+    pairs, shapes = largest_first(todo, todo_shapes)
+    return pairs, shapes, len(get_input_pairs(config)) - len(todo), model_sha256, []
+
+
+def sweep(config: dict, pairs: list, model_sha256: list, profiler):
+    """Denoises every pair with all models in ``path``, which are extracted and built only once."""
+    from cryocare.internals.CryoCARE import CryoCARE
+
+    models, means, stds = [], [], []
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for i, path in enumerate(config['path']):
+            model_dir = os.path.join(tmpdirname, str(i))
+            with profiler.stage('extract_model'):
+                model_name, norm_data = extract_model_archive(path, model_dir)
+            with profiler.stage('model_build'):
+                models.append(CryoCARE(None, model_name, basedir=model_dir))
+            means.append(norm_data['mean'])
+            stds.append(norm_data['std'])
+
+        for even, odd, outputs in pairs:
+            todo = [i for i, out in enumerate(outputs) if out is not None]
+            for i in todo:
+                os.makedirs(os.path.dirname(os.path.abspath(outputs[i])), exist_ok=True)
+            profiler.tomogram = os.path.basename(even)
+            denoise_sweep([models[i] for i in todo], [means[i] for i in todo], [stds[i] for i in todo], config,
+                          even=even, odd=odd, output_files=[outputs[i] for i in todo], profiler=profiler,
+                          bin_factor=get_bin_factor(config))
+            for i in todo:
+                write_provenance(even, odd, outputs[i], model_sha256[i])
+            print(f'{os.path.basename(even)}: denoised with {len(todo)} models')
+            if profiler.enabled:
+                print(profiler.summary_line(profiler.tomogram))
+
+
+def print_check(config: dict, errors: list):
+    """Prints which tomograms would be denoised with ``config`` and exits, with a non-zero status on errors."""
+    if len(errors) == 0 and type(config['path']) is list:
+        pairs, shapes, n_skipped, _, errors = plan_sweep(config)
+        for (even, odd, outputs), shape in zip(pairs, shapes):
+            print(f'{even} + {odd} {shape} -> {", ".join(out for out in outputs if out is not None)}')
+        if n_skipped > 0:
+            print(f'{n_skipped} tomograms are up to date.')
+    elif len(errors) == 0 and os.path.isfile(config['path']):
+        pairs, shapes, n_skipped, _, errors = plan(config)
+        for (even, odd, output), shape in zip(pairs, shapes):
+            print(f'{even} + {odd} {shape} -> {output}')
+        if n_skipped > 0:
+            print(f'{n_skipped} tomograms are up to date.')
+    if len(errors) == 0 and os.path.exists(config['output']) and not ('overwrite' in config and config['overwrite']) \
+            and not ('cooperative' in config and config['cooperative']):
+        errors = ["Output directory already exists. Please choose a new output directory or set 'overwrite' to 'true' in your configuration file."]
+    if len(errors) > 0:
+        print('\n'.join(errors))
+    sys.exit(0 if len(errors) == 0 else 1)
+
+
+def _init_worker(device_queue, cpu_profile):
+    # Runs before TensorFlow is imported in the worker, so each worker only sees its own GPU
+    gpu, numa_node = device_queue.get()
+    if gpu is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    if cpu_profile is not None:
+        set_cpu_profile(dict(cpu_profile, numa_node=numa_node))
+    set_gpu_id({})
+
+
+def _denoise_task(args):
+    config, mean, std, even, odd, output, model_sha256 = args
+    profiler = get_profiler(config)
+    profiler.tomogram = os.path.basename(even)
+    denoise_pair(config, mean, std, even=even, odd=odd, output_file=output, profiler=profiler)
+    write_provenance(even, odd, output, model_sha256)
+    return even, profiler.events if profiler.enabled else []
+
+
+def denoise_parallel(config: dict, mean: float, std: float, pairs: list, model_sha256: str, workers: int, profiler):
+    """Denoises ``pairs`` in ``workers`` processes, one per GPU if there are enough GPUs.
+
+    The pairs are handed out in the given order, each worker takes the next one as soon as it is done. If the CPU
+    profile pins to a NUMA node, the workers are spread over the NUMA nodes, starting at that node.
+    """
+    gpu_ids = get_gpu_ids(config)
+    if 'CUDA_VISIBLE_DEVICES' in os.environ and len(gpu_ids) > 0:
+        # The IDs are relative to the devices this process can see
+        visible = os.environ['CUDA_VISIBLE_DEVICES'].split(',')
+        gpu_ids = [visible[i] for i in gpu_ids]
+    # A fresh interpreter per worker, TensorFlow does not survive a fork
+    ctx = multiprocessing.get_context('spawn')
+    cpu_profile = get_cpu_profile(config)
+    first_node = cpu_profile['numa_node'] if cpu_profile is not None and 'numa_node' in cpu_profile else None
+    device_queue = ctx.Queue()
+    for i in range(workers):
+        device_queue.put((gpu_ids[i % len(gpu_ids)] if len(gpu_ids) > 0 else None,
+                          None if first_node is None else (first_node + i) % len(numa_nodes())))
+    worker_config = {key: value for key, value in config.items() if key != 'gpu_id'}
+    tasks = [(worker_config, mean, std, even, odd, output, model_sha256) for even, odd, output in pairs]
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(device_queue, cpu_profile)) as pool:
+        for even, events in pool.imap_unordered(_denoise_task, tasks, chunksize=1):
+            print(f'Denoised {even}')
+            if profiler.enabled:
+                profiler.events.extend(events)
+                print(profiler.summary_line(os.path.basename(even)))
+
+
+def denoise_cooperative(config: dict, mean: float, std: float, pairs: list, model_sha256: str, profiler):
+    """Denoises ``pairs`` together with other processes that run with the same inputs and output directory.
+
+    The work is split into units of one Z slab (``slabs`` per tomogram, default 1) each. A process claims a unit
+    through a lease in ``<output>/.cryocare``, renews it while denoising and leaves a done marker. Units of crashed
+    processes are taken over once their lease expires after ``lease_seconds``. Returns once all units are done,
+    waiting for the units other processes are working on.
+    """
+    n_slabs = config['slabs'] if 'slabs' in config else 1
+    ttl = config['lease_seconds'] if 'lease_seconds' in config else 300
+    bin_factor = get_bin_factor(config)
+    lease_dir = join(config['output'], '.cryocare')
+    os.makedirs(lease_dir, exist_ok=True)
+    owner = new_owner()
+
+    def unit_path(output, key, suffix):
+        return join(lease_dir, f'{os.path.basename(output)}.{key}.{suffix}')
+
+    while True:
+        pending = False
+        for even, odd, output in pairs:
+            # Outputs of a manifest can have the same name in different directories. With the inputs and the model,
+            # markers of an earlier run do not count once an input has changed.
+            key = hashlib.sha1(json.dumps([os.path.abspath(output), provenance(even, odd, model_sha256)],
+                                          sort_keys=True).encode()).hexdigest()[:16]
+            for i in range(n_slabs):
+                done = unit_path(output, key, f'slab{i}of{n_slabs}.done')
+                if os.path.exists(done):
+                    continue
+                lease = Lease(unit_path(output, key, f'slab{i}of{n_slabs}.lease'), owner, ttl)
+                if not lease.acquire():
+                    pending = True
+                    continue
+                with lease.kept_alive():
+                    if os.path.exists(done):
+                        continue
+                    if n_slabs > 1:
+                        # The first process to get here creates the output, the others wait for it
+                        created = unit_path(output, key, 'created')
+                        create_lease = Lease(unit_path(output, key, 'create.lease'), owner, ttl)
+                        if wait_for(created, create_lease):
+                            create_output(even, output, bin_factor)
+                            open(created, 'w').close()
+                            create_lease.release()
+                    profiler.tomogram = os.path.basename(even)
+                    print(f'Denoising {even}' + (f', slab {i + 1} of {n_slabs}' if n_slabs > 1 else ''))
+                    if n_slabs > 1:
+                        denoise(config, mean, std, even=even, odd=odd, output_file=output, profiler=profiler,
+                                bin_factor=bin_factor, slab=(i, n_slabs))
+                    else:
+                        denoise_pair(config, mean, std, even=even, odd=odd, output_file=output, profiler=profiler)
+                    if lease.lost:
+                        print(f'Lost the lease on {os.path.basename(lease.path)}, the unit was done twice.')
+                    open(done, 'w').close()
+                if all(os.path.exists(unit_path(output, key, f'slab{j}of{n_slabs}.done')) for j in range(n_slabs)):
+                    write_provenance(even, odd, output, model_sha256)
+        if not pending:
+            return
+        # Other processes hold the remaining units. Wait until they are done or their leases expire.
+        time.sleep(min(ttl / 3, 30))
+
+
 def main():
     
     parser = argparse.ArgumentParser(description='Run cryoCARE prediction.')
     parser.add_argument('--conf')
+    parser.add_argument('--check', action='store_true',
+                        help='Only check the config and list the tomograms to denoise, without importing TensorFlow.')
+    parser.add_argument('--tune-cpu', action='store_true',
+                        help='Find the fastest CPU settings for this host on a synthetic tomogram and store them.')
 
     args = parser.parse_args()
     with open(args.conf, 'r') as f:
         config = json.load(f)
+    if 'preview_bin' in config and 'preview_model' in config:
+        # A model trained on tomograms with the same binning
+        config['path'] = config['preview_model']
+
+    if args.check:
+        print_check(config, check_predict_config(config))
+
+    if args.tune_cpu:
+        from cryocare.benchmarks.cpu import tune_cpu
+
+        tune_cpu(config['path'][0] if type(config['path']) is list else config['path'], config['n_tiles'],
+                 shape=config['tune_cpu_shape'] if 'tune_cpu_shape' in config else [128, 256, 256])
+        return
+
+    cpu_profile = get_cpu_profile(config)
+    if cpu_profile is not None and 'n_tiles' in cpu_profile:
+        config['n_tiles'] = cpu_profile['n_tiles']
+
+    is_sweep = type(config['path']) is list
+    if is_sweep or os.path.isfile(config['path']):
+        # Everything is checked before the first tomogram is denoised
+        pairs, shapes, n_skipped, model_sha256, errors = plan_sweep(config) if is_sweep else plan(config)
+        if len(errors) > 0:
+            print('\n'.join(errors))
+            sys.exit(1)
+        if n_skipped > 0:
+            print(f'Skipping {n_skipped} tomograms whose output is up to date.')
+        if len(pairs) == 0:
+            return
 
     try:
         os.makedirs(config['output'])
     except OSError:
-        if 'overwrite' in config and config['overwrite']:
+        # Cooperating processes share the output directory
+        if 'overwrite' in config and config['overwrite'] or 'cooperative' in config and config['cooperative']:
             os.makedirs(config['output'], exist_ok=True)
         else:
             print("Output directory already exists. Please choose a new output directory or set 'overwrite' to 'true' in your configuration file.")
             sys.exit(1)
     
-    set_gpu_id(config)
+    workers = config['workers'] if 'workers' in config else 1
+    if workers == 1:
+        set_cpu_profile(cpu_profile)
+        set_gpu_id(config)
+    profiler = get_profiler(config)
     
-    if os.path.isfile(config['path']):
+    if is_sweep:
+        sweep(config, pairs, model_sha256, profiler)
+    elif os.path.isfile(config['path']):
         with tempfile.TemporaryDirectory() as tmpdirname:
-            tar = tarfile.open(config['path'], "r:gz")
-            tar.extractall(tmpdirname)
-            tar.close()
-            config['model_name'] = os.listdir(tmpdirname)[0]
+            with profiler.stage('extract_model'):
+                config['model_name'], norm_data = extract_model_archive(config['path'], tmpdirname)
             config['path'] = os.path.join(tmpdirname)
-            with open(os.path.join(tmpdirname,config['model_name'],"norm.json")) as f:
-                norm_data = json.load(f)
-                mean = norm_data["mean"]
-                std = norm_data["std"]
+            mean = norm_data["mean"]
+            std = norm_data["std"]
 
+            # Outputs given in a manifest can be outside of the output directory
+            for _, _, out_filename in pairs:
+                os.makedirs(os.path.dirname(os.path.abspath(out_filename)), exist_ok=True)
 
-
-            from glob import glob
-            if type(config['even']) is list:
-                all_even=tuple(config['even'])
-                all_odd=tuple(config['odd'])
-            elif os.path.isdir(config['even']) and os.path.isdir(config['odd']):
-                all_even = glob(os.path.join(config['even'],"*.mrc"))
-                all_odd = glob(os.path.join(config['odd'],"*.mrc"))
+            if 'cooperative' in config and config['cooperative']:
+                denoise_cooperative(config, mean, std, pairs, model_sha256, profiler)
+            elif workers > 1:
+                denoise_parallel(config, mean, std, pairs, model_sha256, workers, profiler)
             else:
-                all_even = [config['even']]
-                all_odd = [config['odd']]
-
-            for even,odd in zip(all_even,all_odd):
-                out_filename = os.path.join(config['output'], "denoised_" + os.path.basename(even))
-                denoise(config, mean, std, even=even, odd=odd, output_file=out_filename)
+                for even,odd,out_filename in pairs:
+                    profiler.tomogram = os.path.basename(even)
+                    denoise_pair(config, mean, std, even=even, odd=odd, output_file=out_filename, profiler=profiler)
+                    write_provenance(even, odd, out_filename, model_sha256)
+                    if profiler.enabled:
+                        print(profiler.summary_line(profiler.tomogram))
     else:
         # Fall back to original cryoCARE implmentation
         s = f" {config['path']} is not a file"
@@ -166,7 +567,13 @@ def main():
         dm.load(config['path'])
         mean, std = dm.train_dataset.mean, dm.train_dataset.std
 
-        denoise(config, mean, std, even=config['even'], odd=config['odd'], output_file=join(config['path'], config['output_name']))
+        profiler.tomogram = os.path.basename(config['even'])
+        denoise(config, mean, std, even=config['even'], odd=config['odd'], output_file=join(config['path'], config['output_name']),
+                profiler=profiler)
+        if profiler.enabled:
+            print(profiler.summary_line(profiler.tomogram))
+
+    write_profile(config, profiler)
 
 
 
@@ -1,68 +1,397 @@
 #! python
+from __future__ import annotations
+
 import argparse
 import json
-from cryocare.internals.CryoCARE import CryoCARE
-from csbdeep.models import Config
 import pickle
+import sys
 from os.path import join
+from typing import TYPE_CHECKING
+from cryocare.internals.CryoCAREConfig import check_train_config
 from cryocare.internals.CryoCAREDataModule import CryoCARE_DataModule
-from cryocare.scripts.cryoCARE_predict import set_gpu_id
-import tensorflow as tf
+from cryocare.internals.CryoCAREModelArchive import extract_model_archive, write_model_archive, load_model_config, \
+    load_history, find_weights
+import os
+import tempfile
+
+# TensorFlow, CSBDeep and the model are imported once they are needed, so --help and --check return quickly
+if TYPE_CHECKING:
+    from csbdeep.models import Config
+    from cryocare.internals.CryoCARE import CryoCARE
+
+
+def get_distribution_strategy(config: dict, worker_index: int = None):
+    """Returns the distribution strategy, the number of workers and the index of this worker.
+
+    Without a ``distributed`` entry in the config, training runs on all GPUs of this machine. Otherwise a
+    ``MultiWorkerMirroredStrategy`` is used. The cluster is either given by ``distributed.workers`` (a list of
+    ``host:port``, all workers use the same config and pass their own ``--worker_index``) or, if
+    ``distributed`` is ``true``, by the ``TF_CONFIG`` environment variable.
+    """
+    import tensorflow as tf
+
+    if 'distributed' not in config or not config['distributed']:
+        return tf.distribute.MirroredStrategy(), 1, 0
+
+    distributed = config['distributed']
+    if type(distributed) is dict and 'workers' in distributed:
+        if worker_index is None:
+            worker_index = distributed['index'] if 'index' in distributed else 0
+        os.environ['TF_CONFIG'] = json.dumps({
+            'cluster': {'worker': distributed['workers']},
+            'task': {'type': 'worker', 'index': worker_index}
+        })
+    elif 'TF_CONFIG' not in os.environ:
+        raise RuntimeError('Distributed training requires either a list of workers in the config or the TF_CONFIG environment variable.')
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    resolver = strategy.cluster_resolver
+    num_workers = resolver.cluster_spec().num_tasks('worker')
+    print(f'Worker {resolver.task_id} of {num_workers}')
+    return strategy, num_workers, resolver.task_id
+
 
 def main():
     parser = argparse.ArgumentParser(description='Load training config.')
     parser.add_argument('--conf')
+    parser.add_argument('--worker_index', type=int, default=None,
+                        help='Index of this worker in the list of workers for distributed training.')
+    parser.add_argument('--autotune', action='store_true',
+                        help='Find the batch size and patch shape with the highest throughput and write them to the config.')
+    parser.add_argument('--check', action='store_true',
+                        help='Only check the config and the training data, without importing TensorFlow.')
 
     args = parser.parse_args()
     with open(args.conf, 'r') as f:
         config = json.load(f)
 
+    errors = check_train_config(config)
+    if args.check:
+        print_check(config, errors)
+    if len(errors) > 0:
+        print('\n'.join(errors))
+        sys.exit(1)
+
+    from cryocare.internals.CryoCAREDevice import set_gpu_id, get_cpu_profile, set_cpu_profile
+
+    # Before TensorFlow is imported, which reads the oneDNN setting
+    set_cpu_profile(get_cpu_profile(config))
+
+    from csbdeep.models import Config
+    from cryocare.internals.CryoCARE import CryoCARE
+    from cryocare.internals.CryoCARECallbacks import AsyncCheckpoint, TrainingMetrics, PatchPoolRefresh
+
     set_gpu_id(config)
-    
+
+    strategy, num_workers, worker_index = get_distribution_strategy(config, args.worker_index)
+    is_chief = worker_index == 0
+
     dm = CryoCARE_DataModule()
     dm.load(config['train_data'])
+    if 'base_model' in config and 'base_model_norm' in config and config['base_model_norm'] == 'reuse':
+        # Keep the input distribution the base model was trained on
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            _, norm = extract_model_archive(config['base_model'], tmpdirname)
+        dm.set_normalization(norm['mean'], norm['std'])
+    teacher_dir = None
+    if 'teacher_model' in config:
+        teacher_dir = tempfile.TemporaryDirectory()
+        teacher_name, norm = extract_model_archive(config['teacher_model'], teacher_dir.name)
+        # The student learns the teacher's mapping of normalized inputs, so both share the normalization
+        dm.set_normalization(norm['mean'], norm['std'])
+        teacher = CryoCARE(None, teacher_name, basedir=teacher_dir.name)
+    if num_workers > 1:
+        dm.shard(num_workers, worker_index)
+    if 'patch_shape' in config:
+        dm.set_sample_shape(config['patch_shape'])
 
     net_conf = Config(
         axes='ZYXC',
         train_loss='mse',
-        train_epochs=config['epochs'],
+        train_epochs=config['finetune_epochs'] if 'base_model' in config and 'finetune_epochs' in config else config['epochs'],
         train_steps_per_epoch=config['steps_per_epoch'],
-        train_batch_size=config['batch_size'],
+        train_batch_size=config['batch_size'] * num_workers,
         unet_kern_size=config['unet_kern_size'],
         unet_n_depth=config['unet_n_depth'],
         unet_n_first=config['unet_n_first'],
         train_tensorboard=False,
-        train_learning_rate=config['learning_rate']
+        train_learning_rate=config['finetune_learning_rate'] if 'base_model' in config and 'finetune_learning_rate' in config else config['learning_rate']
     )
+    if 'reduce_lr' in config:
+        net_conf.train_reduce_lr = config['reduce_lr']
     
-    mirrored_strategy = tf.distribute.MirroredStrategy()
+    if args.autotune:
+        run_autotune(args.conf, config, net_conf, dm, strategy)
+        return
+
+    # Only the chief writes the model, the other workers write to a throwaway directory
+    scratch_dir = None if is_chief else tempfile.TemporaryDirectory()
+    basedir = config['path'] if is_chief else scratch_dir.name
+
+    with strategy.scope():
+
+        model = CryoCARE(net_conf, config['model_name'], basedir=basedir)
+
+        if is_chief:
+            # The normalization is known upfront, so even an interrupted run leaves a usable model directory
+            write_norm(dm, join(config['path'], config['model_name']))
+
+        # Written by the chief only, but every worker resumes from it, so all of them start from the same state
+        checkpoint_path = join(config['path'], config['model_name'], 'checkpoint', 'checkpoint.pkl')
+        resume_from = None
+        if 'resume' in config and config['resume']:
+            resume_from = AsyncCheckpoint.load(checkpoint_path)
+            if resume_from is None:
+                print(f'No checkpoint found at {checkpoint_path}, starting from scratch.')
+            else:
+                dm.set_state(resume_from['data'])
+        # Every worker consumes config['batch_size'] samples of its own shard per step
+        checkpoint = AsyncCheckpoint(checkpoint_path, dm, config['batch_size'],
+                                     every_n_epochs=config['checkpoint_every'] if 'checkpoint_every' in config else 1,
+                                     resume_from=resume_from, write=is_chief)
+        if 'base_model' in config:
+            warm_start(model, config['base_model'],
+                       freeze_encoder=config['freeze_encoder'] if 'freeze_encoder' in config else False)
+        model.prepare_for_training()
+        budget_callbacks = get_budget_callbacks(config, net_conf)
+        # The checkpoint restores the state of these callbacks, so they have to come before it
+        checkpoint.callbacks = model.callbacks + budget_callbacks
+        metrics = TrainingMetrics(join(basedir, config['model_name'], 'training_metrics.json'), dm.train_dataset,
+                                  net_conf.train_batch_size, resume=resume_from is not None,
+                                  steps_per_batch=num_workers)
+
+        val_cache_budget_mb = config['val_cache_budget_mb'] if 'val_cache_budget_mb' in config else 1024
+        val_cache_dir = config['val_cache_dir'] if 'val_cache_dir' in config else None
+        if val_cache_dir is not None and num_workers > 1:
+            val_cache_dir = join(val_cache_dir, f'worker_{worker_index}')
+        validation_freq = config['validation_freq'] if 'validation_freq' in config else 1
 
-    with mirrored_strategy.scope():
+        callbacks = budget_callbacks + [checkpoint, metrics]
+        if 'patch_pool_mb' in config:
+            if resume_from is not None:
+                print('Note: the patch pool is not checkpointed. The resumed training refills it with new patches, '
+                      'so it does not continue with exactly the patches of the interrupted run.')
+            pool = dm.use_patch_pool(config['patch_pool_mb'],
+                                     refresh_fraction=config['patch_pool_refresh'] if 'patch_pool_refresh' in config else 0.1)
+            # Before the checkpoint, which records reads_per_sample in the history
+            callbacks.insert(0, PatchPoolRefresh(pool))
+        train_dataset = dm.get_train_dataset(batch_size=net_conf.train_batch_size)
+        val_transform = None
+        if teacher_dir is not None:
+            from cryocare.internals.CryoCAREDistillation import get_distillation_dataset
 
-        model = CryoCARE(net_conf, config['model_name'], basedir=config['path'])
+            train_dataset = get_distillation_dataset(train_dataset, teacher.keras_model, net_conf.train_batch_size)
+            # Cached with the validation patches, so the teacher predicts them only once
+            val_transform = lambda ds: get_distillation_dataset(ds, teacher.keras_model, net_conf.train_batch_size)
+        val_dataset = dm.get_val_dataset(cache_budget_mb=val_cache_budget_mb, cache_dir=val_cache_dir,
+                                         transform=val_transform)
+        train_dataset = metrics.timed_input(train_dataset)
 
-        history = model.train(dm.get_train_dataset(), dm.get_val_dataset())
+        model.train(train_dataset, val_dataset,
+                    validation_freq=validation_freq, callbacks=callbacks,
+                    initial_epoch=0 if resume_from is None else resume_from['epoch'] + 1)
         
-    mean, std = dm.train_dataset.mean, dm.train_dataset.std
+    if not is_chief:
+        scratch_dir.cleanup()
+        return
+
+    budget = budget_callbacks[-1]
+    checkpoint.history['budget'] = budget.summary()
+    print_budget(checkpoint.history['budget'])
 
+    # The checkpoint callback holds the history of all epochs, including the ones before a resume
     with open(join(config['path'], config['model_name'], 'history.dat'), 'wb+') as f:
-        pickle.dump(history.history, f)
+        pickle.dump(checkpoint.history, f)
+
+    if 'baseline_model' in config:
+        write_finetune_report(config, net_conf, checkpoint.history)
+
+    if teacher_dir is not None:
+        write_distillation_report(config, teacher, dm)
+        teacher_dir.cleanup()
+
+    write_model_archive(config['path'], config['model_name'])
+
+
+def get_budget_callbacks(config: dict, net_conf: Config) -> list:
+    """Returns the callbacks that end training before ``epochs`` if it stops improving or runs out of budget.
 
+    The last one is always a ``TrainingBudget``, which summarizes how training ended.
+    """
+    import tensorflow as tf
+    from cryocare.internals.CryoCARECallbacks import TrainingBudget
 
-    # Write norm to disk
+    callbacks = []
+    early_stopping = None
+    if 'early_stopping_patience' in config:
+        early_stopping = tf.keras.callbacks.EarlyStopping(
+            monitor='val_loss', patience=config['early_stopping_patience'],
+            min_delta=config['early_stopping_min_delta'] if 'early_stopping_min_delta' in config else 0, verbose=1)
+        callbacks.append(early_stopping)
+    callbacks.append(TrainingBudget(
+        net_conf.train_epochs, net_conf.train_steps_per_epoch,
+        max_seconds=config['max_hours'] * 3600 if 'max_hours' in config else None,
+        max_steps=config['max_steps'] if 'max_steps' in config else None,
+        early_stopping=early_stopping))
+    return callbacks
+
+
+def print_budget(summary: dict):
+    if summary['stop_reason'] == 'completed':
+        return
+    saved = f"{summary['steps_saved']} steps"
+    if 'seconds_saved' in summary:
+        saved += ' (about {:.1f} min)'.format(summary['seconds_saved'] / 60)
+    print(f"Training ended by {summary['stop_reason']} after {summary['epochs_run']} of "
+          f"{summary['epochs_planned']} epochs, {saved} less than planned.")
+
+
+def warm_start(model: CryoCARE, base_model: str, freeze_encoder: bool = False):
+    """Initializes ``model`` with the weights of the model archive ``base_model``.
+
+    The U-Net settings have to match. If ``freeze_encoder`` is set, the layers of the contracting path are not
+    trained. This has to happen before the model is compiled.
+    """
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        base_name, _ = extract_model_archive(base_model, tmpdirname)
+        base_dir = join(tmpdirname, base_name)
+        base_config = load_model_config(base_dir)
+        for key in ['unet_n_depth', 'unet_n_first', 'unet_kern_size']:
+            if base_config[key] != getattr(model.config, key):
+                raise ValueError(f'The base model was trained with {key}={base_config[key]}, '
+                                 f'but {key}={getattr(model.config, key)} is configured.')
+        weights = find_weights(base_dir)
+        print(f'Initializing from {base_model} ({os.path.basename(weights)})')
+        model.keras_model.load_weights(weights)
+
+    if freeze_encoder:
+        frozen = [layer for layer in model.keras_model.layers if layer.name.startswith('down_level_')]
+        for layer in frozen:
+            layer.trainable = False
+        print(f'Froze {len(frozen)} encoder layers')
+
+
+def write_finetune_report(config: dict, net_conf: Config, history: dict, tolerance: float = 0.01):
+    """Compares the fine-tuning run against the from-scratch model archive ``baseline_model``.
+
+    Reports the best validation losses and the number of training samples needed until the validation loss came
+    within ``tolerance`` of the best baseline loss.
+    """
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        baseline_name, _ = extract_model_archive(config['baseline_model'], tmpdirname)
+        baseline_config = load_model_config(join(tmpdirname, baseline_name))
+        baseline_history = load_history(join(tmpdirname, baseline_name))
+
+    def samples_until(history, target, samples_per_epoch):
+        # Validation might not have run every epoch
+        validation_freq = round(len(history['loss']) / len(history['val_loss']))
+        for i, loss in enumerate(history['val_loss']):
+            if loss <= target:
+                return (i + 1) * validation_freq * samples_per_epoch
+        return None
+
+    baseline_best = float(min(baseline_history['val_loss']))
+    baseline_samples_per_epoch = baseline_config['train_steps_per_epoch'] * baseline_config['train_batch_size']
+    finetune_samples_per_epoch = net_conf.train_steps_per_epoch * net_conf.train_batch_size
+    target = baseline_best * (1 + tolerance)
+    report = {
+        'baseline_best_val_loss': baseline_best,
+        'finetune_best_val_loss': float(min(history['val_loss'])),
+        'baseline_samples': samples_until(baseline_history, target, baseline_samples_per_epoch),
+        'finetune_samples': samples_until(history, target, finetune_samples_per_epoch),
+        'tolerance': tolerance
+    }
+    if report['finetune_samples'] is not None:
+        report['compute_fraction'] = report['finetune_samples'] / report['baseline_samples']
+        print('Fine-tuning reached the baseline validation loss with {:.1%} of the training samples.'.format(
+            report['compute_fraction']))
+    else:
+        print('Fine-tuning did not reach the baseline validation loss of {:.5f} (best: {:.5f}).'.format(
+            baseline_best, report['finetune_best_val_loss']))
+    with open(join(config['path'], config['model_name'], 'finetune_report.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+
+def write_distillation_report(config: dict, teacher: CryoCARE, dm: CryoCARE_DataModule):
+    """Reports the inference speedup of the student over the teacher and how closely it matches the teacher."""
+    from cryocare.internals.CryoCARE import CryoCARE
+    from cryocare.internals.CryoCAREDistillation import measure_inference_time, measure_fidelity
+
+    # Load the student like cryoCARE_predict.py does, outside of the training strategy
+    student = CryoCARE(None, config['model_name'], basedir=config['path'])
+    patch_shape = [int(s) for s in dm.val_dataset.sample_shape]
+    teacher_time = measure_inference_time(teacher.keras_model, patch_shape)
+    student_time = measure_inference_time(student.keras_model, patch_shape)
+    report = {
+        'teacher': {key: teacher.config.__dict__[key] for key in ['unet_n_depth', 'unet_n_first', 'unet_kern_size']},
+        'student': {key: student.config.__dict__[key] for key in ['unet_n_depth', 'unet_n_first', 'unet_kern_size']},
+        'teacher_parameters': int(teacher.keras_model.count_params()),
+        'student_parameters': int(student.keras_model.count_params()),
+        'teacher_seconds_per_patch': teacher_time,
+        'student_seconds_per_patch': student_time,
+        'speedup': teacher_time / student_time,
+        'fidelity': measure_fidelity(student.keras_model, teacher.keras_model, dm.get_val_dataset(),
+                                     config['batch_size'])
+    }
+    print('Student is {:.2f}x faster than the teacher, PSNR against the teacher: {:.2f} dB'.format(
+        report['speedup'], report['fidelity']['psnr']))
+    with open(join(config['path'], config['model_name'], 'distill_report.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+
+def run_autotune(conf_path: str, config: dict, net_conf: Config, dm: CryoCARE_DataModule, strategy):
+    from cryocare.internals.CryoCAREAutotune import autotune
+
+    batch_sizes = config['autotune_batch_sizes'] if 'autotune_batch_sizes' in config else [1, 2, 4, 8, 16, 32, 64]
+    patch_shapes = config['autotune_patch_shapes'] if 'autotune_patch_shapes' in config else [
+        [int(s) for s in dm.train_dataset.sample_shape]]
+
+    results, best = autotune(net_conf, dm, batch_sizes, patch_shapes, strategy)
+
+    print(f"Best configuration: batch size {best['batch_size']}, patch shape {best['patch_shape']} "
+          f"({best['samples_per_second']:.1f} samples/s)")
+    config['batch_size'] = best['batch_size']
+    if best['patch_shape'] != [int(s) for s in dm.train_dataset.extracted_sample_shape]:
+        config['patch_shape'] = best['patch_shape']
+    else:
+        config.pop('patch_shape', None)
+    with open(conf_path, 'w') as f:
+        json.dump(config, f, indent=4)
+    with open(os.path.splitext(conf_path)[0] + '_autotune.json', 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f'Updated {conf_path}')
+
+
+def print_check(config: dict, errors: list):
+    """Prints what training would do with ``config`` and exits, with a non-zero status if the config has errors."""
+    if len(errors) == 0:
+        dm = CryoCARE_DataModule()
+        # A dry run, training data of earlier versions is converted by the training itself
+        dm.load(config['train_data'], convert=False)
+        patch_shape = config['patch_shape'] if 'patch_shape' in config else \
+            [int(s) for s in dm.train_dataset.extracted_sample_shape]
+        print(f"Training data: {len(dm.train_dataset)} training and {len(dm.val_dataset)} validation patches "
+              f"from {len(dm.train_dataset.tomo_paths_even)} tomograms, patch shape {patch_shape}")
+        print(f"U-Net: depth {config['unet_n_depth']}, {config['unet_n_first']} first filters, "
+              f"kernel size {config['unet_kern_size']}")
+        print(f"Training: {config['epochs']} epochs of {config['steps_per_epoch']} steps, batch size "
+              f"{config['batch_size']}, learning rate {config['learning_rate']}")
+        print(f"Model: {join(config['path'], config['model_name'])}.tar.gz")
+    else:
+        print('\n'.join(errors))
+    sys.exit(0 if len(errors) == 0 else 1)
+
+
+def write_norm(dm: CryoCARE_DataModule, model_dir: str):
+    mean, std = dm.train_dataset.mean, dm.train_dataset.std
     norm = {
         "mean": float(mean),
         "std": float(std)
     }
-    with open(join(config['path'], config['model_name'], 'norm.json'), 'w') as fp:
+    os.makedirs(model_dir, exist_ok=True)
+    with open(join(model_dir, 'norm.json'), 'w') as fp:
         json.dump(norm, fp)
 
-    import tarfile
-    import os
-    with tarfile.open(join(config['path'], f"{config['model_name']}.tar.gz"), "w:gz") as tar:
-        tar.add(join(config['path'], config['model_name']), arcname=os.path.basename(join(config['path'], config['model_name'])))
-
-
 
 if __name__ == "__main__":
     main()